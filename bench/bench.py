@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Benchmark the container life cycle of lxci: create_runtime_container(),
+start(), run_command() and archive() or destroy().
+
+By default the lxc module is replaced with bench/fakelxc which only sleeps
+for the given latencies so the numbers show the overhead added by lxci
+itself. With --real the real lxc module and base container are used.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.realpath(os.path.dirname(__file__))
+
+# Latency of the fake lxc operation included in each phase
+PHASE_LATENCIES = {
+    "clone": "clone",
+    "boot": "start",
+    "command": "attach",
+    "stop": "stop",
+    "destroy": "destroy",
+}
+
+parser = argparse.ArgumentParser(description="Benchmark the lxci container life cycle")
+parser.add_argument("-n", "--jobs", metavar="N", type=int, default=10, dest="jobs", help="number of containers to run through the life cycle. DEFAULT: 10")
+parser.add_argument("-c", "--concurrency", metavar="N", type=int, default=1, dest="concurrency", help="number of containers processed concurrently. DEFAULT: 1")
+parser.add_argument("--real", metavar="BASE_CONTAINER", dest="real", help="use the real lxc module and the given base container instead of the fake lxc")
+parser.add_argument("--root", metavar="DIR", dest="root", help="directory for the lxci home and the runtime and archived containers. Use a tmpfs mount to compare against disk. DEFAULT: a new temporary directory")
+parser.add_argument("-p", "--snapshot", dest="snapshot", action="store_true", help="clone the containers as snapshots")
+parser.add_argument("-B", "--backingstore", metavar="BACKINGSTORE", dest="backingstore", help="backingstore of the clones like with lxci")
+parser.add_argument("-A", "--archive", dest="archive", action="store_true", help="archive the containers instead of destroying them")
+parser.add_argument("-x", "--exec-backend", metavar="BACKEND", default="attach", dest="exec_backend", help="exec backend for the command. DEFAULT: attach")
+parser.add_argument("--command", metavar="COMMAND", default="true", dest="command", help="command run in the containers. DEFAULT: true")
+parser.add_argument("--latency", metavar="OPERATION=SECONDS", action="append", default=[], dest="latencies", help="latency of a fake lxc operation: clone, start, stop, destroy or attach. Can be given multiple times")
+parser.add_argument("--base-files", metavar="N", type=int, default=100, dest="base_files", help="number of files in the fake base container rootfs. DEFAULT: 100")
+parser.add_argument("--json", dest="json", action="store_true", help="print the results as JSON")
+
+
+def create_fake_base(base_config_path, name, files):
+    """
+    Create a directory backed fake base container with a minimal rootfs
+    """
+    container_dir = os.path.join(base_config_path, name)
+    rootfs = os.path.join(container_dir, "rootfs")
+    for d in ("etc", "home", "var/lib/dpkg", "usr/share/bench"):
+        os.makedirs(os.path.join(rootfs, d), exist_ok=True)
+    with open(os.path.join(rootfs, "etc", "hostname"), "w") as f:
+        f.write(name + "\n")
+    with open(os.path.join(rootfs, "var/lib/dpkg/status"), "w") as f:
+        f.write("")
+    for i in range(files):
+        with open(os.path.join(rootfs, "usr/share/bench", str(i)), "wb") as f:
+            f.write(b"x" * 4096)
+    with open(os.path.join(container_dir, "config"), "w") as f:
+        f.write("lxc.rootfs = {}\n".format(rootfs))
+        f.write("lxc.utsname = {}\n".format(name))
+
+
+def setup(args, latencies):
+    """
+    Write lxci config for the benchmark and point the environment to it. Must
+    be called before importing lxci
+    """
+    root = os.path.realpath(args.root or tempfile.mkdtemp(prefix="lxci-bench-"))
+    home = os.path.join(root, "home")
+    os.makedirs(home, exist_ok=True)
+
+    settings = {
+        "RUNTIME_CONFIG_PATH": os.path.join(root, "runtime"),
+        "ARCHIVE_CONFIG_PATH": os.path.join(root, "archive"),
+        "RESULTS_PATH": os.path.join(root, "results"),
+        "STATE_PATH": os.path.join(root, "state"),
+        "CACHE_CONFIG_PATH": os.path.join(root, "cache"),
+        "EXEC_BACKEND": args.exec_backend,
+    }
+
+    if args.real:
+        base = args.real
+    else:
+        base = "bench"
+        settings["BASE_CONFIG_PATH"] = os.path.join(root, "base")
+        if not os.path.exists(os.path.join(settings["BASE_CONFIG_PATH"], base)):
+            create_fake_base(settings["BASE_CONFIG_PATH"], base, args.base_files)
+        os.environ["LXCI_BENCH_LXCPATH"] = settings["BASE_CONFIG_PATH"]
+        os.environ["LXCI_BENCH_LATENCIES"] = json.dumps(latencies)
+        os.environ["PATH"] = os.path.join(BENCH_DIR, "bin") + os.pathsep + os.environ["PATH"]
+        sys.path.insert(0, os.path.join(BENCH_DIR, "fakelxc"))
+
+    with open(os.path.join(home, "config"), "w") as f:
+        for key, value in sorted(settings.items()):
+            f.write("{} = {}\n".format(key, value))
+
+    os.environ["LXCI_HOME"] = home
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    return root, base
+
+
+def _init_worker():
+    # Keep the attach backend from allocating a pseudo-terminal
+    sys.stdin = open(os.devnull, "r")
+
+
+def run_job(args, base, i):
+    """
+    Run one container through the life cycle
+
+    returns history entry like lxci.append_history() writes
+    """
+    import lxci
+
+    name = "bench-{}-{}".format(os.getpid(), i)
+    started = time.time()
+    runtime_container = lxci.create_runtime_container(
+        base, name, snapshot=args.snapshot, backingstore=args.backingstore
+    )
+    runtime_container.start()
+    result = runtime_container.run_command(args.command)
+    runtime_container.stop()
+    if args.archive:
+        runtime_container.archive()
+    else:
+        runtime_container.destroy()
+
+    meta = runtime_container.read_meta()
+    return {
+        "name": name,
+        "base": base,
+        "backingstore": meta.get("backingstore"),
+        "exit_code": result.returncode,
+        "timings": dict(meta.get("timings", {}), total=time.time() - started),
+    }
+
+
+def print_results(stats, wall, jobs, file=sys.stdout):
+    phase_width = max([len("PHASE")] + [len(s["phase"]) for s in stats])
+    row = "{phase:<{pw}}  {count:>6}  {p50:>8}  {p95:>8}  {max:>8}  {overhead:>9}"
+    print(row.format(
+        phase="PHASE", count="COUNT", p50="P50", p95="P95", max="MAX", overhead="OVERHEAD", pw=phase_width
+    ), file=file)
+    for s in stats:
+        print(row.format(
+            phase=s["phase"],
+            count=s["count"],
+            p50="{:.3f}s".format(s["p50"]),
+            p95="{:.3f}s".format(s["p95"]),
+            max="{:.3f}s".format(s["max"]),
+            overhead="{:.3f}s".format(s["overhead"]) if "overhead" in s else "-",
+            pw=phase_width
+        ), file=file)
+    print("{jobs} jobs in {wall:.2f}s ({rate:.2f} jobs/s)".format(
+        jobs=jobs, wall=wall, rate=jobs / wall if wall else 0
+    ), file=file)
+
+
+def main():
+    args = parser.parse_args()
+
+    latencies = {}
+    for pair in args.latencies:
+        operation, sep, seconds = pair.partition("=")
+        if not sep:
+            parser.error("Invalid --latency value: {}".format(pair))
+        latencies[operation] = float(seconds)
+
+    root, base = setup(args, latencies)
+    import lxci
+
+    started = time.time()
+    entries = []
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.concurrency, initializer=_init_worker) as executor:
+        futures = [executor.submit(run_job, args, base, i) for i in range(args.jobs)]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                entries.append(future.result())
+            except Exception as e:
+                lxci.error_message("Job failed: {}".format(e))
+                failed += 1
+    wall = time.time() - started
+
+    stats = lxci.compute_stats(entries)
+    if not args.real:
+        # Time spent in lxci on top of the fake lxc operations
+        for s in stats:
+            operation = PHASE_LATENCIES.get(s["phase"])
+            if operation:
+                s["overhead"] = s["p50"] - latencies.get(operation, 0)
+
+    if args.json:
+        print(json.dumps({
+            "root": root,
+            "jobs": args.jobs,
+            "concurrency": args.concurrency,
+            "failed": failed,
+            "wall": wall,
+            "stats": stats,
+        }, indent=4, sort_keys=True))
+    else:
+        print_results(stats, wall, len(entries))
+
+    # Fake containers in a temporary directory are of no use afterwards
+    if not args.real and not args.root:
+        shutil.rmtree(root)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Stand-in for the python3-lxc module used by bench/bench.py to measure the
+overhead of lxci itself without real containers.
+
+Containers are plain directories with a config file like with lxc. Nothing is
+ever executed in them. The operations which take time with real containers
+sleep for the latencies given as JSON object in LXCI_BENCH_LATENCIES, for
+example {"clone": 0.5, "start": 2}. See LATENCIES for the keys.
+"""
+import json
+import os
+import shutil
+import time
+
+LATENCIES = {
+    "clone": 0.0,
+    "start": 0.0,
+    "stop": 0.0,
+    "destroy": 0.0,
+    "attach": 0.0,
+}
+LATENCIES.update(json.loads(os.environ.get("LXCI_BENCH_LATENCIES", "{}")))
+
+LXC_CLONE_SNAPSHOT = 4
+
+default_config_path = os.environ.get("LXCI_BENCH_LXCPATH", "/var/lib/lxc")
+
+def _sleep(operation):
+    if LATENCIES[operation]:
+        time.sleep(LATENCIES[operation])
+
+def list_containers(config_path=None, **kw):
+    config_path = config_path or default_config_path
+    if not os.path.isdir(config_path):
+        return ()
+    return tuple(sorted(
+        name for name in os.listdir(config_path)
+        if os.path.exists(os.path.join(config_path, name, "config"))
+    ))
+
+
+class Container():
+
+    def __init__(self, name, config_path=None):
+        self.name = name
+        self.config_path = config_path or default_config_path
+        self.dir = os.path.join(self.config_path, name)
+        self.config_file_name = os.path.join(self.dir, "config")
+        self.config = []
+        if os.path.exists(self.config_file_name):
+            with open(self.config_file_name, "r") as f:
+                for line in f:
+                    key, sep, value = line.partition("=")
+                    if sep:
+                        self.config.append((key.strip(), value.strip()))
+
+    def _state_path(self):
+        return os.path.join(self.dir, "state")
+
+    @property
+    def state(self):
+        try:
+            with open(self._state_path(), "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return "STOPPED"
+
+    def _set_state(self, state):
+        with open(self._state_path(), "w") as f:
+            f.write(state)
+
+    @property
+    def init_pid(self):
+        return os.getpid() if self.state == "RUNNING" else -1
+
+    def get_config_path(self):
+        return self.config_path
+
+    def get_config_item(self, key):
+        values = [v for k, v in self.config if k == key]
+        if len(values) == 1:
+            return values[0]
+        return values or ""
+
+    def set_config_item(self, key, value):
+        self.config.append((key, value))
+        return True
+
+    def clear_config_item(self, key):
+        self.config = [(k, v) for k, v in self.config if k != key]
+        return True
+
+    def save_config(self):
+        with open(self.config_file_name, "w") as f:
+            for key, value in self.config:
+                f.write("{} = {}\n".format(key, value))
+        return True
+
+    def clone(self, name, config_path=None, flags=0, bdevtype=None, **kw):
+        _sleep("clone")
+        config_path = config_path or self.config_path
+        clone_dir = os.path.join(config_path, name)
+        os.makedirs(clone_dir)
+        rootfs = self.get_config_item("lxc.rootfs").split(":")[-1]
+
+        clone = Container(name, config_path)
+        clone.config = [(k, v) for k, v in self.config if k not in ("lxc.rootfs", "lxc.utsname")]
+        if flags & LXC_CLONE_SNAPSHOT:
+            delta = os.path.join(clone_dir, "delta0")
+            os.mkdir(delta)
+            clone.set_config_item("lxc.rootfs", "overlayfs:{}:{}".format(rootfs, delta))
+        else:
+            shutil.copytree(rootfs, os.path.join(clone_dir, "rootfs"), symlinks=True)
+            clone.set_config_item("lxc.rootfs", os.path.join(clone_dir, "rootfs"))
+        clone.set_config_item("lxc.utsname", name)
+        clone.save_config()
+        return clone
+
+    def start(self, useinit=True, daemonize=True, close_fds=False, cmd=()):
+        _sleep("start")
+        if daemonize:
+            self._set_state("RUNNING")
+        return True
+
+    def wait(self, state, timeout=-1):
+        return self.state == state
+
+    def stop(self):
+        _sleep("stop")
+        self._set_state("STOPPED")
+        return True
+
+    def shutdown(self, timeout=-1):
+        return self.stop()
+
+    def destroy(self):
+        _sleep("destroy")
+        shutil.rmtree(self.dir)
+        return True
+
+    def get_ips(self, **kw):
+        return ("127.0.0.1",)
+
+    def attach(self, run, payload=None, **kw):
+        # The command is not run. Just pretend it took the attach latency
+        pid = os.fork()
+        if pid == 0:
+            _sleep("attach")
+            os._exit(0)
+        return pid
+
+    def get_cgroup_item(self, key):
+        return ""
+
+    def set_cgroup_item(self, key, value):
+        return True
@@ -3,7 +3,6 @@ import argparse
 import sys
 import datetime
 import atexit
-import lxc
 import os
 import json
 import subprocess
@@ -19,16 +18,22 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument("base_container", metavar="BASE_CONTAINER", nargs="?", help="base container to use. Use [sudo] lxc-ls to list available containers.")
 parser.add_argument("-c", "--command", metavar="COMMAND", default="bash", dest="command", help="shell command to be executed in the container. If set to - the command will be read from the stdin. DEFAULT: bash")
+parser.add_argument("--step", metavar="NAME=COMMAND", action="append", dest="steps", help="run COMMAND as a step named NAME instead of --command. Can be given many times. The steps are run in order in the same container and their exit statuses and durations are saved to the meta data. The exit status is the one of the first failed step")
+parser.add_argument("--steps-file", metavar="PATH", dest="steps_file", help="read the steps from a JSON file with a list of objects with name and command keys. Run before the --step steps")
+parser.add_argument("--fail-fast", dest="fail_fast", action="store_true", help="skip the steps after the first failed step")
 parser.add_argument("-C", "--success-command", metavar="SUCCESS_COMMAND", dest="success_command", help="shell command to be executed on the host when the build succeeds (exit status 0). The command is executed before the container is destroyed.")
+parser.add_argument("-R", "--results-format", metavar="FORMAT", dest="results_format", help="how the result artifacts are stored to the results path. FORMAT must be dir, tar, tar.gz, tar.xz or tar.zst. The tar formats create a single tarball with a SHA256SUMS manifest. DEFAULT: RESULTS_FORMAT from the config")
 parser.add_argument("-n", "--name",  metavar="NAME", dest="name", help="custom name for the temporary runtime container")
 parser.add_argument("-t", "--tag",  metavar="TAG", dest="tag", help="tag container with TAG")
 parser.add_argument("-s", "--sync",  metavar="DIR", dest="workspace_source_dir", help="synchronize DIR to the container. The trailing slash works like in rsync. If it is present the contents of the DIR is synchronized to the current working directory command. If not the directory itself is synchronized.")
-parser.add_argument("-A", "--archive", dest="archive", action="store_true", help="archive the container after running the command. The archive is always created with a directory backing store")
+parser.add_argument("-M", "--sync-mode", metavar="MODE", dest="sync_mode", help="how --sync gets the DIR to the container. MODE must be rsync or mount. mount mounts DIR read-only with a writable overlayfs layer in the container so nothing is copied. It works only with privileged containers. DEFAULT: SYNC_MODE from the config")
+parser.add_argument("-A", "--archive", dest="archive", action="store_true", help="archive the container after running the command. The container is moved to the archive if it is on the same filesystem. Otherwise it is copied as a snapshot of the base container if possible or as a directory backed container")
 parser.add_argument("-a", "--archive-on-fail", dest="archive_on_fail", action="store_true", help="archive the container only if the command returns with non zero exit status")
 parser.add_argument("-m", "--info", metavar="NAME", dest="info", help="display meta data of an archived container")
-parser.add_argument("-D", "--destroy", metavar="STATE", dest="destroy_containers", help="destroy containers. STATE must be archive or runtime. Filter with --tag TAG")
+parser.add_argument("-D", "--destroy", metavar="STATE", dest="destroy_containers", help="destroy containers. STATE must be archive, runtime, pool or cache. Filter with --tag TAG")
 parser.add_argument("-d", "--destroy-archive-on-success", dest="destroy_on_ok", action="store_true", help="destroy archived containers on success. If --tag is set only the containers with matching tags will be destroyed")
-parser.add_argument("-i", "--inspect",  metavar="NAME", dest="inspect", help="start bash in the archived container for inspection")
+parser.add_argument("-i", "--inspect",  metavar="NAME", dest="inspect", help="start bash in the archived container for inspection. Exported containers are restored to the archive first")
+parser.add_argument("--export", metavar="NAME", dest="export", help="replace the archived container with a zstd compressed tarball of its changes to the base container in EXPORT_PATH. List the exports with --list export")
 parser.add_argument("-E", "--copy-env",  metavar="ENV", dest="copy_env", help="copy comma separated environment variables to the container")
 parser.add_argument("-e", "--set-env", metavar="ENV", nargs="*", dest="set_env", help="Set environment variable for the container. Example FOO=bar")
 parser.add_argument("--print-config", dest="print_config", action="store_true", help="print config")
@@ -37,55 +42,117 @@ parser.add_argument("-S", "--sudo", dest="sudo", action="store_true", help="enab
 parser.add_argument("-p", "--snapshot", dest="snapshot", action="store_true", help="clone base container as a snapshot. Makes the temporary container creation really fast if your host filesystem supports this")
 parser.add_argument("-B", "--backingstore", metavar="BACKINGSTORE", dest="backingstore", help="set custom backingstore for --snapshot. Works just like lxc-clone --backingstore")
 parser.add_argument("-V", "--version", dest="version", action="store_true", help="print lxci version")
-parser.add_argument("-l", "--list", metavar="STATE", dest="list_containers", help="list containers. STATE must be archive or runtime. Filter with --tag TAG")
-parser.add_argument("--stop", metavar="STATE", dest="stop_containers", help="stop containers. STATE must be archive or runtime. Filter with --tag TAG")
+parser.add_argument("-l", "--list", metavar="STATE", dest="list_containers", help="list containers. STATE must be archive, runtime, pool, cache or export. Filter with --tag TAG")
+parser.add_argument("--stop", metavar="STATE", dest="stop_containers", help="stop containers. STATE must be archive, runtime or pool. Filter with --tag TAG")
+parser.add_argument("-P", "--pool", dest="pool", action="store_true", help="take the container from the pool of prepared containers instead of cloning it. The pool is refilled in the background. See POOL_SIZE and POOL_STATE in the config")
+parser.add_argument("--fill-pool", dest="fill_pool", action="store_true", help="fill the pool of BASE_CONTAINER and exit. Use with the same --sudo, --snapshot and --backingstore options as the builds")
+parser.add_argument("--cache", dest="cache", action="store_true", help="clone the container as a snapshot of a cached copy of BASE_CONTAINER which has been already prepared for lxci. The cached copy is recreated when the base container changes. See CACHE_SIZE in the config")
+parser.add_argument("--package-cache", dest="package_cache", action="store_true", help="share the apt and pip downloads with the other builds of BASE_CONTAINER through a cache on the host. See PACKAGE_CACHE_SIZE in the config. DEFAULT: PACKAGE_CACHE from the config")
+parser.add_argument("--build-cache", dest="build_cache", action="store_true", help="mount a cache directory kept between the builds with the same --tag to /home/lxci/cache. CCACHE_DIR and SCCACHE_DIR point to it. Each build works on an overlayfs layer or a reflinked copy which replaces the cache when the build succeeds. Without either the cache is read-only. See BUILD_CACHE_SIZE in the config")
+parser.add_argument("--checkpoint", dest="checkpoint", action="store_true", help="like --cache but the cached copy is booted once and saved as a CRIU checkpoint. The builds are restored from the checkpoint instead of booting them. Falls back to booting when the restore fails or the build has mounts like --sync-mode mount, --package-cache or --build-cache. Requires CRIU and privileged containers")
+parser.add_argument("-x", "--exec-backend", metavar="BACKEND", dest="exec_backend", help="how the command is executed in the container. BACKEND must be ssh or attach. attach does not need the network or SSH server in the container. DEFAULT: EXEC_BACKEND from the config")
+parser.add_argument("-b", "--batch", metavar="MANIFEST", dest="batch", help="run the jobs of a JSON manifest concurrently. Each job is run like a separate lxci command. Exits with non zero status if any of the jobs fail")
+parser.add_argument("-j", "--jobs", metavar="N", type=int, dest="jobs", help="number of jobs to run concurrently with --batch or containers to process concurrently with --stop, --destroy, --gc and --destroy-archive-on-success. DEFAULT: JOBS from the config")
+parser.add_argument("--stats", dest="stats", action="store_true", help="print p50, p95 and max durations of the container phases from the timing history")
+parser.add_argument("--group-by", metavar="KEY", dest="group_by", default="base", help="group --stats by KEY. KEY must be base, backingstore or tag. DEFAULT: base")
+parser.add_argument("--prometheus", metavar="PATH", dest="prometheus", help="with --stats write the stats to PATH in the Prometheus text format for the node_exporter textfile collector instead of printing them")
+parser.add_argument("--gc", dest="gc", action="store_true", help="destroy archived containers over the retention limits ARCHIVE_MAX_AGE, ARCHIVE_MAX_PER_TAG and ARCHIVE_MAX_SIZE of the config. Successful builds and older archives go first")
+parser.add_argument("--dry-run", dest="dry_run", action="store_true", help="with --gc only print the archived containers which would be destroyed")
+parser.add_argument("--memory-limit", metavar="BYTES", dest="memory_limit", help="limit the memory of the container. K, M and G suffixes can be used. DEFAULT: MEMORY_LIMIT from the config")
+parser.add_argument("--cpu-shares", metavar="SHARES", type=int, dest="cpu_shares", help="relative CPU share of the container. 1024 is the default share of a cgroup. Converted to cpu.weight with cgroup v2. DEFAULT: CPU_SHARES from the config")
+parser.add_argument("--blkio-weight", metavar="WEIGHT", type=int, dest="blkio_weight", help="relative block I/O weight of the container from 10 to 1000. Converted to io.weight with cgroup v2. DEFAULT: BLKIO_WEIGHT from the config")
+parser.add_argument("--no-daemon", dest="no_daemon", action="store_true", help="run the build in this process even if USE_DAEMON is set in the config")
 parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="be verbose")
 
 
+# Options the members of DAEMON_GROUP may pass to lxcid. lxcid runs the
+# jobs as root so the options running commands on the host, reading or
+# writing arbitrary host paths, managing the containers of others or raising
+# the resource limits are reserved for root
+DAEMON_USER_ARGS = (
+    "base_container", "command", "steps", "fail_fast", "results_format", "name", "tag",
+    "workspace_source_dir", "sync_mode", "archive", "archive_on_fail", "set_env", "sudo",
+    "snapshot", "backingstore", "pool", "cache", "package_cache", "build_cache", "checkpoint",
+    "exec_backend", "no_daemon", "verbose",
+)
+
+
 def die(*a):
     error_message(*a)
     sys.exit(2)
 
+def check_daemon_user_args(args):
+    denied = [
+        action.option_strings[-1] for action in parser._actions
+        if action.option_strings and action.dest not in DAEMON_USER_ARGS
+        and getattr(args, action.dest, action.default) != action.default
+    ]
+    if denied:
+        die("Permission denied: only root may pass {} to lxcid".format(", ".join(denied)))
+
 
 def inspect(args):
+    import lxc
+    from lxci import _export
     if not args.inspect in lxci.list_archived_containers():
-        die("Unknown container {}. See lxci --list archive".format(args.inspect))
+        if not args.inspect in _export.list_exports():
+            die("Unknown container {}. See lxci --list archive".format(args.inspect))
+        try:
+            _export.restore_export(args.inspect)
+        except lxci.RuntimeContainerError as e:
+            die("Failed to restore {}: {}".format(args.inspect, e))
     container = lxci.RuntimeContainer(lxc.Container(args.inspect, config_path=config.ARCHIVE_CONFIG_PATH))
+    # The size changes when the container is used
+    container.add_meta({"size": None})
     container.start()
-    cmd = container.run_command("bash")
+    cmd = container.run_command("bash", log=False)
     container.stop()
     sys.exit(cmd.returncode)
 
 def info(args):
-    if not args.info in lxci.list_archived_containers():
-        die("{} is not an archived container. See lxci --list archive".format(args.base_container))
-    c = lxci.RuntimeContainer(lxc.Container(args.info))
-    print(json.dumps(c.read_meta(), sort_keys=True, indent=4))
+    from lxci import _export
+    containers = lxci.list_archived_containers(return_object=True, name=args.info)
+    if not containers and args.info in _export.list_exports():
+        print(json.dumps(_export.read_export_manifest(args.info)["meta"], sort_keys=True, indent=4))
+        return
+    if not containers:
+        die("{} is not an archived container. See lxci --list archive".format(args.info))
+    print(json.dumps(containers[0].read_meta(), sort_keys=True, indent=4))
+
+def run_bulk(action, containers, args):
+    failed = lxci.run_bulk(action, containers, jobs=args.jobs)
+    if failed:
+        error_message("Failed to {action} {count} of {total} containers:".format(
+            action=action, count=len(failed), total=len(containers)
+        ))
+        for name, error in sorted(failed.items()):
+            error_message("  {}: {}".format(name, error))
+    return failed
 
 def destroy_archive(args):
     containers = lxci.list_archived_containers(return_object=True, tag_filter=args.tag)
-    for c in containers:
-        c.destroy()
+    run_bulk("destroy", containers, args)
 
 
-def list_containers_by_state(state, tag):
+def list_containers_by_state(state, tag, return_object=True):
     containers = []
     if state == "archive":
-        containers = lxci.list_archived_containers(return_object=True, tag_filter=tag)
+        containers = lxci.list_archived_containers(return_object=return_object, tag_filter=tag)
     elif state == "runtime":
-        containers = lxci.list_runtime_containers(return_object=True, tag_filter=tag)
+        containers = lxci.list_runtime_containers(return_object=return_object, tag_filter=tag)
+    elif state == "pool":
+        containers = lxci.list_pool_containers(return_object=return_object, tag_filter=tag)
+    elif state == "cache":
+        containers = lxci.list_cache_containers(return_object=return_object, tag_filter=tag)
     else:
-        die("Expected STATE to be archive or runtime")
+        die("Expected STATE to be archive, runtime, pool or cache")
 
     return containers
 
-    if (len(containers) == 0):
-        verbose_message("No matching containers")
-        return
-
 def stop_containers(args):
-    for c in list_containers_by_state(args.stop_containers, args.tag):
-        c.stop()
+    containers = list_containers_by_state(args.stop_containers, args.tag)
+    if run_bulk("stop", containers, args):
+        sys.exit(1)
 
 def destroy_containers(args):
     state = args.destroy_containers
@@ -95,24 +162,128 @@ def destroy_containers(args):
         verbose_message("No matching containers")
         return
 
-    for c in containers:
-        if state == "runtime" and not c.is_stopped():
+    running = []
+    if state in ("runtime", "pool"):
+        running = [c for c in containers if not c.is_stopped()]
+        for c in running:
             error_message("Cannot destroy running runtime container '{}'. Use --stop first".format(c.get_name()))
+    elif state == "cache":
+        running = [c for c in containers if lxci.is_cache_container_in_use(c.get_name())]
+        for c in running:
+            error_message("Cannot destroy cached container '{}'. It has snapshots in the runtime or archive".format(c.get_name()))
+
+    if run_bulk("destroy", [c for c in containers if c not in running], args):
+        sys.exit(1)
+
+def export(args):
+    from lxci import _export
+    if not args.export in lxci.list_archived_containers():
+        die("Unknown container {}. See lxci --list archive".format(args.export))
+    try:
+        manifest = _export.export_container(args.export)
+    except lxci.RuntimeContainerError as e:
+        die("Failed to export {}: {}".format(args.export, e))
+    verbose_message("Exported {} files to {} ({} bytes)".format(
+        len(manifest["files"]), _export.get_export_path(args.export), manifest["size"]
+    ))
+
+def list_exports(args):
+    from lxci import _export
+    for name in _export.list_exports():
+        manifest = _export.read_export_manifest(name)
+        if args.tag and args.tag not in manifest["meta"].get("tags", []):
+            continue
+        if config.VERBOSE:
+            print("{name} base={base} size={size} exported={exported}".format(**manifest))
         else:
-            c.destroy()
+            print(name)
 
 def list_containers(args):
-    containers = list_containers_by_state(args.list_containers, args.tag)
+    if args.list_containers == "export":
+        return list_exports(args)
+    # The names come from the container index. Only the state printed in
+    # the verbose mode needs liblxc
+    containers = list_containers_by_state(args.list_containers, args.tag, return_object=config.VERBOSE)
 
     if (len(containers) == 0):
         verbose_message("No matching containers")
         return
 
     for c in containers:
-        if config.VERBOSE:
-            print(c)
-        else:
-            print(c.get_name())
+        print(c)
+
+
+def batch(args):
+    try:
+        jobs = lxci.load_manifest(args.batch)
+    except (OSError, lxci.RuntimeContainerError) as e:
+        die("Failed to load manifest: {}".format(e))
+
+    lxci_command = [sys.executable, os.path.realpath(sys.argv[0]), "--exec-backend", config.EXEC_BACKEND]
+    if config.VERBOSE:
+        lxci_command.append("--verbose")
+
+    results = lxci.run_batch(jobs, lxci_command, parallel=args.jobs or config.JOBS)
+    lxci.print_batch_results(results)
+
+    if any(r["exit_code"] != 0 for r in results):
+        sys.exit(1)
+
+
+def gc(args):
+    if not (config.ARCHIVE_MAX_AGE or config.ARCHIVE_MAX_PER_TAG or config.ARCHIVE_MAX_SIZE):
+        die("No retention limits. Set ARCHIVE_MAX_AGE, ARCHIVE_MAX_PER_TAG or ARCHIVE_MAX_SIZE in the config")
+
+    for name, reason in lxci.collect_garbage(dry_run=args.dry_run, jobs=args.jobs):
+        print("{}: {}".format(name, reason))
+
+
+def stats(args):
+    from lxci import _stats
+    if args.group_by not in _stats.GROUP_BY_KEYS:
+        die("Expected KEY to be {}".format(", ".join(_stats.GROUP_BY_KEYS)))
+
+    phase_stats = _stats.compute_stats(_stats.read_history(), group_by=args.group_by)
+    if args.prometheus:
+        _stats.write_prometheus_textfile(phase_stats, args.prometheus, group_by=args.group_by)
+    else:
+        _stats.print_stats(phase_stats, group_by=args.group_by)
+
+
+def refill_pool(args):
+    """
+    Refill the pool in a detached lxci process
+    """
+    cmd = [sys.executable, os.path.realpath(sys.argv[0]), args.base_container, "--fill-pool"]
+    if args.sudo:
+        cmd.append("--sudo")
+    if args.snapshot:
+        cmd.append("--snapshot")
+    if args.backingstore:
+        cmd += ["--backingstore", args.backingstore]
+
+    verbose_message("Refilling the pool in the background")
+    subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+
+
+def start_gc():
+    """
+    Run --gc in a detached lxci process so that the build does not wait for it
+    """
+    verbose_message("Collecting garbage in the background")
+    subprocess.Popen(
+        [sys.executable, os.path.realpath(sys.argv[0]), "--gc"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
 
 
 def print_config(prefix=""):
@@ -120,10 +291,27 @@ def print_config(prefix=""):
         if key.isupper():
             print("{p}{k}=\"{v}\"".format(p=prefix, k=key, v=getattr(config, key)))
 
+def use_daemon(args):
+    # Interactive builds need the terminal and --copy-env the environment of
+    # this process so they are not submitted to lxcid
+    return (
+        config.USE_DAEMON
+        and not args.no_daemon
+        and not args.copy_env
+        and not os.environ.get("LXCI_DAEMON_JOB")
+        and not sys.stdin.isatty()
+    )
+
 def main():
     args = parser.parse_args()
+    if os.environ.get("LXCI_DAEMON_UID", "0") != "0":
+        check_daemon_user_args(args)
     if args.verbose:
         config.VERBOSE = True
+    if args.exec_backend:
+        if args.exec_backend not in lxci.EXEC_BACKENDS:
+            die("Expected BACKEND to be {}".format(" or ".join(sorted(lxci.EXEC_BACKENDS))))
+        config.EXEC_BACKEND = args.exec_backend
     env = {}
 
 
@@ -139,7 +327,8 @@ def main():
         print(config.VERSION)
         sys.exit(0)
 
-    if args.command == "-":
+    command_from_stdin = args.command == "-"
+    if command_from_stdin:
         args.command = sys.stdin.read()
 
     if args.list_containers:
@@ -157,6 +346,37 @@ def main():
     if args.info:
         return info(args)
 
+    if args.export:
+        return export(args)
+
+    if args.batch:
+        return batch(args)
+
+    steps = []
+    try:
+        if args.steps_file:
+            steps += lxci.load_steps(args.steps_file)
+        steps += [lxci.parse_step(step) for step in args.steps or []]
+    except (OSError, lxci.RuntimeContainerError) as e:
+        die("Failed to load steps: {}".format(e))
+
+    if args.stats:
+        return stats(args)
+
+    if args.gc:
+        return gc(args)
+
+    if use_daemon(args):
+        argv = sys.argv[1:]
+        if command_from_stdin:
+            # The last --command wins
+            argv += ["--command", args.command]
+        try:
+            from lxci import _daemon
+            sys.exit(_daemon.run_via_daemon(argv))
+        except OSError as e:
+            error_message("Cannot connect to lxcid at {}: {}. Running the build locally".format(config.DAEMON_SOCKET, e))
+
     if args.copy_env:
         env_keys = args.env.split(",")
         env = env.merge({k:v for k,v in os.environ.items() if k in env_keys})
@@ -172,16 +392,28 @@ def main():
     if not args.base_container:
         die("BASE_CONTAINER not defined. See [sudo] lxc-ls")
 
-    if not args.name:
-        args.name = args.base_container + "-" + datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-
     if not args.base_container in lxci.list_base_containers():
         die("Unknown base container {}".format(args.base_container))
 
-    if args.name in lxci.list_runtime_containers():
+    if args.build_cache and not args.tag:
+        die("--build-cache requires --tag")
+
+    if args.fill_pool:
+        lxci.fill_pool(
+            args.base_container, sudo=args.sudo, snapshot=args.snapshot, backingstore=args.backingstore
+        )
+        return
+
+    # Pool containers keep their own name unless a custom one is given
+    custom_name = args.name
+
+    if not args.name:
+        args.name = args.base_container + "-" + datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+
+    if lxci.list_runtime_containers(name=args.name):
         die("Container name {} already exists in the runtime".format(args.name))
 
-    if args.name in lxci.list_archived_containers():
+    if lxci.list_archived_containers(name=args.name):
         die("Container name {} already exists in the archive".format(args.name))
 
     if args.tag:
@@ -189,12 +421,30 @@ def main():
             error_message("Found a runtime container with the same tag: {}. Destroying it.".format(c.get_name()))
             c.destroy()
 
-    runtime_container = lxci.create_runtime_container(
-        args.base_container, args.name, snapshot=args.snapshot, backingstore=args.backingstore
-    )
+    runtime_container = None
+    if args.pool:
+        runtime_container = lxci.take_pool_container(args.base_container, name=custom_name, sudo=args.sudo)
+        if not runtime_container:
+            verbose_message("No ready containers in the pool. Cloning a new one")
+        refill_pool(args)
+
+    tags = (args.tag or "default").split(",")
+    if not runtime_container and (args.cache or args.checkpoint):
+        runtime_container = lxci.create_cached_runtime_container(
+            args.base_container, args.name, sudo=args.sudo, backingstore=args.backingstore, tags=tags,
+            checkpoint=args.checkpoint
+        )
+
+    if not runtime_container:
+        runtime_container = lxci.create_runtime_container(
+            args.base_container, args.name, snapshot=args.snapshot, backingstore=args.backingstore, tags=tags
+        )
+        if args.sudo:
+            runtime_container.enable_sudo()
+
     runtime_container.add_meta({
-        "command": args.command,
-        "tags": (args.tag or "default").split(","),
+        "command": None if steps else args.command,
+        "tags": tags,
     })
 
     did_fail = False
@@ -206,6 +456,9 @@ def main():
             runtime_container.archive()
         else:
             runtime_container.destroy()
+        lxci.append_history(runtime_container)
+        if config.GC_AFTER_BUILD:
+            start_gc()
         if did_fail:
             print("Command failed in the container with exit status {status}".format(status=cmd.returncode))
             if archive:
@@ -219,24 +472,72 @@ def main():
 
 
     if args.workspace_source_dir:
-        runtime_container.sync_workspace(args.workspace_source_dir)
+        sync_mode = args.sync_mode or config.SYNC_MODE
+        if sync_mode == "mount" and not runtime_container.is_stopped():
+            verbose_message("Cannot mount the workspace to a booted pool container. Using rsync")
+            sync_mode = "rsync"
+        if sync_mode == "mount" and not lxci.has_overlay_metacopy():
+            error_message("The overlayfs of the kernel does not support metacopy. Using rsync instead of copying the whole workspace up")
+            sync_mode = "rsync"
+
+        if sync_mode == "mount":
+            runtime_container.mount_workspace(args.workspace_source_dir)
+        elif sync_mode == "rsync":
+            runtime_container.sync_workspace(args.workspace_source_dir)
+        else:
+            die("Expected sync MODE to be rsync or mount")
 
-    if args.sudo:
-        runtime_container.enable_sudo()
+    runtime_container.set_resource_limits(
+        memory=args.memory_limit or config.MEMORY_LIMIT,
+        cpu_shares=args.cpu_shares or config.CPU_SHARES,
+        blkio_weight=args.blkio_weight or config.BLKIO_WEIGHT,
+    )
+
+    package_cache = None
+    if args.package_cache or config.PACKAGE_CACHE:
+        if runtime_container.is_stopped():
+            package_cache = lxci.PackageCache(runtime_container)
+            package_cache.mount()
+        else:
+            verbose_message("Cannot mount the package cache to a booted pool container")
 
-    runtime_container.start()
+    build_cache = None
+    if args.build_cache:
+        if runtime_container.is_stopped():
+            build_cache = lxci.BuildCache(runtime_container, args.tag)
+            build_cache.mount()
+        else:
+            verbose_message("Cannot mount the build cache to a booted pool container")
+
+    runtime_container.start(checkpoint_path=lxci.get_checkpoint_path(runtime_container))
     atexit.register(on_exit)
     runtime_container.add_meta({ "started": datetime.datetime.now().isoformat() })
-    cmd = runtime_container.run_command(args.command)
+    if steps:
+        cmd = runtime_container.run_steps(steps, fail_fast=args.fail_fast)
+    else:
+        cmd = runtime_container.run_command(args.command)
     did_fail = cmd.returncode != 0
+    # The cgroup counters are gone once the container stops
+    if not runtime_container.is_stopped():
+        runtime_container.collect_resource_usage()
     runtime_container.stop()
+    if package_cache:
+        package_cache.collect()
+    if build_cache:
+        build_cache.collect(publish=not did_fail)
+    # Learn the size for placing the next containers to the runtime tiers
+    if len(lxci.runtime_config_paths()) > 1:
+        runtime_container.record_size()
     runtime_container.add_meta({
         "stopped": datetime.datetime.now().isoformat(),
         "exit_code": cmd.returncode,
     })
+    runtime_container.flush_meta()
 
     if not did_fail and runtime_container.has_results_files():
-        runtime_container.copy_results()
+        # The container is destroyed unless it is archived so the results
+        # can be moved out of it
+        runtime_container.copy_results(args.results_format, move=not args.archive)
 
     if not did_fail and args.success_command:
         subprocess.check_call(["sh", "-c", args.success_command])
@@ -1 +1,24 @@
-from lxci._lxci import *
+import importlib
+import sys
+
+from lxci import config
+
+# The public names of these submodules are available as lxci.NAME. The
+# submodules are imported on the first access so that light commands like
+# --version do not load the container code
+_SUBMODULES = (
+    "_messages", "_lxci", "_pool", "_batch", "_bulk", "_cache", "_stats", "_daemon",
+    "_retention", "_pkgcache", "_buildcache", "_export",
+)
+
+def __getattr__(name):
+    if not name.startswith("_"):
+        # Look in the already imported submodules first so that the heavier
+        # ones are not imported in vain
+        loaded = [s for s in _SUBMODULES if __name__ + "." + s in sys.modules]
+        for submodule in loaded + [s for s in _SUBMODULES if s not in loaded]:
+            module = importlib.import_module(__name__ + "." + submodule)
+            if name in vars(module):
+                globals()[name] = vars(module)[name]
+                return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,222 @@
+import datetime
+import itertools
+import json
+import subprocess
+import sys
+import threading
+import time
+
+from lxci._lxci import RuntimeContainerError, error_message
+
+# Manifest job keys and the matching lxci options
+_VALUE_OPTIONS = {
+    "command": "--command",
+    "success_command": "--success-command",
+    "name": "--name",
+    "tag": "--tag",
+    "sync": "--sync",
+    "sync_mode": "--sync-mode",
+    "backingstore": "--backingstore",
+    "exec_backend": "--exec-backend",
+    "results_format": "--results-format",
+    "memory_limit": "--memory-limit",
+    "cpu_shares": "--cpu-shares",
+    "blkio_weight": "--blkio-weight",
+    "steps_file": "--steps-file",
+}
+_FLAG_OPTIONS = {
+    "archive": "--archive",
+    "archive_on_fail": "--archive-on-fail",
+    "destroy_on_ok": "--destroy-archive-on-success",
+    "sudo": "--sudo",
+    "snapshot": "--snapshot",
+    "pool": "--pool",
+    "cache": "--cache",
+    "checkpoint": "--checkpoint",
+    "fail_fast": "--fail-fast",
+    "package_cache": "--package-cache",
+    "build_cache": "--build-cache",
+}
+_KNOWN_KEYS = set(_VALUE_OPTIONS) | set(_FLAG_OPTIONS) | {"base", "env", "steps"}
+
+
+def load_manifest(path):
+    """
+    Load jobs from a JSON manifest file. The manifest is an object with
+    optional "defaults", "matrix" and "jobs" keys:
+
+        {
+            "defaults": {"command": "sh ci.sh", "sync": ".", "tag": "myproject-{base}"},
+            "matrix": {"base": ["trusty-amd64", "trusty-i386"]},
+            "jobs": [{"base": "xenial-amd64", "env": {"FOO": "bar"}}]
+        }
+
+    Every combination of the matrix values and every entry in jobs becomes a
+    job on top of the defaults. {key} placeholders in name and tag are
+    replaced with the job values.
+
+    returns list of job dicts
+    """
+    with open(path, "r") as f:
+        try:
+            manifest = json.load(f)
+        except ValueError as e:
+            raise RuntimeContainerError("Invalid manifest {}: {}".format(path, e))
+
+    defaults = manifest.get("defaults", {})
+    jobs = []
+
+    matrix = manifest.get("matrix", {})
+    if matrix:
+        keys = sorted(matrix)
+        for values in itertools.product(*(matrix[k] for k in keys)):
+            job = dict(defaults)
+            job.update(zip(keys, values))
+            jobs.append(job)
+
+    for job_overrides in manifest.get("jobs", []):
+        job = dict(defaults)
+        job.update(job_overrides)
+        jobs.append(job)
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    for i, job in enumerate(jobs):
+        unknown = set(job) - _KNOWN_KEYS
+        if unknown:
+            raise RuntimeContainerError("Unknown keys in manifest job {}: {}".format(i, ", ".join(sorted(unknown))))
+        if not job.get("base"):
+            raise RuntimeContainerError("Manifest job {} has no base".format(i))
+        # The default lxci names are not unique when started at the same time
+        job.setdefault("name", "{base}-" + timestamp + "-" + str(i))
+        for key in ("name", "tag"):
+            if job.get(key):
+                try:
+                    job[key] = job[key].format(**job)
+                except (KeyError, ValueError, IndexError) as e:
+                    raise RuntimeContainerError("Invalid placeholder in manifest job {} {}: {}".format(i, key, e))
+
+    return jobs
+
+
+def job_to_args(job):
+    """
+    Convert manifest job to lxci command line arguments
+    """
+    args = [job["base"]]
+    for key, option in sorted(_VALUE_OPTIONS.items()):
+        if job.get(key):
+            args += [option, str(job[key])]
+    for key, option in sorted(_FLAG_OPTIONS.items()):
+        if job.get(key):
+            args.append(option)
+    for step in job.get("steps", []):
+        args.append("--step=" + step)
+    env = job.get("env")
+    if env:
+        args += ["--set-env"] + ["{}={}".format(k, v) for k, v in sorted(env.items())]
+    return args
+
+
+def _job_tags(job):
+    # lxci destroys the runtime containers with the same tag only when the
+    # tag is explicitly set
+    return set(job["tag"].split(",")) if job.get("tag") else set()
+
+
+def run_batch(jobs, lxci_command, parallel=4):
+    """
+    Run the jobs as lxci processes with at most parallel jobs at the time.
+    Output lines of each job are prefixed with the job name. Jobs sharing a
+    tag are never run at the same time since lxci destroys runtime
+    containers with the same tag.
+
+    returns list of result dicts in the order of jobs
+    """
+    results = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    running_tags = set()
+    lock = threading.Condition()
+    output_lock = threading.Lock()
+
+    def next_job():
+        for i in pending:
+            if not (_job_tags(jobs[i]) & running_tags):
+                return i
+
+    def run_job(job):
+        prefix = "[{}] ".format(job["name"]).encode()
+        started = time.time()
+        process = subprocess.Popen(
+            lxci_command + job_to_args(job),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+        for line in process.stdout:
+            with output_lock:
+                sys.stdout.buffer.write(prefix + line)
+                sys.stdout.buffer.flush()
+        process.wait()
+        return {
+            "name": job["name"],
+            "base": job["base"],
+            "exit_code": process.returncode,
+            "duration": time.time() - started,
+        }
+
+    def worker():
+        while True:
+            with lock:
+                while True:
+                    if not pending:
+                        return
+                    i = next_job()
+                    if i is not None:
+                        break
+                    lock.wait()
+                pending.remove(i)
+                tags = _job_tags(jobs[i])
+                running_tags.update(tags)
+
+            try:
+                results[i] = run_job(jobs[i])
+            except OSError as e:
+                error_message("Failed to start job {}: {}".format(jobs[i]["name"], e))
+                results[i] = {
+                    "name": jobs[i]["name"],
+                    "base": jobs[i]["base"],
+                    "exit_code": 127,
+                    "duration": 0,
+                }
+            finally:
+                with lock:
+                    running_tags.difference_update(tags)
+                    lock.notify_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(parallel, len(jobs))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def print_batch_results(results, file=sys.stderr):
+    """
+    Print exit status and duration of each job
+    """
+    name_width = max([len("NAME")] + [len(r["name"]) for r in results])
+    base_width = max([len("BASE")] + [len(r["base"]) for r in results])
+    row = "{name:<{nw}}  {base:<{bw}}  {exit_code:>4}  {duration:>9}"
+    print(row.format(name="NAME", base="BASE", exit_code="EXIT", duration="TIME", nw=name_width, bw=base_width), file=file)
+    for r in results:
+        print(row.format(
+            name=r["name"],
+            base=r["base"],
+            exit_code=r["exit_code"],
+            duration="{:.1f}s".format(r["duration"]),
+            nw=name_width,
+            bw=base_width
+        ), file=file)
+    file.flush()
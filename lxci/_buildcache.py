@@ -0,0 +1,259 @@
+import os
+import stat
+import subprocess
+import uuid
+
+from lxci import config
+from lxci._lxci import (
+    LXCI_UID,
+    RuntimeContainerError,
+    assert_ret,
+    container_exec,
+    file_lock,
+    list_runtime_containers,
+    timer_print,
+    verbose_message,
+)
+from lxci._pkgcache import list_files, remove_paths, select_evicted
+
+# Container path of the build cache
+BUILD_CACHE_MOUNT_PATH = "/home/lxci/cache"
+
+
+def get_build_cache_path(tag):
+    return os.path.join(config.BUILD_CACHE_PATH, tag.replace("/", "_"))
+
+def get_build_cache_env(size, read_only=False):
+    """
+    returns dict of the environment variables pointing the compiler caches
+    to the build cache and limiting them to size megabytes
+    """
+    env = {
+        "LXCI_BUILD_CACHE": BUILD_CACHE_MOUNT_PATH,
+        "CCACHE_DIR": BUILD_CACHE_MOUNT_PATH + "/ccache",
+        "SCCACHE_DIR": BUILD_CACHE_MOUNT_PATH + "/sccache",
+    }
+    if size:
+        env["CCACHE_MAXSIZE"] = env["SCCACHE_CACHE_SIZE"] = "{}M".format(size)
+    if read_only:
+        env["CCACHE_READONLY"] = "1"
+        env["SCCACHE_LOCAL_RW_MODE"] = "READ_ONLY"
+    return env
+
+def has_overlayfs():
+    """
+    returns True if the kernel supports overlayfs
+    """
+    try:
+        with open("/proc/filesystems", "r") as f:
+            return any(line.split()[-1] == "overlay" for line in f if line.strip())
+    except OSError:
+        return False
+
+def _is_whiteout(st):
+    # overlayfs marks the deleted files with 0:0 character devices
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+def _is_opaque(path):
+    # The lower directory is hidden under an opaque upper directory
+    try:
+        return os.getxattr(path, "trusted.overlay.opaque", follow_symlinks=False) == b"y"
+    except OSError:
+        return False
+
+
+class BuildCache():
+    """
+    Persistent cache directory of the builds with the same tag mounted to
+    /home/lxci/cache.
+
+    The cache is kept as generations. current is a symlink to the newest one.
+    Builds running at the same time never see each other's half-written
+    files, since each build gets its own view of the current generation:
+
+    - overlay: a writable overlayfs layer on top of the generation. Nothing
+      is copied up front. On success the new generation is made by
+      hardlinking the old one and applying the layer on top. Needs a
+      privileged container like --sync-mode mount.
+    - reflink: a cp --reflink=always copy of the generation, which is
+      copy-on-write on btrfs and xfs.
+    - read-only: the generation itself mounted read-only, when neither of the
+      above works. Nothing is saved from the build.
+    - new: an empty directory when there is no generation yet.
+
+    When the build succeeds its copy becomes the new generation by swapping
+    the current symlink. The cache is modified only with container_exec() so
+    that its files are owned by the lxci user of unprivileged containers too.
+    """
+    def __init__(self, runtime_container, tag):
+        self.runtime_container = runtime_container
+        self.tag = tag
+        self.path = get_build_cache_path(tag)
+        self.current_path = os.path.join(self.path, "current")
+        # Unique so that a rerun with the same --name never touches the
+        # generation the current symlink points to
+        self.job_path = os.path.join(self.path, "{}-{}".format(runtime_container.get_name(), uuid.uuid4().hex))
+        # Upper and work directories of the overlay
+        self.overlay_path = self.job_path + ".overlay"
+        # Symlink to the generation the build uses so that it is not removed
+        # before the build ends
+        self.lower_link = self.job_path + ".lower"
+        self.generation = None
+        self.mode = None
+
+    def _lock(self):
+        return file_lock(os.path.join(config.STATE_PATH, "build-cache-{}.lock".format(os.path.basename(self.path))))
+
+    def _get_lower_path(self):
+        return os.path.join(self.path, self.generation)
+
+    def mount(self):
+        """
+        Give the container its own view of the current generation and bind
+        mount it. The container must be stopped
+        """
+        container = self.runtime_container.container
+        if container.state != "STOPPED":
+            raise RuntimeContainerError("Can mount the build cache only to stopped containers")
+
+        with timer_print("Mounting the build cache of {}".format(self.tag)) as t:
+            os.makedirs(self.path, exist_ok=True)
+            with self._lock():
+                if os.path.isdir(self.current_path):
+                    self.generation = os.readlink(self.current_path)
+                    self.mode = self._mount_generation()
+                else:
+                    self.mode = "new"
+                    container_exec(["mkdir", self.job_path])
+                    container_exec(["chown", "{uid}:{uid}".format(uid=LXCI_UID), self.job_path])
+                    self._add_mount_entry("{} {{target}} none bind,create=dir,optional 0 0".format(self.job_path))
+
+            assert_ret(container.save_config(), "Failed to save the container config")
+            self.runtime_container.write_env(get_build_cache_env(config.BUILD_CACHE_SIZE, read_only=self.mode == "read-only"))
+        verbose_message("Build cache mode: {}".format(self.mode))
+        self.runtime_container.record_timing("build_cache", t.took)
+
+    def _mount_generation(self):
+        # The cache lock must be held. returns the mode
+        lower = self._get_lower_path()
+        if not self.runtime_container.is_unprivileged() and has_overlayfs():
+            os.symlink(self.generation, self.lower_link)
+            upper = os.path.join(self.overlay_path, "upper")
+            work = os.path.join(self.overlay_path, "work")
+            container_exec(["mkdir", "-p", upper, work])
+            # The root of the overlay gets the owner and mode of the upper
+            # directory
+            container_exec(["chown", "--reference=" + lower, upper])
+            container_exec(["chmod", "--reference=" + lower, upper])
+            # redirect_dir and metacopy would leave files in the lower
+            # directory which the upper one refers to
+            self._add_mount_entry(
+                "overlay {{target}} overlay lowerdir={},upperdir={},workdir={},redirect_dir=off,metacopy=off,create=dir 0 0".format(
+                    lower, upper, work
+                )
+            )
+            return "overlay"
+
+        try:
+            container_exec(["cp", "-a", "--reflink=always", lower, self.job_path])
+        except subprocess.CalledProcessError:
+            # A full copy would cost more than the cache saves
+            remove_paths([self.job_path])
+            os.symlink(self.generation, self.lower_link)
+            self._add_mount_entry("{} {{target}} none bind,ro,create=dir,optional 0 0".format(lower))
+            return "read-only"
+        self._add_mount_entry("{} {{target}} none bind,create=dir,optional 0 0".format(self.job_path))
+        return "reflink"
+
+    def _add_mount_entry(self, entry):
+        assert_ret(
+            self.runtime_container.container.set_config_item(
+                "lxc.mount.entry", entry.format(target=BUILD_CACHE_MOUNT_PATH.lstrip("/"))
+            ),
+            "Failed to add the build cache mount"
+        )
+
+    def _apply_overlay(self):
+        # Make the new generation from hardlinks to the lower generation and
+        # the upper layer. cp --remove-destination replaces the links instead
+        # of writing through them to the files of the lower generation
+        upper = os.path.join(self.overlay_path, "upper")
+        container_exec(["cp", "-al", self._get_lower_path(), self.job_path])
+        removed = []
+        for dirpath, dirnames, filenames in os.walk(upper):
+            rel = os.path.relpath(dirpath, upper)
+            for name in dirnames + filenames:
+                src = os.path.join(dirpath, name)
+                dest = os.path.normpath(os.path.join(self.job_path, rel, name))
+                if _is_whiteout(os.lstat(src)):
+                    removed += [src, dest]
+                elif name in dirnames and _is_opaque(src):
+                    removed.append(dest)
+        remove_paths(removed)
+        container_exec(["cp", "-a", "--remove-destination", upper + "/.", self.job_path])
+
+    def collect(self, publish=True):
+        """
+        Make the copy or the overlay of the container the current generation
+        and evict the least recently used files over BUILD_CACHE_SIZE from it.
+        Without publish or in the read-only mode nothing is saved. Old
+        generations and the copies of crashed builds are removed
+        """
+        publish = publish and self.mode != "read-only"
+        with timer_print("Saving the build cache of {}".format(self.tag)):
+            evicted = []
+            size = 0
+            if publish:
+                if self.mode == "overlay":
+                    self._apply_overlay()
+                files = list_files(self.job_path)
+                if config.BUILD_CACHE_SIZE:
+                    evicted = select_evicted(files, config.BUILD_CACHE_SIZE)
+                    if evicted:
+                        verbose_message("Evicting {} files from the build cache of {}".format(len(evicted), self.tag))
+                        remove_paths(evicted)
+                evicted_paths = set(evicted)
+                size = sum(st.st_size for path, st in files if path not in evicted_paths)
+
+            with self._lock():
+                if publish:
+                    tmp_link = self.current_path + ".tmp"
+                    if os.path.lexists(tmp_link):
+                        os.remove(tmp_link)
+                    os.symlink(os.path.basename(self.job_path), tmp_link)
+                    # rename(2) swaps the symlink atomically
+                    os.replace(tmp_link, self.current_path)
+                else:
+                    remove_paths([self.job_path])
+                remove_paths([self.overlay_path, self.lower_link])
+                self._remove_unused()
+
+        self.runtime_container.add_meta({"build_cache": {
+            "tag": self.tag,
+            "mode": self.mode,
+            "generation": self.generation,
+            "published": publish,
+            "size": size,
+            "evicted": len(evicted),
+        }})
+
+    def _remove_unused(self):
+        # Everything but the current generation and the copies, overlays and
+        # lower generations of the other running builds. Called only after
+        # the new generation is published. The cache lock must be held
+        running = set(list_runtime_containers()) - {self.runtime_container.get_name()}
+        names = os.listdir(self.path)
+        keep = {"current"}
+        if os.path.lexists(self.current_path):
+            keep.add(os.readlink(self.current_path))
+        for n in names:
+            job = n
+            for suffix in (".overlay", ".lower"):
+                if n.endswith(suffix):
+                    job = n[:-len(suffix)]
+            if job.rsplit("-", 1)[0] not in running:
+                continue
+            keep.add(n)
+            if n.endswith(".lower"):
+                keep.add(os.readlink(os.path.join(self.path, n)))
+        remove_paths([os.path.join(self.path, n) for n in names if n not in keep and not n.endswith(".tmp")])
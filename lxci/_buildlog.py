@@ -0,0 +1,96 @@
+import datetime
+import gzip
+import os
+
+
+def _timestamp():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3].encode()
+
+
+class build_log():
+    """
+    Write command output to path with a timestamp at the start of each line.
+
+    The log is kept under max_size bytes (uncompressed, 0 for no limit) like a
+    ring buffer of two segments: when the current segment grows over half of
+    max_size it is moved to path.1 replacing the older one. With compress the
+    segments are gzipped and .gz is appended to their names.
+    """
+    def __init__(self, path, compress=False, max_size=0, owner=None):
+        if compress:
+            path += ".gz"
+        self.path = path
+        self.compress = compress
+        self.max_size = max_size
+        self.owner = owner
+        self.file = None
+        self.size = 0
+        self.at_line_start = True
+
+    def _open(self):
+        if self.compress:
+            self.file = gzip.open(self.path, "ab")
+        else:
+            self.file = open(self.path, "ab", buffering=0)
+        if self.owner:
+            os.chown(self.path, self.owner[0], self.owner[1])
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            # gzip members do not tell the uncompressed size cheaply so
+            # compressed logs start counting from zero
+            self.size = 0 if self.compress else os.path.getsize(self.path)
+        except FileNotFoundError:
+            self.size = 0
+        self._open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _rotate(self):
+        self.close()
+        os.replace(self.path, self.segment_path())
+        self.size = 0
+        self._open()
+
+    def segment_path(self):
+        """
+        Path of the older segment
+        """
+        if self.compress:
+            return self.path[:-len(".gz")] + ".1.gz"
+        return self.path + ".1"
+
+    def write_line(self, line):
+        """
+        Write a complete line of lxci's own, for example the command
+        """
+        if not self.at_line_start:
+            self.write(b"\n")
+        self.write(line.encode() + b"\n")
+
+    def write(self, data):
+        """
+        Write output bytes. Each line gets the time when its first byte was
+        written
+        """
+        timestamp = _timestamp() + b" "
+        out = []
+        for line in data.splitlines(True):
+            if self.at_line_start:
+                out.append(timestamp)
+            out.append(line)
+            self.at_line_start = line.endswith(b"\n")
+        out = b"".join(out)
+
+        if self.max_size and self.size + len(out) > self.max_size // 2 and self.size > 0:
+            self._rotate()
+        self.file.write(out)
+        self.size += len(out)
@@ -0,0 +1,57 @@
+import concurrent.futures
+
+from lxci import config
+from lxci._lxci import RuntimeContainer, error_message, verbose_message
+
+def _init_worker():
+    # Progress is reported by the parent. Interleaved timer messages from the
+    # workers would be just noise
+    config.VERBOSE = False
+
+def _stop(name, config_path):
+    import lxc
+    RuntimeContainer(lxc.Container(name, config_path=config_path)).stop()
+
+def _destroy(name, config_path):
+    import lxc
+    RuntimeContainer(lxc.Container(name, config_path=config_path)).destroy()
+
+BULK_ACTIONS = {
+    "stop": (_stop, "Stopped"),
+    "destroy": (_destroy, "Destroyed"),
+}
+
+def run_bulk(action, containers, jobs=None):
+    """
+    Stop or destroy the containers in at most jobs worker processes. Failures
+    do not stop the other containers from being processed. Progress is
+    reported as the containers complete.
+
+    returns dict of container names and error messages of the failed ones
+    """
+    func, done_message = BULK_ACTIONS[action]
+    failed = {}
+    if not containers:
+        return failed
+
+    total = len(containers)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or config.JOBS, initializer=_init_worker) as executor:
+        futures = dict(
+            (executor.submit(func, c.get_name(), c.get_config_path()), c.get_name())
+            for c in containers
+        )
+        for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            name = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed[name] = str(e) or e.__class__.__name__
+                error_message("[{i}/{total}] Failed to {action} {name}: {error}".format(
+                    i=i, total=total, action=action, name=name, error=failed[name]
+                ))
+            else:
+                verbose_message("[{i}/{total}] {done} {name}".format(
+                    i=i, total=total, done=done_message, name=name
+                ))
+
+    return failed
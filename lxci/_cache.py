@@ -0,0 +1,257 @@
+import datetime
+import hashlib
+import json
+import os
+
+from lxci import config
+from lxci._lxci import (
+    LXCI_USER_PREPARE_COMMANDS,
+    SUDO_PREPARE_COMMANDS,
+    RuntimeContainer,
+    RuntimeContainerError,
+    assert_ret,
+    choose_runtime_config_path,
+    container_exec,
+    create_runtime_container,
+    ensure_ssh_key,
+    error_message,
+    file_lock,
+    list_archived_containers,
+    list_cache_containers,
+    list_runtime_containers,
+    timer_print,
+    verbose_message,
+)
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def get_base_fingerprint(base_container_name):
+    """
+    Modification times of the base container which change when it is
+    modified or its packages are upgraded
+    """
+    import lxc
+    base_container = lxc.Container(base_container_name, config_path=config.BASE_CONFIG_PATH)
+    rootfs = base_container.get_config_item("lxc.rootfs")
+    # Strip the backingstore prefix like dir:
+    rootfs = rootfs.rsplit(":", 1)[-1]
+    return [
+        _mtime(base_container.config_file_name),
+        _mtime(rootfs),
+        _mtime(os.path.join(rootfs, "etc")),
+        _mtime(os.path.join(rootfs, "var/lib/dpkg/status")),
+    ]
+
+def get_cache_key(base_container_name, sudo=False, checkpoint=False):
+    """
+    Key of the prepared base container. It changes when the base container,
+    the prepare commands or the SSH key changes
+    """
+    commands = list(LXCI_USER_PREPARE_COMMANDS)
+    if sudo:
+        commands += SUDO_PREPARE_COMMANDS
+    ensure_ssh_key()
+    with open(config.SSH_PUB_KEY_PATH, "r") as f:
+        pub_key = f.read()
+
+    data = json.dumps([
+        base_container_name,
+        get_base_fingerprint(base_container_name),
+        commands,
+        pub_key,
+        sudo,
+    ] + (["checkpoint"] if checkpoint else []))
+    return hashlib.sha256(data.encode()).hexdigest()[:12]
+
+def _cache_lock_path(base_container_name):
+    return os.path.join(config.STATE_PATH, "cache-{}.lock".format(base_container_name))
+
+# Last use time is kept on the host since the rootfs of the cached container
+# must not change while it is the lower layer of snapshots
+def _used_stamp_path(name):
+    return os.path.join(config.STATE_PATH, "cache-used", name)
+
+def _mark_used(name):
+    path = _used_stamp_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a"):
+        os.utime(path)
+
+def get_last_used(name):
+    return _mtime(_used_stamp_path(name)) or 0
+
+def is_cache_container_in_use(name):
+    """
+    Return True if runtime or archived containers are snapshots of the cached
+    container
+    """
+    for containers in (list_runtime_containers, list_archived_containers):
+        for c in containers(return_object=True):
+            if c.read_meta().get("cache_container") == name:
+                return True
+    return False
+
+def get_checkpoint_path(runtime_container):
+    """
+    returns path of the checkpoint of the cached container the runtime
+    container was cloned from or None
+    """
+    name = runtime_container.read_meta().get("cache_container")
+    if not name:
+        return None
+    path = os.path.join(config.CACHE_CONFIG_PATH, name, "checkpoint")
+    if not os.path.isdir(path):
+        return None
+    return path
+
+def _checkpoint(cache_container):
+    path = os.path.join(config.CACHE_CONFIG_PATH, cache_container.get_name(), "checkpoint")
+    try:
+        cache_container.checkpoint(path)
+    except RuntimeContainerError as e:
+        # The builds boot the containers instead
+        error_message("{}. Booting the containers instead".format(e))
+        if cache_container.container.state != "STOPPED":
+            cache_container.stop()
+        container_exec(["rm", "-rf", path])
+
+def _get_cache_container(base_container_name, sudo, checkpoint=False):
+    # Must be called with the cache lock of the base container held.
+    # Returns the container and the seconds it took to create it or None
+    key = get_cache_key(base_container_name, sudo=sudo, checkpoint=checkpoint)
+    name = "{base}-cache-{key}".format(base=base_container_name, key=key)
+
+    for c in list_cache_containers(return_object=True, name=name):
+        if c.read_meta().get("cache") == "ready":
+            _mark_used(name)
+            return c, None
+        # Left behind by a failed build
+        c.destroy()
+
+    with timer_print("Creating cached base container {}".format(name)) as build_timer:
+        cache_container = create_runtime_container(
+            base_container_name, name, config_path=config.CACHE_CONFIG_PATH
+        )
+        cache_container.add_meta({"cache": "building", "sudo": sudo, "checkpoint": checkpoint, "key": key})
+        cache_container.flush_meta()
+        try:
+            if sudo:
+                cache_container.enable_sudo()
+            cache_container.prepare()
+            # Booted only for the checkpoint before any snapshots are taken
+            # since the snapshots share the rootfs
+            if checkpoint:
+                _checkpoint(cache_container)
+        except Exception:
+            cache_container.destroy()
+            raise
+        cache_container.add_meta({"cache": "ready"})
+        cache_container.flush_meta()
+        _mark_used(name)
+
+    return cache_container, build_timer.took
+
+def evict_cache_containers(size=None):
+    """
+    Destroy cached base containers for which the base container has changed
+    and the least recently used ones over size. Containers which have
+    snapshots are kept.
+
+    returns list of destroyed container names
+    """
+    if size is None:
+        size = config.CACHE_SIZE
+
+    current_keys = {}
+    def is_stale(meta):
+        args = (meta.get("base"), meta.get("sudo", False), meta.get("checkpoint", False))
+        if args not in current_keys:
+            try:
+                current_keys[args] = get_cache_key(*args)
+            except (OSError, KeyError):
+                # The base container is gone
+                current_keys[args] = None
+        return current_keys[args] != meta.get("key")
+
+    cached = list_cache_containers(return_object=True)
+    last_used = dict((c.get_name(), get_last_used(c.get_name())) for c in cached)
+    cached.sort(key=lambda c: last_used[c.get_name()], reverse=True)
+
+    destroyed = []
+    for i, c in enumerate(cached):
+        name = c.get_name()
+        meta = c.read_meta()
+        if meta.get("cache") != "ready":
+            continue
+        if i < size and not is_stale(meta):
+            continue
+        # Checked again under the lock since create_cached_runtime_container()
+        # may have picked the container for a snapshot in the meantime
+        with file_lock(_cache_lock_path(meta.get("base"))):
+            current = list_cache_containers(return_object=True, name=name)
+            if not current:
+                continue
+            meta = current[0].read_meta()
+            if meta.get("cache") != "ready":
+                continue
+            # Used since the listing so it is not the least recently used
+            if not is_stale(meta) and get_last_used(name) != last_used[name]:
+                continue
+            if is_cache_container_in_use(name):
+                continue
+            verbose_message("Evicting cached base container {}".format(name))
+            current[0].destroy()
+            try:
+                os.remove(_used_stamp_path(name))
+            except FileNotFoundError:
+                pass
+        destroyed.append(name)
+
+    return destroyed
+
+def create_cached_runtime_container(base_container_name, runtime_container_name, sudo=False, backingstore=None, tags=None, checkpoint=False):
+    """
+    Clone the runtime container as a snapshot of a prepared copy of the base
+    container which has the lxci user, SSH key and sudo already set up. The
+    prepared copy is created when it does not exist or the base container has
+    changed. With checkpoint the prepared copy is booted once and
+    checkpointed so that the runtime container can be restored instead of
+    booted. See get_checkpoint_path().
+    """
+    import lxc
+    # The snapshot must be registered before anyone can evict the cached
+    # container
+    with file_lock(_cache_lock_path(base_container_name)):
+        cache_container, build_took = _get_cache_container(base_container_name, sudo, checkpoint)
+
+        tier = choose_runtime_config_path(base_container_name, tags, snapshot=True)
+        container = None
+        with timer_print("Cloning container '{runtime}' using '{base}'".format(runtime=runtime_container_name, base=cache_container.get_name())) as t:
+            container = cache_container.container.clone(
+                runtime_container_name,
+                config_path=tier,
+                flags=lxc.LXC_CLONE_SNAPSHOT,
+                bdevtype=backingstore or "overlayfs"
+            )
+            assert_ret(container, "Error while creating the runtime container")
+
+        runtime_container = RuntimeContainer(container, meta={})
+        runtime_container.write_meta({
+            "base": base_container_name,
+            "backingstore": runtime_container.get_backingstore(),
+            "cache_container": cache_container.get_name(),
+            "snapshot": True,
+            "tier": tier,
+            "created": datetime.datetime.now().isoformat(),
+        })
+        runtime_container.record_timing("clone", t.took)
+        if build_took is not None:
+            runtime_container.record_timing("cache_build", build_took)
+        runtime_container.flush_meta()
+
+    evict_cache_containers()
+    return runtime_container
@@ -0,0 +1,138 @@
+import os
+
+# Default and maximum of cgroup v1 cpu.shares and blkio.weight
+CPU_SHARES_DEFAULT = 1024
+CPU_SHARES_MAX = 262144
+BLKIO_WEIGHT_DEFAULT = 500
+# Default cpu.weight and io.weight of cgroup v2
+CGROUP2_WEIGHT_DEFAULT = 100
+CGROUP2_WEIGHT_MAX = 10000
+
+
+def is_cgroup2():
+    """
+    returns True if the host uses the unified cgroup v2 hierarchy
+    """
+    return os.path.exists("/sys/fs/cgroup/cgroup.controllers")
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+def get_limit_items(memory=None, cpu_shares=None, blkio_weight=None, cgroup2=None):
+    """
+    Translate the limits to cgroup item names and values. memory is a
+    byte count with an optional K, M or G suffix. cpu_shares and
+    blkio_weight are given as cgroup v1 values and converted to the cpu.weight
+    and io.weight of cgroup v2 like systemd does.
+
+    returns list of (item, value) tuples without the lxc.cgroup prefix
+    """
+    if cgroup2 is None:
+        cgroup2 = is_cgroup2()
+    items = []
+    if memory and str(memory) != "0":
+        items.append(("memory.max" if cgroup2 else "memory.limit_in_bytes", str(memory)))
+    if cpu_shares:
+        if cgroup2:
+            weight = cpu_shares * CGROUP2_WEIGHT_DEFAULT // CPU_SHARES_DEFAULT
+            items.append(("cpu.weight", str(_clamp(weight, 1, CGROUP2_WEIGHT_MAX))))
+        else:
+            items.append(("cpu.shares", str(_clamp(cpu_shares, 2, CPU_SHARES_MAX))))
+    if blkio_weight:
+        if cgroup2:
+            weight = blkio_weight * CGROUP2_WEIGHT_DEFAULT // BLKIO_WEIGHT_DEFAULT
+            items.append(("io.weight", str(_clamp(weight, 1, CGROUP2_WEIGHT_MAX))))
+        else:
+            items.append(("blkio.weight", str(_clamp(blkio_weight, 10, 1000))))
+    return items
+
+
+def _parse_flat_keyed(value):
+    # "key value" lines like in cpu.stat
+    result = {}
+    for line in value.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            result[parts[0]] = int(parts[1])
+    return result
+
+
+def _parse_io_stat(value):
+    # cgroup v2 io.stat: "8:0 rbytes=1 wbytes=2 rios=3 ..." per device
+    read = write = 0
+    for line in value.splitlines():
+        for field in line.split()[1:]:
+            key, _, count = field.partition("=")
+            if key == "rbytes":
+                read += int(count)
+            elif key == "wbytes":
+                write += int(count)
+    return read, write
+
+
+def _parse_blkio_service_bytes(value):
+    # cgroup v1 blkio.throttle.io_service_bytes: "8:0 Read 1" per device and
+    # operation and a "Total" line
+    read = write = 0
+    for line in value.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[1] == "Read":
+            read += int(parts[2])
+        elif len(parts) == 3 and parts[1] == "Write":
+            write += int(parts[2])
+    return read, write
+
+
+def read_resource_usage(get_item, cgroup2=None):
+    """
+    Read the CPU time, peak memory and block I/O counters of a container
+    with get_item(name) which returns the value of a cgroup item or raises
+    KeyError. The counters cover the life time of the container. Counters
+    not supported by the kernel are left out.
+
+    returns dict
+    """
+    if cgroup2 is None:
+        cgroup2 = is_cgroup2()
+
+    def read(name):
+        try:
+            return get_item(name)
+        except KeyError:
+            return None
+
+    usage = {}
+    if cgroup2:
+        cpu = read("cpu.stat")
+        if cpu:
+            stat = _parse_flat_keyed(cpu)
+            for key, name in (("usage_usec", "cpu_seconds"), ("user_usec", "cpu_user_seconds"), ("system_usec", "cpu_system_seconds")):
+                if key in stat:
+                    usage[name] = stat[key] / 1000000
+        # memory.peak is available since Linux 5.19
+        peak = read("memory.peak")
+        if peak:
+            usage["memory_peak_bytes"] = int(peak)
+        io = read("io.stat")
+        if io is not None:
+            usage["io_read_bytes"], usage["io_write_bytes"] = _parse_io_stat(io)
+    else:
+        cpu = read("cpuacct.usage")
+        if cpu:
+            usage["cpu_seconds"] = int(cpu) / 1000000000
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu = read("cpuacct.stat")
+        if cpu:
+            stat = _parse_flat_keyed(cpu)
+            for key, name in (("user", "cpu_user_seconds"), ("system", "cpu_system_seconds")):
+                if key in stat:
+                    usage[name] = stat[key] / ticks
+        peak = read("memory.max_usage_in_bytes")
+        if peak:
+            usage["memory_peak_bytes"] = int(peak)
+        io = read("blkio.throttle.io_service_bytes")
+        if io is not None:
+            usage["io_read_bytes"], usage["io_write_bytes"] = _parse_blkio_service_bytes(io)
+    return usage
@@ -0,0 +1,355 @@
+import base64
+import collections
+import grp
+import json
+import os
+import pwd
+import select
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from lxci import config
+from lxci._lxci import RuntimeContainerError, verbose_message
+
+# Jobs started less than this many seconds ago are not using all of their
+# memory and disk yet so they are reserved from the free resources
+SETTLE_TIME = 30
+
+# Seconds between the admission checks of the queued jobs
+POLL_INTERVAL = 1
+
+
+def get_available_memory():
+    """
+    returns MemAvailable of the host in megabytes
+    """
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) // 1024
+    raise RuntimeContainerError("MemAvailable missing from /proc/meminfo")
+
+def get_free_disk(path):
+    """
+    returns free space of the filesystem of path in megabytes
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize // (1024 * 1024)
+
+def get_load():
+    """
+    returns 1 minute load average per CPU
+    """
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+def get_job_tags(argv):
+    """
+    Get the --tag values from lxci arguments
+    """
+    tags = set()
+    for i, arg in enumerate(argv):
+        value = None
+        if arg in ("-t", "--tag") and i + 1 < len(argv):
+            value = argv[i + 1]
+        elif arg.startswith("--tag="):
+            value = arg.split("=", 1)[1]
+        elif arg.startswith("-t") and not arg.startswith("--"):
+            value = arg[2:]
+        if value:
+            tags.update(t for t in value.split(",") if t)
+    return tags
+
+
+class Job():
+    def __init__(self, argv, cwd, uid):
+        self.argv = argv
+        self.cwd = cwd
+        self.uid = uid
+        self.tags = get_job_tags(argv)
+        # Jobs with the same tags share a queue. Untagged jobs are queued per
+        # user so that one user cannot starve the others
+        if self.tags:
+            self.queue_key = "tag:" + ",".join(sorted(self.tags))
+        else:
+            self.queue_key = "uid:{}".format(uid)
+        self.state = "queued"
+        self.started = None
+
+
+class JobScheduler():
+    """
+    Admit queued jobs when the host has capacity for them.
+
+    Jobs sharing a tag are run one at a time. The queues are served round
+    robin so that a long queue of one tag does not starve the others. A job
+    is admitted when memory and disk for it and the jobs started within
+    SETTLE_TIME are free and the load is under max_load per CPU. At least one
+    job is always allowed to run.
+    """
+    def __init__(self, max_jobs=0, job_memory=0, job_disk=0, max_load=0, disk_path="/"):
+        self.max_jobs = max_jobs or os.cpu_count() or 1
+        self.job_memory = job_memory
+        self.job_disk = job_disk
+        self.max_load = max_load
+        self.disk_path = disk_path
+        self.lock = threading.Condition()
+        self.queues = collections.OrderedDict()
+        self.running = []
+
+    def submit(self, job):
+        with self.lock:
+            self.queues.setdefault(job.queue_key, collections.deque()).append(job)
+            self.lock.notify_all()
+
+    def cancel(self, job):
+        with self.lock:
+            queue = self.queues.get(job.queue_key)
+            if queue and job in queue:
+                queue.remove(job)
+                if not queue:
+                    del self.queues[job.queue_key]
+            job.state = "cancelled"
+            self.lock.notify_all()
+
+    def finish(self, job):
+        with self.lock:
+            if job in self.running:
+                self.running.remove(job)
+            job.state = "done"
+            self.lock.notify_all()
+
+    def get_position(self, job):
+        """
+        returns number of queued jobs in front of the job in all queues
+        """
+        with self.lock:
+            position = 0
+            for queue in self.queues.values():
+                for queued in queue:
+                    if queued is job:
+                        break
+                    position += 1
+            return position
+
+    def wait_for_turn(self, job, is_alive=lambda: True):
+        """
+        Block until the job is admitted. Returns False if is_alive returned
+        False before that and the job was cancelled
+        """
+        with self.lock:
+            while True:
+                self._schedule()
+                if job.state == "running":
+                    return True
+                if not is_alive():
+                    break
+                self.lock.wait(POLL_INTERVAL)
+        self.cancel(job)
+        return False
+
+    def _has_capacity(self):
+        if not self.running:
+            return True
+        if len(self.running) >= self.max_jobs:
+            return False
+
+        now = time.time()
+        starting = len([j for j in self.running if now - j.started < SETTLE_TIME])
+        if self.job_memory and get_available_memory() < self.job_memory * (starting + 1):
+            return False
+        if self.job_disk and get_free_disk(self.disk_path) < self.job_disk * (starting + 1):
+            return False
+        if self.max_load and get_load() >= self.max_load:
+            return False
+        return True
+
+    def _next_job(self):
+        running_tags = set()
+        for job in self.running:
+            running_tags.update(job.tags)
+        for queue in self.queues.values():
+            if not (queue[0].tags & running_tags):
+                return queue[0]
+        return None
+
+    def _schedule(self):
+        while True:
+            job = self._next_job()
+            if job is None or not self._has_capacity():
+                return
+
+            queue = self.queues.pop(job.queue_key)
+            queue.popleft()
+            # Put the queue last for the round robin
+            if queue:
+                self.queues[job.queue_key] = queue
+            job.state = "running"
+            job.started = time.time()
+            self.running.append(job)
+            verbose_message("Admitted job {} for uid {}".format(job.argv, job.uid))
+            self.lock.notify_all()
+
+
+def _get_peer_uid(sock):
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _pid, uid, _gid = struct.unpack("3i", creds)
+    return uid
+
+def _is_connected(sock):
+    readable, _, _ = select.select([sock], [], [], 0)
+    if not readable:
+        return True
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b""
+    except OSError:
+        return False
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """
+    Read a job request as a JSON line, wait for the scheduler to admit it and
+    stream the output and the exit code back as JSON lines
+    """
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        uid = _get_peer_uid(self.request)
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            job = Job(list(request["args"]), request.get("cwd", "/"), uid)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send({"error": "Invalid request: {}".format(e)})
+            return
+
+        scheduler = self.server.scheduler
+        scheduler.submit(job)
+        try:
+            position = scheduler.get_position(job)
+            if position:
+                self.send({"queued": position})
+            if not scheduler.wait_for_turn(job, lambda: _is_connected(self.request)):
+                return
+        except OSError:
+            scheduler.cancel(job)
+            return
+
+        try:
+            self.run_job(job)
+        finally:
+            scheduler.finish(job)
+
+    def run_job(self, job):
+        env = dict(os.environ)
+        env["LXCI_DAEMON_JOB"] = "1"
+        # lxci rejects the options reserved for root when the uid is not 0
+        env["LXCI_DAEMON_UID"] = str(job.uid)
+        for key in ("SUDO_UID", "SUDO_GID", "SUDO_USER"):
+            env.pop(key, None)
+        if job.uid != 0:
+            # Let lxci apply the same limits as for sudo users
+            user = pwd.getpwuid(job.uid)
+            env["SUDO_UID"] = str(job.uid)
+            env["SUDO_GID"] = str(user.pw_gid)
+            env["SUDO_USER"] = user.pw_name
+
+        try:
+            process = subprocess.Popen(
+                self.server.lxci_command + job.argv,
+                cwd=job.cwd,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+        except OSError as e:
+            self.send({"error": "Failed to start the job: {}".format(e)})
+            return
+
+        self.send({"started": True})
+        try:
+            for data in iter(lambda: os.read(process.stdout.fileno(), 65536), b""):
+                self.send({"output": base64.b64encode(data).decode()})
+        except OSError:
+            # The client went away. SIGINT lets lxci clean up its container
+            process.send_signal(signal.SIGINT)
+            process.wait()
+            return
+        finally:
+            process.stdout.close()
+
+        self.send({"exit_code": process.wait()})
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, lxci_command, scheduler):
+        self.lxci_command = lxci_command
+        self.scheduler = scheduler
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        socketserver.UnixStreamServer.__init__(self, socket_path, _JobHandler)
+
+        # Only root and members of DAEMON_GROUP may submit jobs
+        mode = 0o600
+        if config.DAEMON_GROUP:
+            os.chown(socket_path, -1, grp.getgrnam(config.DAEMON_GROUP).gr_gid)
+            mode = 0o660
+        os.chmod(socket_path, mode)
+
+
+def create_daemon(lxci_command, socket_path=None):
+    """
+    Create the lxcid job server using the DAEMON_* settings
+    """
+    scheduler = JobScheduler(
+        max_jobs=config.DAEMON_MAX_JOBS,
+        job_memory=config.DAEMON_JOB_MEMORY,
+        job_disk=config.DAEMON_JOB_DISK,
+        max_load=config.DAEMON_MAX_LOAD,
+        disk_path=config.RUNTIME_CONFIG_PATH,
+    )
+    return JobServer(socket_path or config.DAEMON_SOCKET, lxci_command, scheduler)
+
+
+def run_via_daemon(argv, socket_path=None):
+    """
+    Run lxci with argv in the lxcid daemon and stream its output to stdout.
+
+    returns the exit code of the job
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path or config.DAEMON_SOCKET)
+    except OSError:
+        sock.close()
+        raise
+
+    with sock, sock.makefile("rwb") as f:
+        f.write(json.dumps({"args": argv, "cwd": os.getcwd()}).encode() + b"\n")
+        f.flush()
+        for line in f:
+            message = json.loads(line.decode())
+            if "output" in message:
+                sys.stdout.buffer.write(base64.b64decode(message["output"]))
+                sys.stdout.buffer.flush()
+            elif "queued" in message:
+                verbose_message("Waiting for the lxcid to admit the job. {} jobs in front".format(message["queued"]))
+            elif "started" in message:
+                verbose_message("Job started by lxcid")
+            elif "exit_code" in message:
+                return message["exit_code"]
+            elif "error" in message:
+                raise RuntimeContainerError(message["error"])
+
+    raise RuntimeContainerError("Connection to lxcid was lost")
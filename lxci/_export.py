@@ -0,0 +1,235 @@
+import datetime
+import json
+import os
+import re
+
+from lxci import config
+from lxci._lxci import (
+    RuntimeContainer,
+    RuntimeContainerError,
+    _rewrite_config_paths,
+    container_exec,
+    create_runtime_container,
+    error_message,
+    list_archived_containers,
+    timer_print,
+    verbose_message,
+)
+from lxci._cache import get_base_fingerprint
+
+# Fields printed by find for each file: path relative to the start point,
+# type, size, modification time, mode, uid, gid and symlink target
+_FIND_FORMAT = "%P\\0%y\\0%s\\0%T@\\0%m\\0%U\\0%G\\0%l\\0"
+_FIND_FIELDS = 8
+
+# Keys of the container config which are specific to the host and are
+# taken from the fresh clone of the base on restore
+_HOST_CONFIG_KEYS = re.compile(r"^\s*lxc\.(rootfs|net\.\d+\.hwaddr|network\.hwaddr)\b")
+
+
+def get_export_path(name):
+    """
+    returns path of the rootfs diff tarball of the exported container
+    """
+    return os.path.join(config.EXPORT_PATH, name + ".tar.zst")
+
+def get_export_manifest_path(name):
+    return os.path.join(config.EXPORT_PATH, name + ".json")
+
+def list_exports():
+    """
+    returns sorted list of the names of the exported containers
+    """
+    try:
+        filenames = os.listdir(config.EXPORT_PATH)
+    except FileNotFoundError:
+        return []
+    return sorted(f[:-len(".json")] for f in filenames if f.endswith(".json"))
+
+def read_export_manifest(name):
+    with open(get_export_manifest_path(name), "r") as f:
+        return json.load(f)
+
+def scan_tree(path):
+    """
+    List the files under path with find as root of the containers so that
+    the rootfs of unprivileged containers can be read too
+
+    returns dict of relative path to a tuple of type, size, modification
+    time, mode, uid, gid and symlink target
+    """
+    output = container_exec(["find", path, "-printf", _FIND_FORMAT], output=True)
+    fields = output.decode("utf-8", "surrogateescape").split("\0")[:-1]
+    tree = {}
+    for i in range(0, len(fields), _FIND_FIELDS):
+        entry = fields[i:i + _FIND_FIELDS]
+        # The start point itself
+        if entry[0]:
+            tree[entry[0]] = tuple(entry[1:])
+    return tree
+
+def diff_trees(base_tree, tree):
+    """
+    Compare two scan_tree() results. Files are considered unchanged when
+    their type, size, modification time, mode, owner and symlink target are
+    the same like rsync does.
+
+    returns (changed, deleted) tuple of sorted lists of relative paths.
+    Only the topmost deleted directories are listed
+    """
+    changed = sorted(p for p, entry in tree.items() if base_tree.get(p) != entry)
+    deleted = []
+    for p in sorted(set(base_tree) - set(tree)):
+        if deleted and p.startswith(deleted[-1] + "/"):
+            continue
+        deleted.append(p)
+    return changed, deleted
+
+def _parse_rootfs(container):
+    # returns ("dir", rootfs) or ("overlayfs", lower, upper)
+    rootfs = container.get_config_item("lxc.rootfs")
+    if rootfs.startswith("overlayfs:"):
+        _, lower, upper = rootfs.split(":", 2)
+        return ("overlayfs", lower, upper)
+    return ("dir", rootfs.rsplit(":", 1)[-1])
+
+def _get_base_rootfs(base_container_name):
+    import lxc
+    base_container = lxc.Container(base_container_name, config_path=config.BASE_CONFIG_PATH)
+    return _parse_rootfs(base_container)[-1]
+
+def merge_container_config(exported, cloned):
+    """
+    Take the container config of an export but keep the rootfs and the MAC
+    address of the clone it is restored to
+
+    returns the config as a string
+    """
+    lines = [l for l in exported.splitlines() if not _HOST_CONFIG_KEYS.match(l)]
+    lines += [l for l in cloned.splitlines() if _HOST_CONFIG_KEYS.match(l)]
+    return "\n".join(lines) + "\n"
+
+def _write_tarball(rootfs, paths, dest_path):
+    container_exec([
+        "tar", "-c", "--no-recursion", "--numeric-owner", "--xattrs", "--xattrs-include=*",
+        "-I", "zstd -q -T0", "-C", rootfs, "-f", dest_path, "--null", "-T", "-",
+    ], input=b"".join(p.encode("utf-8", "surrogateescape") + b"\0" for p in paths))
+
+def export_container(name):
+    """
+    Replace the archived container with a zstd compressed tarball of its
+    changes to the base container and a manifest with the meta data, the
+    changed files and the deleted files. Directory backed containers are
+    compared with the base container file by file. The writable layer of
+    overlayfs snapshots of the base container is exported as is.
+
+    returns the manifest dict
+    """
+    import lxc
+    if name not in list_archived_containers():
+        raise RuntimeContainerError("Unknown archived container {}".format(name))
+    container = RuntimeContainer(lxc.Container(name, config_path=config.ARCHIVE_CONFIG_PATH))
+    if not container.is_stopped():
+        raise RuntimeContainerError("Cannot export the running container {}".format(name))
+
+    meta = container.read_meta()
+    base = meta.get("base")
+    if not base:
+        raise RuntimeContainerError("The base container of {} is unknown".format(name))
+    base_rootfs = _get_base_rootfs(base)
+    rootfs = _parse_rootfs(container.container)
+    container_dir = os.path.join(config.ARCHIVE_CONFIG_PATH, name)
+    with open(os.path.join(container_dir, "config"), "r") as f:
+        container_config = f.read()
+
+    with timer_print("Comparing {} to {}".format(name, base)):
+        if rootfs[0] == "dir":
+            tree = scan_tree(rootfs[1])
+            changed, deleted = diff_trees(scan_tree(base_rootfs), tree)
+            layer = rootfs[1]
+        elif os.path.realpath(rootfs[1]) == os.path.realpath(base_rootfs):
+            # Deletions are whiteouts in the writable layer
+            tree = scan_tree(rootfs[2])
+            changed, deleted = sorted(tree), []
+            layer = rootfs[2]
+        else:
+            raise RuntimeContainerError(
+                "Cannot export {}. It is a snapshot of {} instead of the base container {}".format(name, rootfs[1], base)
+            )
+
+    manifest = {
+        "name": name,
+        "base": base,
+        "base_fingerprint": get_base_fingerprint(base),
+        "rootfs": rootfs[0],
+        "exported": datetime.datetime.now().isoformat(),
+        "meta": meta,
+        # The cgroup limits, mounts and hooks of the container
+        "config": container_config,
+        "config_dir": container_dir,
+        "files": [{"path": p, "type": tree[p][0], "size": int(tree[p][1])} for p in changed],
+        "deleted": deleted,
+    }
+
+    os.makedirs(config.EXPORT_PATH, exist_ok=True)
+    tarball = get_export_path(name)
+    with timer_print("Exporting {} changed files of {}".format(len(changed), name)):
+        _write_tarball(layer, changed, tarball + ".tmp")
+        os.replace(tarball + ".tmp", tarball)
+    manifest["size"] = os.path.getsize(tarball)
+
+    manifest_path = get_export_manifest_path(name)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, sort_keys=True, indent=4)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    container.destroy()
+    return manifest
+
+def restore_export(name):
+    """
+    Recreate the archived container from the base container and the exported
+    changes. The container config of the export is restored on top of the
+    clone. The export is kept.
+
+    returns the archived RuntimeContainer
+    """
+    import lxc
+    if name in list_archived_containers():
+        raise RuntimeContainerError("Container {} is already in the archive".format(name))
+    manifest = read_export_manifest(name)
+    base = manifest["base"]
+    if get_base_fingerprint(base) != manifest["base_fingerprint"]:
+        error_message("The base container {} has changed since {} was exported".format(base, name))
+
+    snapshot = manifest["rootfs"] == "overlayfs"
+    with timer_print("Restoring {} from the export".format(name)):
+        create_runtime_container(
+            base, name, snapshot=snapshot, backingstore=manifest["rootfs"], config_path=config.ARCHIVE_CONFIG_PATH
+        )
+        # The prepare commands of the new clone are already in the export
+        container_dir = os.path.join(config.ARCHIVE_CONFIG_PATH, name)
+        config_file = os.path.join(container_dir, "config")
+        with open(config_file, "r") as f:
+            cloned_config = f.read()
+        with open(config_file, "w") as f:
+            f.write(merge_container_config(manifest["config"], cloned_config))
+        _rewrite_config_paths(container_dir, manifest["config_dir"], name)
+        container = RuntimeContainer(lxc.Container(name, config_path=config.ARCHIVE_CONFIG_PATH))
+        rootfs = container.get_rootfs_path()
+        if manifest["deleted"]:
+            container_exec(
+                ["xargs", "-0", "rm", "-rf", "--"],
+                input=b"".join(os.path.join(rootfs, p).encode("utf-8", "surrogateescape") + b"\0" for p in manifest["deleted"])
+            )
+        container_exec([
+            "tar", "-x", "-p", "--numeric-owner", "--xattrs", "--xattrs-include=*",
+            "-I", "zstd -q", "-C", rootfs, "-f", get_export_path(name),
+        ])
+
+    meta = dict(manifest["meta"])
+    meta["restored_from"] = get_export_path(name)
+    container.write_meta(meta)
+    container.flush_meta()
+    verbose_message("Restored {} to the archive".format(name))
+    return container
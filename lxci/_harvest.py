@@ -0,0 +1,220 @@
+import errno
+import fcntl
+import grp
+import hashlib
+import io
+import os
+import pwd
+import shutil
+import subprocess
+import tarfile
+import time
+
+# ioctl for cloning a file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+RESULTS_FORMATS = ("dir", "tar", "tar.gz", "tar.xz", "tar.zst")
+
+
+def resolve_owner(user, group):
+    """
+    returns (uid, gid) tuple of the user and group names
+    """
+    return pwd.getpwnam(user).pw_uid, grp.getgrnam(group).gr_gid
+
+
+def _chown(path, owner):
+    if owner:
+        os.chown(path, owner[0], owner[1], follow_symlinks=False)
+
+
+def _get_owner(path):
+    st = os.lstat(path)
+    return st.st_uid, st.st_gid
+
+
+def _reflink(src, dest):
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dest_file.close()
+            os.remove(dest)
+            raise
+    shutil.copystat(src, dest)
+
+
+def harvest_file(src, dest, owner=None, move=False):
+    """
+    Get file src to dest as cheaply as possible: hardlink on the same
+    filesystem, reflink on copy-on-write filesystems and copy otherwise. The
+    owner (uid, gid) is set right away. A hardlink shares the inode with the
+    container so it is used only when src already has the owner. With move
+    src is renamed to dest on the same filesystem instead. Use it only when
+    the container is destroyed afterwards.
+
+    returns the used method: move, link, reflink or copy
+    """
+    if move:
+        try:
+            _chown(src, owner)
+            os.rename(src, dest)
+            return "move"
+        except OSError as e:
+            # EACCES: the directory in the container is not writable for us
+            if e.errno not in (errno.EXDEV, errno.EACCES, errno.EPERM):
+                raise
+
+    method = "copy"
+    try:
+        if owner and _get_owner(src) != tuple(owner):
+            raise OSError(errno.EPERM, "Owner differs", src)
+        os.link(src, dest)
+        method = "link"
+    except OSError as e:
+        # EXDEV: different filesystems, EPERM: protected_hardlinks or the
+        # owner differs
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        try:
+            _reflink(src, dest)
+            method = "reflink"
+        except OSError:
+            shutil.copy2(src, dest)
+
+    _chown(dest, owner)
+    return method
+
+
+def harvest_tree(src_dir, dest_dir, owner=None, move=False):
+    """
+    Harvest all files under src_dir to dest_dir. Symlinks are recreated as
+    symlinks instead of following them since they point to paths in the
+    container. See harvest_file() for move.
+
+    returns dict of used methods and their counts
+    """
+    counts = {}
+    os.makedirs(dest_dir, exist_ok=True)
+    shutil.copystat(src_dir, dest_dir)
+    _chown(dest_dir, owner)
+
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        rel = os.path.relpath(dirpath, src_dir)
+        dest_dirpath = os.path.normpath(os.path.join(dest_dir, rel))
+
+        for name in list(dirnames):
+            src = os.path.join(dirpath, name)
+            dest = os.path.join(dest_dirpath, name)
+            if os.path.islink(src):
+                # os.walk does not descend into symlinked directories
+                filenames.append(name)
+                continue
+            os.mkdir(dest)
+            shutil.copystat(src, dest)
+            _chown(dest, owner)
+
+        for name in filenames:
+            src = os.path.join(dirpath, name)
+            dest = os.path.join(dest_dirpath, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dest)
+                _chown(dest, owner)
+                method = "symlink"
+            elif os.path.isfile(src):
+                method = harvest_file(src, dest, owner, move)
+            else:
+                # Devices, sockets and fifos are not artifacts
+                continue
+            counts[method] = counts.get(method, 0) + 1
+
+    return counts
+
+
+class _hashing_reader():
+    """
+    Compute sha256 of the file while tarfile reads it
+    """
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+class tar_stream():
+    """
+    Open a tarfile for streamed writing to path. tar.zst is compressed with
+    the zstd command, the others with tarfile.
+    """
+    def __init__(self, path, results_format):
+        if results_format not in RESULTS_FORMATS or results_format == "dir":
+            raise ValueError("Unknown tar format {}".format(results_format))
+        self.path = path
+        self.results_format = results_format
+        self.process = None
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "wb")
+        if self.results_format == "tar.zst":
+            self.process = subprocess.Popen(
+                ["zstd", "-q", "-T0", "-c"], stdin=subprocess.PIPE, stdout=self.file
+            )
+            self.tar = tarfile.open(fileobj=self.process.stdin, mode="w|")
+        else:
+            compression = self.results_format.partition(".")[2]
+            self.tar = tarfile.open(fileobj=self.file, mode="w|" + compression)
+        return self.tar
+
+    def __exit__(self, type, value, traceback):
+        self.tar.close()
+        if self.process:
+            self.process.stdin.close()
+            if self.process.wait() != 0 and type is None:
+                raise subprocess.CalledProcessError(self.process.returncode, "zstd")
+        self.file.close()
+
+
+def write_tarball(src_dir, dest_path, results_format, owner=None):
+    """
+    Write everything under src_dir to a single tarball at dest_path. A
+    SHA256SUMS manifest of the files is added as the last member.
+
+    returns number of files written
+    """
+    checksums = []
+
+    def normalize(tarinfo):
+        if owner:
+            tarinfo.uid, tarinfo.gid = owner
+            tarinfo.uname = tarinfo.gname = ""
+        return tarinfo
+
+    with tar_stream(dest_path, results_format) as tar:
+        for dirpath, dirnames, filenames in os.walk(src_dir):
+            dirnames.sort()
+            for name in sorted(dirnames + filenames):
+                src = os.path.join(dirpath, name)
+                arcname = os.path.relpath(src, src_dir)
+                tarinfo = normalize(tar.gettarinfo(src, arcname))
+                if tarinfo.isreg():
+                    with open(src, "rb") as f:
+                        reader = _hashing_reader(f)
+                        tar.addfile(tarinfo, reader)
+                    checksums.append("{}  {}\n".format(reader.sha256.hexdigest(), arcname))
+                elif tarinfo.isdir() or tarinfo.issym():
+                    tar.addfile(tarinfo)
+
+        manifest = "".join(checksums).encode()
+        tarinfo = normalize(tarfile.TarInfo("SHA256SUMS"))
+        tarinfo.size = len(manifest)
+        tarinfo.mode = 0o644
+        tarinfo.mtime = time.time()
+        tar.addfile(tarinfo, io.BytesIO(manifest))
+
+    _chown(dest_path, owner)
+    return len(checksums)
+
@@ -0,0 +1,293 @@
+import json
+import os
+import sqlite3
+
+from lxci import config
+
+# Bump when the schema changes. Old indexes are rebuilt automatically
+INDEX_VERSION = 2
+
+# Number of the latest sizes of each base and tag used for the expected size
+SIZE_HISTORY = 10
+
+_index = None
+
+def get_index():
+    """
+    Get the shared ContainerIndex of STATE_PATH
+    """
+    global _index
+    path = os.path.join(config.STATE_PATH, "index.sqlite")
+    # SQLite connections must not be shared with forked processes
+    if _index is None or _index.path != path or _index.pid != os.getpid():
+        _index = ContainerIndex(path)
+    return _index
+
+
+def _get_meta_filepath(container):
+    rootfs = container.get_config_item("lxc.rootfs")
+    if rootfs.startswith("overlayfs:"):
+        rootfs = rootfs.split(":")[2]
+    return os.path.join(rootfs, "lxci", "meta")
+
+def _read_meta_file(meta_path):
+    try:
+        with open(meta_path, "r") as f:
+            return json.load(f) or {}
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class ContainerIndex():
+    """
+    Host side SQLite index of the lxci containers and their meta data so that
+    the containers can be listed and looked up by name, tag, base and state
+    without reading the meta data of every container.
+
+    The index is updated by RuntimeContainer when it writes its meta data,
+    archives or destroys it. Changes made behind its back are noticed from the
+    modification times of the config path directory and the meta data files
+    in which case the index is synchronized with the containers on the disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version == INDEX_VERSION:
+            return
+
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            # Someone else might have created it while we waited for the lock
+            if self.db.execute("PRAGMA user_version").fetchone()[0] == INDEX_VERSION:
+                return
+            self.db.execute("DROP TABLE IF EXISTS containers")
+            self.db.execute("DROP TABLE IF EXISTS tags")
+            self.db.execute("DROP TABLE IF EXISTS config_paths")
+            self.db.execute("DROP TABLE IF EXISTS sizes")
+            self.db.execute("""
+                CREATE TABLE containers (
+                    config_path TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    base TEXT,
+                    pool INTEGER NOT NULL DEFAULT 0,
+                    meta TEXT NOT NULL,
+                    meta_path TEXT NOT NULL,
+                    meta_mtime INTEGER,
+                    PRIMARY KEY (config_path, name)
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE tags (
+                    config_path TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    tag TEXT NOT NULL
+                )
+            """)
+            self.db.execute("CREATE INDEX tags_tag ON tags (tag)")
+            self.db.execute("""
+                CREATE TABLE config_paths (
+                    config_path TEXT PRIMARY KEY,
+                    mtime INTEGER
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE sizes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    base TEXT NOT NULL,
+                    tag TEXT NOT NULL,
+                    snapshot INTEGER NOT NULL,
+                    size INTEGER NOT NULL
+                )
+            """)
+            self.db.execute("CREATE INDEX sizes_base ON sizes (base, snapshot, tag)")
+            self.db.execute("PRAGMA user_version = {}".format(INDEX_VERSION))
+
+    def _update(self, config_path, name, meta, meta_path):
+        self._remove(config_path, name)
+        self.db.execute(
+            "INSERT INTO containers (config_path, name, base, pool, meta, meta_path, meta_mtime) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (config_path, name, meta.get("base"), int(bool(meta.get("pool"))),
+             json.dumps(meta), meta_path, _mtime(meta_path))
+        )
+        self.db.executemany(
+            "INSERT INTO tags (config_path, name, tag) VALUES (?, ?, ?)",
+            [(config_path, name, tag) for tag in meta.get("tags", [])]
+        )
+
+    def _remove(self, config_path, name):
+        self.db.execute("DELETE FROM containers WHERE config_path = ? AND name = ?", (config_path, name))
+        self.db.execute("DELETE FROM tags WHERE config_path = ? AND name = ?", (config_path, name))
+
+    def update(self, config_path, name, meta, meta_path):
+        """
+        Save meta data of the container to the index
+        """
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self._update(config_path, name, meta, meta_path)
+
+    def remove(self, config_path, name):
+        """
+        Remove container from the index
+        """
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self._remove(config_path, name)
+
+    def sync(self, config_path, force=False):
+        """
+        Synchronize the index with the containers in config_path. The
+        containers are listed again only if the directory has changed since
+        the last synchronization. The meta data files rewritten in place are
+        noticed from their modification times.
+        """
+        # Read the mtime before listing so that containers created during
+        # the listing cause a new synchronization next time
+        dir_mtime = _mtime(config_path)
+        row = self.db.execute(
+            "SELECT mtime FROM config_paths WHERE config_path = ?", (config_path,)
+        ).fetchone()
+        list_containers = force or not row or row[0] != dir_mtime
+        if not list_containers and not self._get_stale(config_path):
+            return
+
+        import lxc
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            indexed = self._get_indexed(config_path)
+            if not list_containers:
+                names = set(indexed)
+            elif dir_mtime:
+                names = set(lxc.list_containers(config_path=config_path))
+            else:
+                names = set()
+
+            for name in set(indexed) - names:
+                self._remove(config_path, name)
+
+            for name in names:
+                if name in indexed:
+                    meta_path, meta_mtime = indexed[name]
+                    if _mtime(meta_path) == meta_mtime:
+                        continue
+                else:
+                    meta_path = _get_meta_filepath(lxc.Container(name, config_path=config_path))
+
+                if os.path.exists(os.path.dirname(meta_path)):
+                    self._update(config_path, name, _read_meta_file(meta_path), meta_path)
+                else:
+                    # Not a lxci container
+                    self._remove(config_path, name)
+
+            if list_containers:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO config_paths (config_path, mtime) VALUES (?, ?)",
+                    (config_path, dir_mtime)
+                )
+
+    def _get_indexed(self, config_path):
+        # returns dict of name to (meta_path, meta_mtime)
+        return dict(
+            (name, (meta_path, meta_mtime)) for name, meta_path, meta_mtime in self.db.execute(
+                "SELECT name, meta_path, meta_mtime FROM containers WHERE config_path = ?",
+                (config_path,)
+            )
+        )
+
+    def _get_stale(self, config_path):
+        # Names of the containers whose meta data file has changed since it
+        # was indexed
+        return [
+            name for name, (meta_path, meta_mtime) in self._get_indexed(config_path).items()
+            if _mtime(meta_path) != meta_mtime
+        ]
+
+    def record_size(self, base, tags, snapshot, size):
+        """
+        Save the final disk usage of a runtime container for
+        get_expected_size()
+        """
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            for tag in tags:
+                self.db.execute(
+                    "INSERT INTO sizes (base, tag, snapshot, size) VALUES (?, ?, ?, ?)",
+                    (base, tag, int(bool(snapshot)), size)
+                )
+                self.db.execute(
+                    """DELETE FROM sizes WHERE base = ? AND tag = ? AND snapshot = ? AND id NOT IN (
+                        SELECT id FROM sizes WHERE base = ? AND tag = ? AND snapshot = ? ORDER BY id DESC LIMIT ?
+                    )""",
+                    (base, tag, int(bool(snapshot))) * 2 + (SIZE_HISTORY,)
+                )
+
+    def get_expected_size(self, base, tags=None, snapshot=False):
+        """
+        Get the largest of the latest sizes of the containers with the tags
+        cloned from base. Without tags or their sizes the sizes of all the
+        tags of base are used.
+
+        returns size in bytes or None if nothing is known
+        """
+        sizes = []
+        for tag in tags or []:
+            sizes += [row[0] for row in self.db.execute(
+                "SELECT size FROM sizes WHERE base = ? AND tag = ? AND snapshot = ? ORDER BY id DESC LIMIT ?",
+                (base, tag, int(bool(snapshot)), SIZE_HISTORY)
+            )]
+        if not sizes:
+            sizes = [row[0] for row in self.db.execute(
+                "SELECT size FROM sizes WHERE base = ? AND snapshot = ?",
+                (base, int(bool(snapshot)))
+            )]
+        return max(sizes) if sizes else None
+
+    def find(self, config_path=None, name=None, tag=None, base=None, pool=None):
+        """
+        Find containers matching all the given filters
+
+        returns list of (config_path, name, meta) tuples sorted by name
+        """
+        query = "SELECT c.config_path, c.name, c.meta FROM containers c"
+        where = []
+        params = []
+
+        if tag is not None:
+            query += " JOIN tags t ON t.config_path = c.config_path AND t.name = c.name"
+            where.append("t.tag = ?")
+            params.append(tag)
+        if config_path is not None:
+            where.append("c.config_path = ?")
+            params.append(config_path)
+        if name is not None:
+            where.append("c.name = ?")
+            params.append(name)
+        if base is not None:
+            where.append("c.base = ?")
+            params.append(base)
+        if pool is not None:
+            where.append("c.pool = ?")
+            params.append(int(bool(pool)))
+
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY c.name"
+
+        return [
+            (row_config_path, row_name, json.loads(meta))
+            for row_config_path, row_name, meta in self.db.execute(query, params)
+        ]
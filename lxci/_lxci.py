@@ -1,62 +1,173 @@
 
 import datetime
+import errno
+import fcntl
 import json
-import lxc
 import os
+import pty
 import pwd
-import shutil
+import select
+import signal
 import socket
 import stat
 import subprocess
+import re
 import time
 import sys
-import tempfile
-import uuid
+import termios
+import tty
 import getpass
+import copy
+import hashlib
+import io
+import tarfile
 
 
 from lxci import config
+from lxci._messages import error_message, verbose_message
+from lxci._readiness import wait_until, is_listening, has_ssh_banner
+from lxci._index import get_index
+from lxci._harvest import RESULTS_FORMATS, harvest_tree, resolve_owner, write_tarball
+from lxci._buildlog import build_log
+from lxci._cgroup import is_cgroup2, get_limit_items, read_resource_usage
+from lxci._placement import choose_tier
 
-def error_message(*a, **kw):
-    print(*a, file=sys.stderr, **kw)
-    sys.stderr.flush()
+# uid and gid of the lxci user in the container
+LXCI_UID = 555
 
-def verbose_message(*a, **kw):
-    if config.VERBOSE:
-        print(*a, file=sys.stderr, **kw)
-        sys.stderr.flush()
+# Backing stores which are layered on top of the base container
+SNAPSHOT_BACKINGSTORES = ("overlayfs", "aufs")
 
-def container_exec(command):
+# Seconds the shared SSH connection of a container is kept open after its
+# last command
+SSH_CONTROL_PERSIST = 60
+
+def container_exec(command, input=None, output=False):
     """
-    Run command using lxc-usernsexec if the caller is not root
+    Run command using lxc-usernsexec if the caller is not root. input bytes
+    are written to the stdin of the command. With output the stdout of the
+    command is returned as bytes
     """
-    if os.getuid() == 0:
-        subprocess.check_call(command)
-    else:
-        subprocess.check_call(["lxc-usernsexec", "--"] + command)
+    if os.getuid() != 0:
+        command = ["lxc-usernsexec", "--"] + command
+    process = subprocess.run(
+        command, input=input, check=True, stdout=subprocess.PIPE if output else None
+    )
+    return process.stdout
 
 
-def wait_for_ssh(address, timeout=10):
+class staging():
     """
-    Wait for SSH server to wake up on address (tuple of host and port)
+    Collect directories and files to be written into a container rootfs and
+    write them all at once with a single tar stream extracted by one
+    container_exec() call. Everything is owned by root in the container.
+
+    Used as a context manager the staged changes are applied at the end of
+    the with block unless it raises.
     """
-    started = time.time()
-    while True:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(self, rootfs):
+        self.rootfs = rootfs
+        self.entries = []
+        self.callbacks = []
 
-        try:
-            s.connect(address)
-            data = s.recv(5)
-            if b'SSH' in data:
-                break
-        except socket.error:
-            time.sleep(0.1)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.apply()
+
+    def _add(self, path, tarinfo_type, mode, content=None):
+        tarinfo = tarfile.TarInfo(path.lstrip("/"))
+        tarinfo.type = tarinfo_type
+        tarinfo.mode = mode
+        tarinfo.mtime = time.time()
+        # Replace earlier versions of the same file
+        self.entries = [e for e in self.entries if e[0].name != tarinfo.name]
+        self.entries.append((tarinfo, content))
+
+    def mkdir(self, path, mode=0o755):
+        """
+        Like mkdir -p path. Existing directories are left untouched
+        """
+        self._add(path, tarfile.DIRTYPE, mode)
 
+    def file(self, path, content, mode=0o644):
+        """
+        Write str or bytes content to the container path
+        """
+        if isinstance(content, str):
+            content = content.encode()
+        self._add(path, tarfile.REGTYPE, mode, content)
 
-        if time.time() - started > timeout:
-              raise RuntimeContainerError("Timeout while waiting for container SSH server to wake up. Are you sure it is installed?")
+    def copy(self, src, path):
+        """
+        Copy file from the host path src to the container path
+        """
+        with open(src, "rb") as f:
+            self.file(path, f.read(), stat.S_IMODE(os.stat(src).st_mode))
 
+    def after_apply(self, callback):
+        """
+        Call callback once the staged changes have been written
+        """
+        self.callbacks.append(callback)
+
+    def apply(self):
+        if self.entries:
+            data = io.BytesIO()
+            with tarfile.open(fileobj=data, mode="w") as tar:
+                for tarinfo, content in self.entries:
+                    if content is None:
+                        tar.addfile(tarinfo)
+                    else:
+                        tarinfo.size = len(content)
+                        tar.addfile(tarinfo, io.BytesIO(content))
+            container_exec([
+                "tar", "-x", "-p", "--numeric-owner", "--no-overwrite-dir",
+                "-C", self.rootfs, "-f", "-"
+            ], input=data.getvalue())
+            self.entries = []
 
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def wait_for_ssh(address, timeout=10):
+    """
+    Wait for SSH server to wake up on address (tuple of host and port)
+    """
+    try:
+        wait_until(lambda: has_ssh_banner(address), timeout)
+    except TimeoutError:
+        raise RuntimeContainerError("Timeout while waiting for container SSH server to wake up. Are you sure it is installed?")
+
+
+class file_lock():
+    """
+    Hold an exclusive flock(2) lock on path for the duration of the with block.
+    With blocking=False BlockingIOError is raised if the lock is already taken
+    """
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.fd = None
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        flags = fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fd, flags)
+        except BlockingIOError:
+            os.close(self.fd)
+            raise
+        return self
+    def __exit__(self, type, value, traceback):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
 
 class timer_print():
     """
@@ -64,32 +175,92 @@ class timer_print():
     """
     def __init__(self, msg):
         verbose_message(msg + "...", end="")
+        self.took = None
     def __enter__(self):
         self.started = time.time()
+        return self
     def __exit__(self, type, value, traceback):
-        took = time.time() - self.started
-        verbose_message("OK {}s".format(round(took, 2)))
+        self.took = time.time() - self.started
+        verbose_message("OK {}s".format(round(self.took, 2)))
+
+def ensure_ssh_key():
+    """
+    Generate the SSH key used to login to the containers if it is missing
+    """
+    if os.path.exists(config.SSH_KEY_PATH):
+        return
+    with file_lock(os.path.join(config.STATE_PATH, "ssh-key.lock")):
+        if not os.path.exists(config.SSH_KEY_PATH):
+            print("ssh key missing. Generating", config.SSH_KEY_PATH, file=sys.stderr)
+            os.makedirs(os.path.dirname(config.SSH_KEY_PATH), exist_ok=True)
+            subprocess.check_call(["ssh-keygen", "-q", "-N", "", "-f", config.SSH_KEY_PATH])
 
 def list_base_containers(**kw):
+    import lxc
     return lxc.list_containers(config_path=config.BASE_CONFIG_PATH)
 
+def runtime_config_paths():
+    """
+    Get the runtime tiers from RUNTIME_TIERS in the order of preference.
+    RUNTIME_CONFIG_PATH is always the last one
+    """
+    tiers = [p.strip() for p in config.RUNTIME_TIERS.split(",") if p.strip()]
+    return [p for p in tiers if p != config.RUNTIME_CONFIG_PATH] + [config.RUNTIME_CONFIG_PATH]
+
+def choose_runtime_config_path(base_container_name, tags=None, snapshot=False):
+    """
+    Choose the runtime tier for a new container from the free space of the
+    tiers and the sizes of the earlier containers of the same base and tags
+    """
+    config_paths = runtime_config_paths()
+    if len(config_paths) == 1:
+        return config_paths[0]
+    expected_size = get_index().get_expected_size(base_container_name, tags, snapshot)
+    config_path = choose_tier(
+        config_paths, expected_size, config.RUNTIME_TIER_RESERVE * 1024 * 1024, snapshot
+    )
+    verbose_message("Placing the container to {} (expected size {})".format(
+        config_path, "unknown" if expected_size is None else "{}M".format(expected_size // (1024 * 1024))
+    ))
+    return config_path
+
+def _list_runtime_tiers(**kw):
+    containers = []
+    for config_path in runtime_config_paths():
+        containers += _list_containers(config_path, **kw)
+    return containers
+
 def list_runtime_containers(**kw):
-    return _list_containers(config.RUNTIME_CONFIG_PATH, **kw)
+    return _list_runtime_tiers(**kw)
 
 def list_archived_containers(**kw):
     return _list_containers(config.ARCHIVE_CONFIG_PATH, **kw)
 
-def _list_containers(config_path, return_object=False, tag_filter=None):
+def list_pool_containers(**kw):
+    return _list_runtime_tiers(pool=True, **kw)
+
+def list_cache_containers(**kw):
+    return _list_containers(config.CACHE_CONFIG_PATH, **kw)
+
+def _list_containers(config_path, return_object=False, tag_filter=None, pool=False, base=None, name=None):
+    # Pool containers are not runtime containers until they are taken
+    return find_containers(
+        config_path, return_object=return_object, tag=tag_filter or None, pool=pool, base=base, name=name
+    )
+
+def find_containers(config_path, return_object=False, name=None, tag=None, base=None, pool=None):
+    """
+    Find lxci containers in config_path using the container index
+    """
+    index = get_index()
+    index.sync(config_path)
     containers = []
-    for name in lxc.list_containers(config_path=config_path):
-        container = RuntimeContainer(lxc.Container(name, config_path=config_path))
-        if tag_filter and tag_filter not in container.get_tags():
-            continue
-        if container.is_lxci_container():
-            if return_object:
-                containers.append(container)
-            else:
-                containers.append(name)
+    for _, container_name, meta in index.find(config_path=config_path, name=name, tag=tag, base=base, pool=pool):
+        if return_object:
+            # lxc is imported only when the container itself is used
+            containers.append(RuntimeContainer(name=container_name, config_path=config_path, meta=meta))
+        else:
+            containers.append(container_name)
     return containers
 
 def make_executable(filepath):
@@ -99,6 +270,14 @@ def make_executable(filepath):
     st = os.stat(filepath)
     os.chmod(filepath, st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
 
+def has_overlay_metacopy():
+    """
+    returns True if the overlayfs of the kernel supports the metacopy=on
+    mount option. The module parameter is only the default for the mounts
+    without the option so its value does not matter
+    """
+    return os.path.exists("/sys/module/overlay/parameters/metacopy")
+
 
 class RuntimeContainerError(Exception):
     "RuntimeContainer Error"
@@ -110,26 +289,374 @@ def assert_ret(was_success, msg=""):
     if not was_success:
         raise RuntimeContainerError(msg)
 
+PREPARE_SH_PATH = "/lxci/prepare.sh"
+# Contains the checksum of the prepare commands once prepare.sh has succeeded
+PREPARED_MARKER = "/lxci/prepared"
+
+# Prepare commands of every lxci container
+LXCI_USER_PREPARE_COMMANDS = (
+    "adduser --system --uid {uid} --shell /bin/bash --group lxci".format(uid=LXCI_UID),
+    # Ensure the user can read everything in home
+    "chown -R lxci:lxci /home/lxci",
+)
+# Prepare commands of enable_sudo()
+SUDO_PREPARE_COMMANDS = (
+    "usermod -a -G sudo lxci",
+    "echo '%lxci ALL=(ALL) NOPASSWD: ALL' >> /etc/sudoers",
+)
+
 prepare_header = """#!/bin/sh
+[ "$(cat {marker} 2>/dev/null)" != "{checksum}" ] || exit 0
 exec >> /var/log/lxci-prepare.log
 exec 2>&1
 set -eux
 """
 
+# Run in a container restored from a checkpoint of another container. $1 is
+# the hostname and $2 the MAC address of the new container. The DHCP lease of
+# the checkpointed container is released and a new one is taken
+restore_fixup_script = """
+hostname "$1"
+if [ -n "$2" ]; then
+    ip link set dev eth0 down
+    ip link set dev eth0 address "$2"
+    ip link set dev eth0 up
+fi
+if command -v dhclient > /dev/null; then
+    dhclient -r eth0 || true
+    dhclient eth0
+elif command -v networkctl > /dev/null; then
+    networkctl reconfigure eth0
+fi
+"""
+
+# Mount entries of the checkpointed container saved to the checkpoint
+# directory. The mounts of a restored container come from the checkpoint so
+# containers with other mounts must be booted
+CHECKPOINT_MOUNTS_FILE = "lxci-mounts.json"
+
 command_header = """#!/bin/sh
 set -eu
 cd /home/lxci/workspace
 """
 
+class CommandResult():
+    """
+    Result of a command executed in the container. Compatible with the
+    returncode attribute of subprocess.Popen
+    """
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+
+class SSHBackend():
+    """
+    Execute commands in the container over SSH as the lxci user. The commands
+    of a container share one connection through a ControlMaster so only the
+    first one pays for the SSH handshake. The master is closed by close()
+    """
+    needs_network = True
+
+    def __init__(self, runtime_container):
+        self.runtime_container = runtime_container
+
+    def get_control_path(self):
+        # Unix socket paths are limited to 108 bytes so the name is hashed
+        name = hashlib.sha1(self.runtime_container.get_name().encode()).hexdigest()[:16]
+        return os.path.join(config.STATE_PATH, "ssh", name)
+
+    def get_ssh_args(self):
+        control_path = self.get_control_path()
+        os.makedirs(os.path.dirname(control_path), exist_ok=True)
+        return [
+            "ssh",
+            "-q", # Quiet mode
+            "-oStrictHostKeyChecking=no", # Skip the host key prompt
+            "-oControlMaster=auto", # Share the connection between commands
+            "-oControlPath=" + control_path,
+            "-oControlPersist=" + str(SSH_CONTROL_PERSIST),
+            "-i", config.SSH_KEY_PATH, # Use our ssh key
+            "-l", "lxci", # Login as lxci user
+        ]
+
+    def close(self):
+        """
+        Close the shared connection
+        """
+        if not os.path.exists(self.get_control_path()):
+            return
+        # The host is not used since the control path has no %h
+        subprocess.call(
+            self.get_ssh_args() + ["-O", "exit", "container"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+    def run(self, script_path, log=None):
+        ensure_ssh_key()
+        process_args = self.get_ssh_args() + [
+            "-t", # Force pseudo-tty allocation
+            self.runtime_container.container.get_ips()[0],
+            script_path,
+        ]
+
+        verbose_message("With: {}".format(process_args))
+
+        if log is None:
+            cmd = subprocess.Popen(process_args, pass_fds=os.pipe())
+            cmd.wait()
+            return cmd
+
+        # Let ssh write to a pty or a pipe of ours so the output can be
+        # copied to the log
+        if sys.stdin.isatty():
+            master_fd, slave_fd = pty.openpty()
+            _copy_window_size(sys.stdin.fileno(), slave_fd)
+            cmd = subprocess.Popen(
+                process_args, stdin=slave_fd, stdout=slave_fd, stderr=slave_fd, start_new_session=True
+            )
+        else:
+            master_fd, slave_fd = os.pipe()
+            cmd = subprocess.Popen(process_args, stdout=slave_fd, stderr=slave_fd)
+        os.close(slave_fd)
+
+        status = _pty_pump(master_fd, cmd.pid, log=log)
+        # The status was reaped by the pump
+        cmd.returncode = _status_to_returncode(status)
+        return cmd
+
+
+class AttachBackend():
+    """
+    Execute commands in the container as the lxci user by attaching to its
+    namespaces with lxc-attach. Does not need network or SSH server in the
+    container. A pseudo-terminal is allocated if stdin is a terminal.
+    """
+    needs_network = False
+
+    def __init__(self, runtime_container):
+        self.runtime_container = runtime_container
+
+    def close(self):
+        pass
+
+    def get_env(self):
+        env = {
+            "HOME": "/home/lxci",
+            "USER": "lxci",
+            "LOGNAME": "lxci",
+            "SHELL": "/bin/bash",
+            "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin",
+            "TERM": os.environ.get("TERM", "dumb"),
+        }
+        # SSH logins read these with pam_env
+        env.update(self.runtime_container.read_env())
+        return env
+
+    def run(self, script_path, log=None):
+        env = self.get_env()
+        master_fd, slave_fd = None, None
+        is_tty = sys.stdin.isatty()
+        if is_tty:
+            master_fd, slave_fd = pty.openpty()
+            _copy_window_size(sys.stdin.fileno(), slave_fd)
+        elif log is not None:
+            master_fd, slave_fd = os.pipe()
+
+        def run_script(payload):
+            # Executed inside the container
+            if slave_fd is not None:
+                os.close(master_fd)
+            if is_tty:
+                os.setsid()
+                for fd in (0, 1, 2):
+                    os.dup2(slave_fd, fd)
+                fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+            elif slave_fd is not None:
+                for fd in (1, 2):
+                    os.dup2(slave_fd, fd)
+            if slave_fd is not None and slave_fd > 2:
+                os.close(slave_fd)
+            os.initgroups("lxci", LXCI_UID)
+            os.setgid(LXCI_UID)
+            os.setuid(LXCI_UID)
+            os.chdir("/home/lxci")
+            os.execve(script_path, [script_path], env)
+
+        pid = self.runtime_container.container.attach(run_script)
+        if slave_fd is not None:
+            os.close(slave_fd)
+        if pid < 0:
+            if master_fd is not None:
+                os.close(master_fd)
+            raise RuntimeContainerError("Failed to attach to the container")
+
+        if master_fd is not None:
+            status = _pty_pump(master_fd, pid, log=log)
+        else:
+            _, status = os.waitpid(pid, 0)
+
+        return CommandResult(_status_to_returncode(status))
+
+
+EXEC_BACKENDS = {
+    "ssh": SSHBackend,
+    "attach": AttachBackend,
+}
+
+
+def _status_to_returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _copy_window_size(src_fd, dest_fd):
+    try:
+        size = fcntl.ioctl(src_fd, termios.TIOCGWINSZ, b"\0" * 8)
+        fcntl.ioctl(dest_fd, termios.TIOCSWINSZ, size)
+    except OSError:
+        pass
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def _pty_pump(master_fd, pid, log=None):
+    """
+    Pass stdin to the pty master and the pty output to stdout and log until
+    process pid exits. If stdin is not a terminal master_fd may be the read
+    end of a pipe and only the output is passed.
+
+    returns the wait status of pid
+    """
+    stdin_fd = sys.stdin.fileno()
+    stdout_fd = sys.stdout.fileno()
+    is_tty = sys.stdin.isatty()
+    if is_tty:
+        old_tty_attrs = termios.tcgetattr(stdin_fd)
+        old_winch = signal.signal(
+            signal.SIGWINCH,
+            lambda signum, frame: _copy_window_size(stdin_fd, master_fd)
+        )
+        tty.setraw(stdin_fd)
+
+    status = None
+    read_fds = [master_fd, stdin_fd] if is_tty else [master_fd]
+    try:
+        while True:
+            if status is None:
+                _pid, _status = os.waitpid(pid, os.WNOHANG)
+                if _pid == pid:
+                    status = _status
+                    # Do not wait for input anymore, just drain the output
+                    read_fds = [master_fd]
+
+            try:
+                readable, _, _ = select.select(read_fds, [], [], 0.1 if status is None else 0)
+            except InterruptedError:
+                continue
+
+            if master_fd in readable:
+                try:
+                    data = os.read(master_fd, 65536)
+                except OSError:
+                    # EIO: all slave fds are closed
+                    data = b""
+                if not data:
+                    read_fds = [fd for fd in read_fds if fd != master_fd]
+                    if status is not None:
+                        break
+                else:
+                    _write_all(stdout_fd, data)
+                    if log is not None:
+                        log.write(data)
+            elif status is not None:
+                break
+
+            if stdin_fd in readable:
+                data = os.read(stdin_fd, 65536)
+                if data:
+                    os.write(master_fd, data)
+                else:
+                    read_fds = [fd for fd in read_fds if fd != stdin_fd]
+    finally:
+        if is_tty:
+            termios.tcsetattr(stdin_fd, termios.TCSAFLUSH, old_tty_attrs)
+            signal.signal(signal.SIGWINCH, old_winch)
+        os.close(master_fd)
+
+    if status is None:
+        _, status = os.waitpid(pid, 0)
+    return status
+
+
+def parse_step(value):
+    """
+    Parse a NAME=COMMAND step
+
+    returns (name, command) tuple
+    """
+    name, sep, command = value.partition("=")
+    if not sep or not name.strip():
+        raise RuntimeContainerError("Invalid step {!r}. Expected NAME=COMMAND".format(value))
+    return name.strip(), command
+
+def load_steps(path):
+    """
+    Load steps from a JSON file with a list of objects with "name" and
+    "command" keys:
+
+        [
+            {"name": "deps", "command": "sudo apt-get install -y libfoo-dev"},
+            {"name": "build", "command": "make"},
+            {"name": "test", "command": "make test"}
+        ]
+
+    returns list of (name, command) tuples
+    """
+    with open(path, "r") as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise RuntimeContainerError("Invalid steps file {}: {}".format(path, e))
+    if not isinstance(data, list):
+        raise RuntimeContainerError("Expected the steps file {} to contain a list".format(path))
+    steps = []
+    for i, step in enumerate(data):
+        if not isinstance(step, dict) or not step.get("name") or "command" not in step:
+            raise RuntimeContainerError("Step {} of {} has no name or command".format(i, path))
+        steps.append((step["name"], step["command"]))
+    return steps
+
+
 class RuntimeContainer():
 
-    def __init__(self, container):
+    def __init__(self, container=None, meta=None, name=None, config_path=None):
+        """
+        Wrap the lxc.Container or, without it, the container name under
+        config_path whose lxc.Container is created on first use
+        """
         if isinstance(container, str):
             raise TypeError("Expected container to be instance of lxc.Container not string")
-        self.container = container
+        if container is None and not (name and config_path):
+            raise TypeError("Expected container or name and config_path")
+        self._container = container
+        self._name = name
+        self._config_path = config_path
         self._prepare_commands = []
+        # Meta data already read from the container index
+        self._meta = meta
+        # Meta data changes are kept in memory until flush_meta()
+        self._meta_dirty = False
 
 
+    @property
+    def container(self):
+        if self._container is None:
+            import lxc
+            self._container = lxc.Container(self._name, config_path=self._config_path)
+        return self._container
+
     def __str__(self):
         meta = self.read_meta()
         return "{name} base={base} state={state} tag={tags} ".format(
@@ -150,38 +677,237 @@ class RuntimeContainer():
 
 
     def get_name(self):
+        if self._container is None:
+            return self._name
         return self.container.name
 
 
-    def start(self):
+    def start(self, checkpoint_path=None):
         """
-        Start the container and wait until the SSH server is available
+        Start the container and wait until it is ready. By default the
+        container is ready when it has an ip address and the SSH server is
+        listening. If READY_MARKER is set it is ready when the marker file
+        appears. The attach exec backend does not need to wait for the network
+        or SSH. Latencies of the phases are saved to the meta data.
+
+        With checkpoint_path the container is restored from the checkpoint()
+        of the container it was cloned from instead of booting it when
+        possible.
         """
 
-        if self.container.state == "STOPPED":
-            self.prepare()
+        readiness = {}
+        restored = False
+        if checkpoint_path and self._can_restore(checkpoint_path):
+            took = self._restore(checkpoint_path)
+            if took is not None:
+                readiness["restore"] = took
+                restored = True
+
+        marker = config.READY_MARKER
+        if not restored:
+            # Containers from the pool and archived containers are already prepared
+            boot_failed_message = "Failed to start the runtime container"
+            if self.container.state == "STOPPED" and self._prepare_commands:
+                self.prepare_on_boot()
+                boot_failed_message = self._get_prepare_failed_message()
+            else:
+                self.flush_meta()
+
+            # Booted pool containers are already running and their marker
+            # tells they are ready. Only a stale marker from the previous
+            # boot is removed
+            booting = self.container.state != "RUNNING"
+            if booting and marker and os.path.exists(self.get_path(marker)):
+                container_exec(["rm", "-f", self.get_path(marker)])
+
+            with timer_print("Waiting for the container to boot") as t:
+                if booting:
+                    assert_ret(self.container.start(), boot_failed_message)
+                    assert_ret(
+                        self.container.wait("RUNNING", config.BOOT_TIMEOUT),
+                        "Timeout while waiting for the container to boot"
+                    )
+            readiness["boot"] = t.took
+
+        # The marker was written before the checkpoint and is not written
+        # again by the restored container
+        if marker and not restored:
+            with timer_print("Waiting for the ready marker {}".format(marker)) as t:
+                self._wait_for_ready_marker(marker)
+            readiness["ready_marker"] = t.took
+        elif self.get_exec_backend().needs_network:
+            with timer_print("Waiting for the container to get network") as t:
+                ip = self._wait_for_network()
+            readiness["network"] = t.took
+
+            with timer_print("Waiting for the container SSH server to wake up") as t:
+                self._wait_for_ssh_server(ip)
+            readiness["ssh"] = t.took
+
+        self.add_meta({"readiness": readiness})
+        for phase, took in readiness.items():
+            self.record_timing(phase, took)
+        self.flush_meta()
+
+    def _get_mount_entries(self):
+        try:
+            return list(self.container.get_config_item("lxc.mount.entry"))
+        except KeyError:
+            return []
+
+    def _get_hwaddr(self):
+        for key in ("lxc.net.0.hwaddr", "lxc.network.0.hwaddr"):
+            try:
+                hwaddr = self.container.get_config_item(key)
+            except KeyError:
+                continue
+            if hwaddr:
+                return hwaddr
+        return ""
+
+    def checkpoint(self, checkpoint_path):
+        """
+        Boot the container and save a CRIU checkpoint of it to
+        checkpoint_path with liblxc. The container is stopped by the
+        checkpoint. Its rootfs must not change afterwards since the
+        containers restored from the checkpoint are its snapshots.
+        """
+        self.start()
+        with timer_print("Checkpointing the container") as t:
+            ok = self.container.checkpoint(checkpoint_path, stop=True, verbose=config.VERBOSE)
+            if not ok:
+                self.stop()
+            assert_ret(ok, "Failed to checkpoint the container with CRIU")
+        with open(os.path.join(checkpoint_path, CHECKPOINT_MOUNTS_FILE), "w") as f:
+            json.dump(self._get_mount_entries(), f)
+        self.record_timing("checkpoint", t.took)
+
+    def _can_restore(self, checkpoint_path):
+        if self.container.state != "STOPPED":
+            return False
+        # The prepare hook is run only on boot
+        if self._prepare_commands:
+            verbose_message("Booting the container since it has prepare commands")
+            return False
+        try:
+            with open(os.path.join(checkpoint_path, CHECKPOINT_MOUNTS_FILE), "r") as f:
+                mounts = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if mounts != self._get_mount_entries():
+            verbose_message("Booting the container since its mounts differ from the checkpoint")
+            return False
+        return True
+
+    def _restore(self, checkpoint_path):
+        # returns the seconds the restore took or None if it failed and the
+        # container must be booted instead
+        import lxc
+        self.flush_meta()
+        with timer_print("Restoring the container from the checkpoint") as t:
+            if not self.container.restore(checkpoint_path, verbose=config.VERBOSE):
+                verbose_message("Failed to restore the container. Booting it instead")
+                if self.container.state != "STOPPED":
+                    self.container.stop()
+                return None
+            status = self.container.attach_wait(
+                lxc.attach_run_command,
+                ["/bin/sh", "-c", restore_fixup_script, "sh", self.get_name(), self._get_hwaddr()]
+            )
+            if _status_to_returncode(status) != 0:
+                self.container.stop()
+                raise RuntimeContainerError("Failed to set up the network of the restored container")
+        self.add_meta({"restored": True})
+        return t.took
+
+    def set_resource_limits(self, memory=None, cpu_shares=None, blkio_weight=None):
+        """
+        Limit the memory (bytes with an optional K, M or G suffix), the CPU
+        shares and the block I/O weight of the container. The limits are saved
+        to the container config of stopped containers and set directly to the
+        cgroup of running pool containers. Works with cgroup v1 and v2.
+        """
+        cgroup2 = is_cgroup2()
+        items = get_limit_items(memory, cpu_shares, blkio_weight, cgroup2)
+        if not items:
+            return
 
-        with timer_print("Waiting for the container to boot"):
-            if self.container.state != "RUNNING":
-                assert_ret(self.container.start(), "Failed to start the runtime container")
-                self.container.wait("RUNNING", 60)
+        running = self.container.state == "RUNNING"
+        prefix = "lxc.cgroup2." if cgroup2 else "lxc.cgroup."
+        for item, value in items:
+            if running:
+                ok = self.container.set_cgroup_item(item, value)
+            else:
+                ok = self.container.set_config_item(prefix + item, value)
+            assert_ret(ok, "Failed to set cgroup limit {} to {}".format(item, value))
+        if not running:
+            assert_ret(self.container.save_config(), "Failed to save the container config")
+        self.add_meta({"limits": dict(items)})
 
-        started = time.time()
-        ips = tuple()
-        with timer_print("Waiting for the container to get network"):
-            while True:
-                ips = self.container.get_ips()
-                if len(ips) > 0:
-                    break
-                time.sleep(0.1)
-                if time.time() - started > 10:
-                    raise RuntimeContainerError("Timeout while waiting for container ip address")
-
-        ip = ips[0]
-
-        with timer_print("Waiting for the container SSH server to wake up"):
-            wait_for_ssh((ip, 22))
-        time.sleep(1)
+    def get_resources_path(self):
+        return os.path.join(config.RESULTS_PATH, self.get_name() + ".resources.json")
+
+    def collect_resource_usage(self):
+        """
+        Read the CPU time, peak memory and block I/O counters from the cgroup
+        of the container. Must be called before the container is stopped
+        since the cgroup is removed then. The usage is added to the meta data
+        and written to RESULTS_PATH/NAME.resources.json.
+
+        returns dict
+        """
+        if self.container.state != "RUNNING":
+            raise RuntimeContainerError("Can read resource usage only from running containers")
+
+        usage = read_resource_usage(self.container.get_cgroup_item)
+        self.add_meta({"resources": usage})
+
+        path = self.get_resources_path()
+        os.makedirs(config.RESULTS_PATH, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(usage, f, sort_keys=True, indent=4)
+        owner = self.get_results_owner()
+        if owner:
+            os.chown(path, owner[0], owner[1])
+        return usage
+
+    def _wait_for_ready_marker(self, marker):
+        marker_path = self.get_path(marker)
+        try:
+            wait_until(
+                lambda: os.path.exists(marker_path),
+                config.READY_TIMEOUT,
+                watch_paths=(os.path.dirname(marker_path),)
+            )
+        except TimeoutError:
+            raise RuntimeContainerError("Timeout while waiting for the ready marker {}".format(marker))
+
+    def _wait_for_network(self):
+        # dhclient writes its lease files here when the interface is up so
+        # there is no need to poll in a tight loop
+        lease_dirs = [self.get_path(p) for p in ("/var/lib/dhcp", "/var/lib/dhclient")]
+        try:
+            return wait_until(
+                lambda: next(iter(self.container.get_ips()), None),
+                config.NETWORK_TIMEOUT,
+                watch_paths=lease_dirs
+            )
+        except TimeoutError:
+            raise RuntimeContainerError("Timeout while waiting for container ip address")
+
+    def _wait_for_ssh_server(self, ip):
+        def check():
+            # Look for the listen socket in the network namespace of the
+            # container instead of connecting to it over and over again
+            listening = is_listening(self.container.init_pid, 22)
+            if listening is None:
+                return has_ssh_banner((ip, 22))
+            return listening
+
+        try:
+            wait_until(check, config.SSH_TIMEOUT)
+        except TimeoutError:
+            raise RuntimeContainerError("Timeout while waiting for container SSH server to wake up. Are you sure it is installed?")
 
     def write_env(self, env):
         """
@@ -196,6 +922,43 @@ class RuntimeContainer():
                 f.write('{k}="{v}"\n'.format(k=k, v=v))
 
 
+    def read_env(self):
+        """
+        Read environment variables from /etc/environment in the container
+
+        returns dict
+        """
+        env = {}
+        try:
+            with open(self.get_path("/etc/environment"), "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#") or "=" not in line:
+                        continue
+                    k, v = line.split("=", 1)
+                    if len(v) >= 2 and v[0] == v[-1] and v[0] in "\"'":
+                        v = v[1:-1]
+                    env[k] = v
+        except FileNotFoundError:
+            pass
+        return env
+
+    def get_backingstore(self):
+        """
+        Get the backingstore type of the container rootfs
+        """
+        try:
+            backingstore = self.container.get_config_item("lxc.rootfs.backend")
+        except KeyError:
+            backingstore = None
+        if backingstore:
+            return backingstore
+
+        rootfs = self.container.get_config_item("lxc.rootfs")
+        if ":" in rootfs:
+            return rootfs.split(":")[0]
+        return "dir"
+
     def get_rootfs_path(self):
         """
         Get writable rootfs path on the host
@@ -210,6 +973,28 @@ class RuntimeContainer():
 
         return rootfs
 
+    def get_disk_usage(self):
+        """
+        Get the disk usage of the writable rootfs. For snapshots only the
+        changes to the base container are counted
+
+        returns size in bytes
+        """
+        usage = container_exec(["du", "-s", "-x", "--block-size=1", self.get_rootfs_path()], output=True)
+        return int(usage.split()[0])
+
+    def record_size(self):
+        """
+        Measure the disk usage of the container and save it to the meta data
+        and the index which uses it to place the next containers of the same
+        base and tags
+        """
+        size = self.get_disk_usage()
+        meta = self.read_meta()
+        get_index().record_size(meta.get("base"), meta.get("tags", []), meta.get("snapshot", False), size)
+        self.add_meta({"size": size})
+        return size
+
     def get_results_src_path(self):
         return self.get_path("/home/lxci/results")
 
@@ -219,68 +1004,180 @@ class RuntimeContainer():
             self.get_name()
         )
 
-    def copy_results(self):
-        with timer_print("Copying result artifacts to {}".format(self.get_results_dest_path())):
-            # os.makedirs(self.get_results_dest_path(), exist_ok=True)
-            shutil.copytree(
-                self.get_results_src_path(),
-                self.get_results_dest_path()
-            )
-            if getpass.getuser() == "root":
-                subprocess.check_call([
-                    "chown", "-R",
-                    "{user}:{group}".format(
-                        user=config.RESULTS_OWNER,
-                        group=config.RESULTS_GROUP
-                    ),
-                    self.get_results_dest_path()
-                ])
+    def get_results_owner(self):
+        """
+        returns (uid, gid) tuple for the files written to RESULTS_PATH or None
+        when not running as root
+        """
+        if getpass.getuser() == "root":
+            return resolve_owner(config.RESULTS_OWNER, config.RESULTS_GROUP)
+        return None
 
+    def copy_results(self, results_format=None, move=False):
+        """
+        Harvest the result artifacts to RESULTS_PATH. With the dir format the
+        files are hardlinked or reflinked when possible. With move they are
+        moved out of the container instead, which must be stopped and
+        destroyed afterwards. The tar formats produce a single tarball with a
+        SHA256SUMS manifest.
 
+        returns path to the results
+        """
+        results_format = results_format or config.RESULTS_FORMAT
+        if results_format not in RESULTS_FORMATS:
+            raise RuntimeContainerError("Unknown results format {}. Expected one of {}".format(
+                results_format, ", ".join(RESULTS_FORMATS)
+            ))
+
+        owner = self.get_results_owner()
+        dest = self.get_results_dest_path()
+        if results_format != "dir":
+            dest += "." + results_format
+
+        with timer_print("Copying result artifacts to {}".format(dest)) as t:
+            if results_format == "dir":
+                counts = harvest_tree(self.get_results_src_path(), dest, owner, move=move)
+                verbose_message(" ".join(
+                    "{}={}".format(method, count) for method, count in sorted(counts.items())
+                ), end=" ")
+            else:
+                write_tarball(self.get_results_src_path(), dest, results_format, owner)
 
+        self.record_timing("results", t.took)
+        self.add_meta({"results": dest})
+        self.flush_meta()
+        return dest
 
     def has_results_files(self):
         return len(os.listdir(self.get_results_src_path())) > 0
 
 
 
-    def sync_workspace(self, source_dir):
-
+    def _check_workspace_source(self, source_dir):
         # sudo users can only sync files from their home directory
         if "SUDO_UID" in os.environ:
             home_dir = pwd.getpwuid(int(os.environ["SUDO_UID"])).pw_dir
             if not os.path.realpath(source_dir).startswith(home_dir):
                 raise RuntimeContainerError("Permission denied: sudo users can sync only their home directories")
 
-        with timer_print("Synchronizing {} to the container".format(source_dir)):
+    def sync_workspace(self, source_dir):
+        self._check_workspace_source(source_dir)
+
+        with timer_print("Synchronizing {} to the container".format(source_dir)) as t:
+            # Set the owner during the sync since the container might have
+            # been prepared already
             container_exec([
                 "rsync",
                 "-a",
+                "--chown={uid}:{uid}".format(uid=LXCI_UID),
                 source_dir,
                 self.get_path("/home/lxci/workspace"),
             ])
+        self.record_timing("sync", t.took)
+
+    def is_unprivileged(self):
+        for key in ("lxc.id_map", "lxc.idmap"):
+            try:
+                if self.container.get_config_item(key):
+                    return True
+            except KeyError:
+                pass
+        return False
+
+    def mount_workspace(self, source_dir):
+        """
+        Mount source_dir read-only to the workspace with a writable overlayfs
+        layer inside the container so that nothing is copied up front. The
+        trailing slash works like with sync_workspace(). Works only with
+        privileged containers since the overlay is mounted by lxc when the
+        container starts. Requires overlayfs with metacopy support. Without
+        it the chown of the workspace would copy up every file.
+        """
+        self._check_workspace_source(source_dir)
+
+        if self.container.state != "STOPPED":
+            raise RuntimeContainerError("Can mount the workspace only to stopped containers")
+        if self.is_unprivileged():
+            raise RuntimeContainerError("Mounting the workspace requires a privileged container")
+        if not has_overlay_metacopy():
+            raise RuntimeContainerError("Mounting the workspace requires overlayfs metacopy support")
+
+        lower = os.path.realpath(source_dir)
+        target = "home/lxci/workspace"
+        if not source_dir.endswith("/"):
+            target += "/" + os.path.basename(lower)
+
+        with self.staging() as staged:
+            staged.mkdir("/lxci/workspace/upper")
+            staged.mkdir("/lxci/workspace/work")
+
+        options = [
+            "lowerdir=" + lower,
+            "upperdir=" + self.get_path("/lxci/workspace/upper"),
+            "workdir=" + self.get_path("/lxci/workspace/work"),
+            "create=dir",
+        ]
+        # The chown below copies up only the metadata
+        options.append("metacopy=on")
+
+        with timer_print("Mounting {} to the container".format(source_dir)) as t:
+            assert_ret(
+                self.container.set_config_item(
+                    "lxc.mount.entry",
+                    "overlay {target} overlay {options} 0 0".format(target=target, options=",".join(options))
+                ),
+                "Failed to add the workspace mount"
+            )
+            assert_ret(self.container.save_config(), "Failed to save the container config")
+        self.record_timing("mount", t.took)
+
+        # Let the lxci user write to the workspace
+        self.add_prepare_command("chown -R lxci:lxci /home/lxci/workspace")
+
+    def staging(self):
+        """
+        Get a staging for writing multiple files and directories into the
+        container at once
+        """
+        return staging(self.get_rootfs_path())
 
     def write_file(self, content, dest, executable=False):
-        tmp_file = None
-        f = None
-        try:
-            tmp_file = os.path.join(tempfile.gettempdir() + "/lxci-" + str(uuid.uuid4()))
-            f = open(tmp_file, "w")
-            f.write(content)
-            f.flush()
-            if executable:
-                make_executable(tmp_file)
-            self.copy_file(tmp_file, dest)
-        finally:
-            if f:
-                f.close()
-            if tmp_file:
-                os.remove(tmp_file)
+        with self.staging() as staged:
+            staged.file(dest, content, 0o755 if executable else 0o644)
 
 
-    def run_command(self, command):
+    def get_exec_backend(self):
         """
-        Run given command in the container using SSH
+        Get the backend used to execute commands in the container. See
+        EXEC_BACKEND in the config
+        """
+        try:
+            return EXEC_BACKENDS[config.EXEC_BACKEND](self)
+        except KeyError:
+            raise RuntimeContainerError("Unknown EXEC_BACKEND {}. Expected one of {}".format(
+                config.EXEC_BACKEND, ", ".join(sorted(EXEC_BACKENDS))
+            ))
+
+    def get_log_path(self):
+        return os.path.join(config.RESULTS_PATH, self.get_name() + ".log")
+
+    def _open_build_log(self):
+        log = build_log(
+            self.get_log_path(),
+            compress=config.BUILD_LOG_COMPRESS,
+            max_size=config.BUILD_LOG_SIZE * 1024 * 1024,
+            owner=self.get_results_owner()
+        )
+        self.add_meta({"log": log.path})
+        return log
+
+    def run_command(self, command, log=True):
+        """
+        Run given command in the container using the exec backend. If log is
+        true and BUILD_LOG is set the output is also saved with timestamps to
+        RESULTS_PATH/NAME.log
+
+        returns object with returncode attribute
         """
 
         if self.container.state == "STOPPED":
@@ -291,25 +1188,81 @@ class RuntimeContainer():
         script += command
         script += "\n"
 
-        self.write_file(script, "/lxci/command.sh", True)
+        output_log = None
+        if log and config.BUILD_LOG:
+            output_log = self._open_build_log()
 
-        process_args = [
-            "ssh",
-            "-q", # Quiet mode
-            "-t", # Force pseudo-tty allocation
-            "-oStrictHostKeyChecking=no", # Skip the host key prompt
-            "-i", config.SSH_KEY_PATH, # Use our ssh key
-            "-l", "lxci", # Login as lxci user
-            self.container.get_ips()[0],
-            "/lxci/command.sh",
-        ]
+        with self.staging() as staged:
+            staged.file("/lxci/command.sh", script, 0o755)
+            self.flush_meta(staged)
 
         verbose_message("Executing: {}".format(command))
-        verbose_message("With: {}".format(process_args))
+        started = time.time()
+        try:
+            if output_log is None:
+                return self.get_exec_backend().run("/lxci/command.sh")
+            with output_log:
+                output_log.write_line("lxci: executing: {}".format(command))
+                result = self.get_exec_backend().run("/lxci/command.sh", log=output_log)
+                output_log.write_line("lxci: exit status {}".format(result.returncode))
+                return result
+        finally:
+            self.record_timing("command", time.time() - started)
 
-        cmd = subprocess.Popen(process_args, pass_fds=os.pipe())
-        cmd.wait()
-        return cmd
+    def run_steps(self, steps, fail_fast=False, log=True):
+        """
+        Run the steps, a list of (name, command) tuples, in order like
+        run_command(). Each step is run in a new shell in the workspace. The
+        exit status and duration of each step are saved to the steps list of
+        the meta data. With fail_fast the steps after a failed one are
+        skipped.
+
+        returns object with returncode attribute. It is the exit status of
+        the first failed step
+        """
+        if self.container.state == "STOPPED":
+            raise RuntimeContainerError("Can run commands only in running containers")
+
+        output_log = None
+        if log and config.BUILD_LOG:
+            output_log = self._open_build_log()
+
+        with self.staging() as staged:
+            for i, (name, command) in enumerate(steps):
+                staged.file("/lxci/steps/{}.sh".format(i), command_header + "\n" + command + "\n", 0o755)
+            self.flush_meta(staged)
+
+        returncode = 0
+        results = []
+        started = time.time()
+        try:
+            for i, (name, command) in enumerate(steps):
+                if returncode != 0 and fail_fast:
+                    results.append({"name": name, "skipped": True})
+                    continue
+                verbose_message("Executing step {}: {}".format(name, command))
+                step_started = time.time()
+                script_path = "/lxci/steps/{}.sh".format(i)
+                if output_log is None:
+                    result = self.get_exec_backend().run(script_path)
+                else:
+                    with output_log:
+                        output_log.write_line("lxci: step {}: executing: {}".format(name, command))
+                        result = self.get_exec_backend().run(script_path, log=output_log)
+                        output_log.write_line("lxci: step {}: exit status {}".format(name, result.returncode))
+                results.append({
+                    "name": name,
+                    "exit_code": result.returncode,
+                    "duration": round(time.time() - step_started, 3),
+                })
+                if result.returncode != 0:
+                    error_message("Step {} failed with exit status {}".format(name, result.returncode))
+                    if returncode == 0:
+                        returncode = result.returncode
+        finally:
+            self.add_meta({"steps": results})
+            self.record_timing("command", time.time() - started)
+        return CommandResult(returncode)
 
     def add_prepare_command(self, command):
         """
@@ -320,24 +1273,66 @@ class RuntimeContainer():
             raise RuntimeContainerError("Can only prepare stopped containers")
         self._prepare_commands.append(command)
 
+    def _write_prepare_script(self, staged):
+        # Containers cloned from a prepared container run only their own
+        # new commands
+        checksum = hashlib.sha256("\n".join(self._prepare_commands).encode()).hexdigest()
+        script = prepare_header.format(marker=PREPARED_MARKER, checksum=checksum)
+        script += "\n"
+        for command in self._prepare_commands:
+            script += command
+            script += "\n"
+        script += "echo {checksum} > {marker}\n".format(marker=PREPARED_MARKER, checksum=checksum)
+        staged.file(PREPARE_SH_PATH, script, 0o755)
+
+    def _get_prepare_failed_message(self):
+        return "Failed to prepare the container. Check {rootfs}/var/log/lxci-prepare.log".format(rootfs=self.get_rootfs_path())
+
     def prepare(self):
+        """
+        Run the prepare commands now by starting the container just for them.
+        start() runs them during the boot so this is only needed for
+        preparing containers ahead of time
+        """
         if self.container.state != "STOPPED":
             raise RuntimeContainerError("Can only prepare stopped containers")
 
-        prepare_sh_path = "/lxci/prepare.sh"
+        with timer_print("Preparing container") as t:
+            with self.staging() as staged:
+                self._write_prepare_script(staged)
+                self.flush_meta(staged)
+            assert_ret(
+                self.container.start(useinit=False, daemonize=False, close_fds=False, cmd=(PREPARE_SH_PATH,)),
+                self._get_prepare_failed_message()
+            )
+        self.record_timing("prepare", t.took)
+        self._prepare_commands = []
 
-        script = prepare_header
-        script += "\n"
-        for command in self._prepare_commands:
-            script += command
-            script += "\n"
+    def prepare_on_boot(self):
+        """
+        Run the prepare commands on the next boot of the container from a
+        lxc.hook.start hook. The hook is run in the container just before init
+        so the commands are done before sshd or anything else starts. The
+        script disables itself once it has succeeded.
+        """
+        if self.container.state != "STOPPED":
+            raise RuntimeContainerError("Can only prepare stopped containers")
 
-        with timer_print("Preparing container"):
-            self.write_file(script, prepare_sh_path, True)
+        with self.staging() as staged:
+            self._write_prepare_script(staged)
+            self.flush_meta(staged)
+
+        try:
+            hooks = self.container.get_config_item("lxc.hook.start")
+        except KeyError:
+            hooks = []
+        if PREPARE_SH_PATH not in hooks:
             assert_ret(
-                self.container.start(useinit=False, daemonize=False, close_fds=False, cmd=(prepare_sh_path,)),
-                "Failed to prepare the container. Check {rootfs}/var/log/lxci-prepare.log".format(rootfs=self.get_rootfs_path())
+                self.container.set_config_item("lxc.hook.start", PREPARE_SH_PATH),
+                "Failed to add the prepare hook"
             )
+            assert_ret(self.container.save_config(), "Failed to save the container config")
+        self._prepare_commands = []
 
     def get_path(self, path):
         """
@@ -354,8 +1349,8 @@ class RuntimeContainer():
         """
 
         verbose_message("Enabling sudo for the lxci user")
-        self.add_prepare_command("usermod -a -G sudo lxci")
-        self.add_prepare_command("echo '%lxci ALL=(ALL) NOPASSWD: ALL' >> /etc/sudoers")
+        for command in SUDO_PREPARE_COMMANDS:
+            self.add_prepare_command(command)
 
     def get_meta_filepath(self):
         return self.get_path("/lxci/meta")
@@ -364,8 +1359,28 @@ class RuntimeContainer():
         return os.path.exists(self.get_meta_filepath())
 
     def write_meta(self, meta):
-        data = json.dumps(meta, sort_keys=True, indent=4)
-        self.write_file(data, "/lxci/meta")
+        """
+        Replace the meta data. The change is kept in memory until
+        flush_meta() is called
+        """
+        self._meta = copy.deepcopy(meta)
+        self._meta_dirty = True
+
+    def flush_meta(self, staged=None):
+        """
+        Write pending meta data changes to the container and the index. With
+        staged the meta file is written along with the other staged changes.
+        """
+        if not self._meta_dirty:
+            return
+        if staged is None:
+            with self.staging() as staged:
+                self.flush_meta(staged)
+            return
+
+        self._meta_dirty = False
+        staged.file("/lxci/meta", json.dumps(self._meta, sort_keys=True, indent=4))
+        staged.after_apply(self.update_index)
 
     def read_meta(self):
         """
@@ -373,45 +1388,127 @@ class RuntimeContainer():
 
         returns dict
         """
+        if self._meta is not None:
+            return copy.deepcopy(self._meta)
         try:
             with open(self.get_meta_filepath(), "r") as f:
                 return json.load(f) or {}
         except FileNotFoundError:
             return {}
 
+    def get_config_path(self):
+        if self._container is None:
+            return self._config_path
+        return self.container.get_config_path()
+
+    def update_index(self):
+        """
+        Save the current meta data to the container index
+        """
+        get_index().update(
+            self.get_config_path(), self.get_name(), self.read_meta(), self.get_meta_filepath()
+        )
+
     def add_meta(self, meta):
         """
-        Merge dict into meta data
+        Merge dict into meta data. See write_meta()
         """
         old = self.read_meta()
         old.update(meta)
         self.write_meta(old)
 
+    def record_timing(self, phase, took):
+        """
+        Save duration of a phase in seconds to the timings of the meta data
+        """
+        meta = self.read_meta()
+        meta.setdefault("timings", {})[phase] = round(took, 3)
+        self.write_meta(meta)
+
 
     def archive(self):
         """
-        Archive the given container to ARCHIVE_CONFIG_PATH
+        Archive the given container to ARCHIVE_CONFIG_PATH.
+
+        The container directory is moved to the archive when it is on the same
+        filesystem. Otherwise overlayfs and aufs containers are cloned as
+        snapshots of the same base so that only the changes are copied. A full
+        copy to a directory backed container is made only when nothing else
+        works. The used strategy is saved to meta data as archive_strategy.
         """
+        import lxc
 
         archived_container = None
         self.stop()
+        self.flush_meta()
 
-        with timer_print("Archiving the container"):
-            if config.RUNTIME_CONFIG_PATH == config.ARCHIVE_CONFIG_PATH:
+        with timer_print("Archiving the container") as t:
+            if self.get_config_path() == config.ARCHIVE_CONFIG_PATH:
                 archived_container = self.container
+                strategy = "in-place"
             else:
-                os.makedirs(config.ARCHIVE_CONFIG_PATH, exist_ok=True)
-                archived_container = self.container.clone(
-                    self.container.name,
-                    config_path=config.ARCHIVE_CONFIG_PATH,
-                    bdevtype="dir"
-                )
-                assert_ret(archived_container, "Failed to archive the container")
-                assert_ret(self.container.destroy(), "Failed to destroy the runtime container after archiving")
-
-
+                try:
+                    archived_container = move_container(
+                        self.container, self.get_name(), config.ARCHIVE_CONFIG_PATH
+                    )
+                    strategy = "move"
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    archived_container, strategy = self._copy_to_archive()
+                    # lxc does not update all the paths, for example the
+                    # workspace mount entries
+                    _rewrite_config_paths(
+                        os.path.join(config.ARCHIVE_CONFIG_PATH, self.get_name()),
+                        os.path.join(self.get_config_path(), self.get_name()),
+                        self.get_name()
+                    )
+                    archived_container = lxc.Container(self.get_name(), config_path=config.ARCHIVE_CONFIG_PATH)
+                    assert_ret(self.container.destroy(), "Failed to destroy the runtime container after archiving")
+                    get_index().remove(self.get_config_path(), self.get_name())
+
+        verbose_message("Archived using {}".format(strategy))
+        self.record_timing("archive", t.took)
+        archived = RuntimeContainer(archived_container)
+        archived.add_meta({
+            "archive_strategy": strategy,
+            "archived": datetime.datetime.now().isoformat(),
+        })
+        if strategy not in ("move", "in-place"):
+            # The size of the runtime container does not apply to the copy.
+            # It is measured again when needed, see get_archive_size()
+            archived.add_meta({"size": None})
+        archived.record_timing("archive", t.took)
+        archived.flush_meta()
         return archived_container
 
+    def _copy_to_archive(self):
+        import lxc
+        os.makedirs(config.ARCHIVE_CONFIG_PATH, exist_ok=True)
+
+        rootfs = self.container.get_config_item("lxc.rootfs")
+        backingstore = rootfs.split(":")[0]
+        if backingstore in SNAPSHOT_BACKINGSTORES:
+            # The lower layer is the base container so the snapshot stays
+            # valid after the runtime container is destroyed
+            archived_container = self.container.clone(
+                self.get_name(),
+                config_path=config.ARCHIVE_CONFIG_PATH,
+                flags=lxc.LXC_CLONE_SNAPSHOT,
+                bdevtype=backingstore
+            )
+            if archived_container:
+                return archived_container, "snapshot"
+            error_message("Failed to archive the container as a snapshot. Copying it")
+
+        archived_container = self.container.clone(
+            self.get_name(),
+            config_path=config.ARCHIVE_CONFIG_PATH,
+            bdevtype="dir"
+        )
+        assert_ret(archived_container, "Failed to archive the container")
+        return archived_container, "copy"
+
     def copy_file(self, src, dest):
         """
         Copy file into the container. src is a path in the host and dest a container path
@@ -424,6 +1521,12 @@ class RuntimeContainer():
         """
         container_exec(["mkdir", "-p", self.get_path(path)])
 
+    def is_pool_container(self):
+        """
+        Return True if the container is waiting in the pool
+        """
+        return bool(self.read_meta().get("pool"))
+
     def is_lxci_container(self):
         """
         Return True if the container has been created by lxci
@@ -433,9 +1536,11 @@ class RuntimeContainer():
     def stop(self):
         if self.container.state == "STOPPED":
             return
-        with timer_print("Stopping the container"):
+        with timer_print("Stopping the container") as t:
+            self.get_exec_backend().close()
             assert_ret(self.container.stop(), "Failed to stop the container")
             self.container.wait("STOPPED", 60)
+        self.record_timing("stop", t.took)
 
     def is_stopped(self):
         return self.container.state == "STOPPED"
@@ -444,7 +1549,7 @@ class RuntimeContainer():
         if self.container.state != "STOPPED":
             self.stop()
 
-        with timer_print("Destroying container {}".format(self.get_name())):
+        with timer_print("Destroying container {}".format(self.get_name())) as t:
             was_success = self.container.destroy()
             if not was_success:
                 # XXX For unknown reason the container fails to be destroyed
@@ -457,17 +1562,87 @@ class RuntimeContainer():
                 time.sleep(5)
                 assert_ret(self.container.destroy(), "Failed to destroy the container")
 
-def create_runtime_container(base_container_name, runtime_container_name, snapshot=False, backingstore="dir"):
+        get_index().remove(self.get_config_path(), self.get_name())
+        # Kept only in memory for the timing history
+        self.record_timing("destroy", t.took)
+
+def _rewrite_config_paths(container_dir, old_dir, new_name):
+    """
+    Point paths in the container config from old_dir to container_dir and set
+    the hostname to new_name
+    """
+    config_file = os.path.join(container_dir, "config")
+    with open(config_file, "r") as f:
+        container_config = f.read()
+    container_config = container_config.replace(old_dir + "/", container_dir + "/")
+    container_config = re.sub(
+        r"^(lxc\.utsname|lxc\.uts\.name)\s*=.*$",
+        r"\1 = " + new_name,
+        container_config,
+        flags=re.MULTILINE
+    )
+    with open(config_file, "w") as f:
+        f.write(container_config)
+
+def move_container(container, new_name, config_path=None):
+    """
+    Move stopped container to new_name under config_path by renaming its
+    directory. Nothing is copied, only the paths in the container config and
+    the hostname are updated. Raises OSError with errno.EXDEV if the
+    directories are on different filesystems.
+
+    returns new lxc.Container
     """
-    Clone the base container and create lxci user for it
+    import lxc
+    if container.state != "STOPPED":
+        raise RuntimeContainerError("Can only move stopped containers")
+
+    old_config_path = container.get_config_path()
+    config_path = config_path or old_config_path
+    old_dir = os.path.join(old_config_path, container.name)
+    new_dir = os.path.join(config_path, new_name)
+
+    if os.path.exists(new_dir):
+        raise RuntimeContainerError("Cannot move container to {}: it already exists".format(new_dir))
+
+    os.makedirs(config_path, exist_ok=True)
+    os.rename(old_dir, new_dir)
+    get_index().remove(old_config_path, container.name)
+
+    _rewrite_config_paths(new_dir, old_dir, new_name)
+
+    moved = lxc.Container(new_name, config_path=config_path)
+    RuntimeContainer(moved).update_index()
+    if new_name != container.name:
+        hostname_files = [
+            RuntimeContainer(moved).get_path(p) for p in ("/etc/hostname", "/etc/hosts")
+        ]
+        hostname_files = [p for p in hostname_files if os.path.exists(p)]
+        if hostname_files:
+            container_exec([
+                "sed", "-i",
+                "s/\\b{old}\\b/{new}/g".format(old=container.name.replace(".", "\\."), new=new_name)
+            ] + hostname_files)
+
+    return moved
+
+def create_runtime_container(base_container_name, runtime_container_name, snapshot=False, backingstore="dir", config_path=None, tags=None):
+    """
+    Clone the base container and create lxci user for it. Without config_path
+    the runtime tier is chosen with choose_runtime_config_path() using the
+    tags
     """
+    import lxc
 
+    tier = None
+    if not config_path:
+        config_path = tier = choose_runtime_config_path(base_container_name, tags, snapshot)
     base_container = lxc.Container(base_container_name, config_path=config.BASE_CONFIG_PATH)
-    os.makedirs(config.RUNTIME_CONFIG_PATH, exist_ok=True)
+    os.makedirs(config_path, exist_ok=True)
 
     clone_kwargs = {
         "flags": 0,
-        "config_path": config.RUNTIME_CONFIG_PATH
+        "config_path": config_path
     }
 
     if snapshot:
@@ -477,27 +1652,34 @@ def create_runtime_container(base_container_name, runtime_container_name, snapsh
         clone_kwargs["bdevtype"] = backingstore
 
     container = None
-    with timer_print("Cloning container '{runtime}' using '{base}'".format(runtime=runtime_container_name, base=base_container_name)):
+    with timer_print("Cloning container '{runtime}' using '{base}'".format(runtime=runtime_container_name, base=base_container_name)) as t:
         container = base_container.clone(runtime_container_name, **clone_kwargs)
         assert_ret(container, "Error while creating the runtime container")
 
     runtime_container =  RuntimeContainer(container)
+    runtime_container.record_timing("clone", t.took)
 
-    # Create lxci directory
-    runtime_container.mkdirp("/lxci")
-    runtime_container.mkdirp("/home/lxci/.ssh")
-    runtime_container.mkdirp("/home/lxci/results")
-    runtime_container.mkdirp("/home/lxci/workspace")
-
-    runtime_container.add_prepare_command("adduser --system --uid 555 --shell /bin/bash --group lxci")
-    # Ensure the user can read everything in home
-    runtime_container.add_prepare_command("chown -R lxci:lxci /home/lxci")
-
-    runtime_container.copy_file(config.SSH_PUB_KEY_PATH, "/home/lxci/.ssh/authorized_keys")
+    for command in LXCI_USER_PREPARE_COMMANDS:
+        runtime_container.add_prepare_command(command)
 
     runtime_container.add_meta({
         "base": base_container_name,
+        "backingstore": runtime_container.get_backingstore(),
+        "snapshot": snapshot,
         "created": datetime.datetime.now().isoformat(),
     })
+    if tier:
+        runtime_container.add_meta({"tier": tier})
+
+    # Create lxci directories and files in one go
+    ensure_ssh_key()
+    with runtime_container.staging() as staged:
+        staged.mkdir("/lxci")
+        staged.mkdir("/home/lxci/.ssh")
+        staged.mkdir("/home/lxci/results")
+        staged.mkdir("/home/lxci/workspace")
+        staged.copy(config.SSH_PUB_KEY_PATH, "/home/lxci/.ssh/authorized_keys")
+        runtime_container.flush_meta(staged)
+
     return runtime_container
 
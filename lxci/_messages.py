@@ -0,0 +1,13 @@
+import sys
+
+from lxci import config
+
+
+def error_message(*a, **kw):
+    print(*a, file=sys.stderr, **kw)
+    sys.stderr.flush()
+
+def verbose_message(*a, **kw):
+    if config.VERBOSE:
+        print(*a, file=sys.stderr, **kw)
+        sys.stderr.flush()
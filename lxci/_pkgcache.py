@@ -0,0 +1,215 @@
+import os
+
+from lxci import config
+from lxci._lxci import (
+    LXCI_UID,
+    RuntimeContainerError,
+    assert_ret,
+    container_exec,
+    file_lock,
+    list_runtime_containers,
+    timer_print,
+    verbose_message,
+)
+
+# Container paths of the package caches
+APT_ARCHIVES_PATH = "/var/cache/apt/archives"
+PIP_CACHE_PATH = "/var/cache/lxci/pip"
+
+APT_CONF = 'Binary::apt::APT::Keep-Downloaded-Packages "true";\n'
+PIP_CONF = "[global]\ncache-dir = {}\n".format(PIP_CACHE_PATH)
+
+
+def get_package_cache_path(base_container_name):
+    return os.path.join(config.PACKAGE_CACHE_PATH, base_container_name)
+
+def _lock(base_container_name):
+    return file_lock(os.path.join(config.STATE_PATH, "package-cache-{}.lock".format(base_container_name)))
+
+def list_files(path):
+    """
+    returns list of (path, stat) tuples of the files under path
+    """
+    files = []
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            try:
+                files.append((filepath, os.lstat(filepath)))
+            except FileNotFoundError:
+                pass
+    return files
+
+def _list_debs(path):
+    try:
+        return set(f for f in os.listdir(path) if f.endswith(".deb"))
+    except FileNotFoundError:
+        return set()
+
+def remove_paths(paths):
+    """
+    rm -rf paths as root of the containers
+    """
+    if paths:
+        container_exec(["xargs", "-0", "rm", "-rf", "--"], input=b"\0".join(p.encode() for p in paths))
+
+def _deb_filename(package, version):
+    # "foo:amd64" and "1:2.0-1" from dpkg.log to foo_1%3a2.0-1_amd64.deb
+    name, _, arch = package.partition(":")
+    return "{}_{}_{}.deb".format(name, version.replace(":", "%3a"), arch)
+
+def read_installed_debs(dpkg_log, offset=0):
+    """
+    Read the packages installed after offset bytes of dpkg.log
+
+    returns set of .deb file names
+    """
+    debs = set()
+    try:
+        with open(dpkg_log, "r", errors="replace") as f:
+            f.seek(0, os.SEEK_END)
+            # The log was truncated
+            if f.tell() < offset:
+                offset = 0
+            f.seek(offset)
+            for line in f:
+                # 2024-01-01 12:00:00 install foo:amd64 <none> 1.0-1
+                parts = line.split()
+                if len(parts) == 6 and parts[2] in ("install", "upgrade"):
+                    debs.add(_deb_filename(parts[3], parts[5]))
+    except FileNotFoundError:
+        pass
+    return debs
+
+def select_evicted(files, max_size):
+    """
+    Select the least recently used files until the rest fits in max_size
+    megabytes. files is a list of (path, stat) tuples. The access time is
+    updated only once a day with relatime so the newer of the access and
+    modification time is used.
+
+    returns list of paths
+    """
+    budget = max_size * 1024 * 1024
+    total = sum(st.st_size for _, st in files)
+    evicted = []
+    for path, st in sorted(files, key=lambda f: max(f[1].st_atime, f[1].st_mtime)):
+        if total <= budget:
+            break
+        total -= st.st_size
+        evicted.append(path)
+    return evicted
+
+
+class PackageCache():
+    """
+    Host side download cache of apt and pip shared by the runtime containers
+    of a base container.
+
+    The pip cache is bind mounted to the containers as is since pip writes it
+    atomically. apt takes a lock in its archives directory so every
+    container gets its own archives directory which is filled with hardlinks
+    to the cached packages before the start. The newly downloaded packages
+    are linked back to the cache after the build. The cache is modified only
+    with container_exec() so that its files are owned by root of unprivileged
+    containers too.
+    """
+    def __init__(self, runtime_container):
+        self.runtime_container = runtime_container
+        self.base = runtime_container.read_meta()["base"]
+        self.path = get_package_cache_path(self.base)
+        self.apt_path = os.path.join(self.path, "apt")
+        self.pip_path = os.path.join(self.path, "pip")
+        self.job_path = os.path.join(self.path, "jobs", runtime_container.get_name())
+        self.seeded = set()
+        self.dpkg_log_offset = 0
+
+    def mount(self):
+        """
+        Seed the apt archives of the container and add the bind mounts to
+        the container config. The container must be stopped
+        """
+        container = self.runtime_container.container
+        if container.state != "STOPPED":
+            raise RuntimeContainerError("Can mount the package cache only to stopped containers")
+
+        with timer_print("Mounting the package cache of {}".format(self.base)) as t:
+            os.makedirs(os.path.join(self.path, "jobs"), exist_ok=True)
+            with _lock(self.base):
+                if not os.path.isdir(self.pip_path):
+                    container_exec(["mkdir", "-p", self.apt_path, self.pip_path])
+                    container_exec(["chown", "{uid}:{uid}".format(uid=LXCI_UID), self.pip_path])
+                remove_paths([self.job_path])
+                self.seeded = _list_debs(self.apt_path)
+                container_exec(["cp", "-al", self.apt_path, self.job_path])
+
+            for source, target in ((self.job_path, APT_ARCHIVES_PATH), (self.pip_path, PIP_CACHE_PATH)):
+                # optional: the job directory is gone when an archived
+                # container is inspected
+                assert_ret(
+                    container.set_config_item(
+                        "lxc.mount.entry",
+                        "{source} {target} none bind,create=dir,optional 0 0".format(source=source, target=target.lstrip("/"))
+                    ),
+                    "Failed to add the package cache mount"
+                )
+            assert_ret(container.save_config(), "Failed to save the container config")
+
+            with self.runtime_container.staging() as staged:
+                staged.file("/etc/apt/apt.conf.d/01lxci-package-cache", APT_CONF)
+                staged.file("/etc/xdg/pip/pip.conf", PIP_CONF)
+
+            try:
+                self.dpkg_log_offset = os.path.getsize(self.runtime_container.get_path("/var/log/dpkg.log"))
+            except FileNotFoundError:
+                pass
+        self.runtime_container.record_timing("package_cache", t.took)
+
+    def collect(self):
+        """
+        Add the packages downloaded by the build to the cache, evict the
+        least recently used files over PACKAGE_CACHE_SIZE and record the hits
+        and misses to the meta data
+        """
+        with timer_print("Collecting downloaded packages"):
+            installed = read_installed_debs(
+                self.runtime_container.get_path("/var/log/dpkg.log"), self.dpkg_log_offset
+            )
+            with _lock(self.base):
+                downloaded = sorted(_list_debs(self.job_path) - self.seeded)
+                hits = sorted(installed & self.seeded)
+                # Mark the used packages recently used for the eviction
+                if hits:
+                    container_exec(["touch", "-c", "--"] + [os.path.join(self.apt_path, d) for d in hits])
+                if downloaded:
+                    container_exec(["cp", "-l", "-n", "--"] + [os.path.join(self.job_path, d) for d in downloaded] + [self.apt_path])
+                downloaded_bytes = sum(os.path.getsize(os.path.join(self.job_path, d)) for d in downloaded)
+                remove_paths([self.job_path])
+                evicted = self.evict()
+
+        self.runtime_container.add_meta({"package_cache": {
+            "hits": len(hits),
+            "misses": len(installed - self.seeded),
+            "downloaded": downloaded,
+            "downloaded_bytes": downloaded_bytes,
+            "evicted": evicted,
+        }})
+
+    def evict(self):
+        """
+        Remove the least recently used files over PACKAGE_CACHE_SIZE and job
+        directories left behind by crashed builds. The cache lock must be held
+
+        returns number of evicted files
+        """
+        jobs_path = os.path.join(self.path, "jobs")
+        running = set(list_runtime_containers())
+        remove_paths([os.path.join(jobs_path, name) for name in os.listdir(jobs_path) if name not in running])
+
+        if not config.PACKAGE_CACHE_SIZE:
+            return 0
+        evicted = select_evicted(list_files(self.apt_path) + list_files(self.pip_path), config.PACKAGE_CACHE_SIZE)
+        if evicted:
+            verbose_message("Evicting {} files from the package cache of {}".format(len(evicted), self.base))
+            remove_paths(evicted)
+        return len(evicted)
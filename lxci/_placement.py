@@ -0,0 +1,29 @@
+import os
+
+
+def get_free_space(path):
+    """
+    returns free space of the filesystem of path in bytes
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def choose_tier(config_paths, expected_size, reserve, snapshot=False):
+    """
+    Choose the first runtime config path with room for a container of
+    expected_size bytes plus reserve bytes. A full clone of unknown size is
+    as big as the base container so it goes to the last tier which is
+    expected to be on a disk. Snapshots of unknown size only store the
+    changes and need just the reserve.
+
+    returns the chosen config path
+    """
+    if expected_size is None and not snapshot:
+        return config_paths[-1]
+
+    needed = (expected_size or 0) + reserve
+    for path in config_paths[:-1]:
+        os.makedirs(path, exist_ok=True)
+        if get_free_space(path) >= needed:
+            return path
+    return config_paths[-1]
@@ -0,0 +1,129 @@
+import datetime
+import os
+import uuid
+
+from lxci import config
+from lxci._lxci import (
+    RuntimeContainerError,
+    create_runtime_container,
+    error_message,
+    file_lock,
+    list_pool_containers,
+    move_container,
+    verbose_message,
+    RuntimeContainer,
+)
+
+POOL_STATES = ("prepared", "booted")
+
+def _pool_lock_path(name):
+    return os.path.join(config.STATE_PATH, "pool-{}.lock".format(name))
+
+def _matches(meta, base_container_name, sudo):
+    return meta.get("base") == base_container_name and meta.get("sudo", False) == sudo
+
+def count_pool_containers(base_container_name, sudo=False):
+    """
+    Count ready and filling pool containers of the base container
+    """
+    return len([
+        c for c in list_pool_containers(return_object=True)
+        if _matches(c.read_meta(), base_container_name, sudo)
+    ])
+
+def create_pool_container(base_container_name, sudo=False, snapshot=False, backingstore=None):
+    """
+    Clone and prepare a new container into the pool. If POOL_STATE is booted
+    the container is also started and left running.
+    """
+    if config.POOL_STATE not in POOL_STATES:
+        raise RuntimeContainerError("Invalid POOL_STATE {}. Expected one of {}".format(
+            config.POOL_STATE, ", ".join(POOL_STATES)
+        ))
+
+    name = "{base}-pool-{id}".format(base=base_container_name, id=uuid.uuid4().hex[:8])
+    runtime_container = create_runtime_container(
+        base_container_name, name, snapshot=snapshot, backingstore=backingstore
+    )
+    # Mark as pool container right away so that it is never listed as a
+    # runtime container but do not let anyone take it before it is ready
+    runtime_container.add_meta({"pool": "filling", "sudo": sudo})
+    runtime_container.flush_meta()
+
+    try:
+        if sudo:
+            runtime_container.enable_sudo()
+        if config.POOL_STATE == "booted":
+            runtime_container.start()
+        else:
+            runtime_container.prepare()
+    except Exception:
+        runtime_container.destroy()
+        raise
+
+    runtime_container.add_meta({"pool": "ready"})
+    runtime_container.flush_meta()
+    return runtime_container
+
+def fill_pool(base_container_name, size=None, sudo=False, snapshot=False, backingstore=None):
+    """
+    Create pool containers until there are size of them. Returns immediately
+    if the pool of the base container is already being filled by someone else.
+
+    returns the number of created containers
+    """
+    if size is None:
+        size = config.POOL_SIZE
+
+    created = 0
+    try:
+        with file_lock(_pool_lock_path("fill-" + base_container_name), blocking=False):
+            while count_pool_containers(base_container_name, sudo=sudo) < size:
+                container = create_pool_container(
+                    base_container_name, sudo=sudo, snapshot=snapshot, backingstore=backingstore
+                )
+                verbose_message("Added {} to the pool".format(container.get_name()))
+                created += 1
+    except BlockingIOError:
+        verbose_message("Pool of {} is already being filled".format(base_container_name))
+
+    return created
+
+def take_pool_container(base_container_name, name=None, sudo=False):
+    """
+    Take a ready container from the pool. If name is given the container is
+    renamed to it. Booted containers cannot be renamed so they are skipped when
+    a name is requested.
+
+    returns RuntimeContainer or None if the pool had no suitable containers
+    """
+    with file_lock(_pool_lock_path("take")):
+        for runtime_container in list_pool_containers(return_object=True):
+            meta = runtime_container.read_meta()
+            if meta.get("pool") != "ready" or not _matches(meta, base_container_name, sudo):
+                continue
+
+            if name and name != runtime_container.get_name():
+                if not runtime_container.is_stopped():
+                    continue
+                try:
+                    runtime_container = RuntimeContainer(
+                        move_container(runtime_container.container, name)
+                    )
+                except OSError as e:
+                    error_message("Failed to rename pool container {}: {}".format(
+                        runtime_container.get_name(), e
+                    ))
+                    continue
+
+            del meta["pool"]
+            # Filling the pool is not part of the build
+            if "timings" in meta:
+                meta["pool_timings"] = meta.pop("timings")
+            meta["taken"] = datetime.datetime.now().isoformat()
+            runtime_container.write_meta(meta)
+            runtime_container.flush_meta()
+            verbose_message("Took {} from the pool".format(runtime_container.get_name()))
+            return runtime_container
+
+    return None
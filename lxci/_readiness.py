@@ -0,0 +1,162 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import socket
+import time
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# TCP socket state of listening sockets in /proc/net/tcp
+TCP_LISTEN = "0A"
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+
+class inotify_watch():
+    """
+    Watch directories for created and written files with inotify(7).
+
+    Missing directories are ignored. If nothing could be watched wait() just
+    sleeps so callers can always use it as their sleep.
+    """
+    def __init__(self, paths, mask=IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_MODIFY):
+        self.paths = paths
+        self.mask = mask
+        self.fd = None
+
+    def __enter__(self):
+        existing = [p for p in self.paths if os.path.isdir(p)]
+        if not existing:
+            return self
+        try:
+            libc = _get_libc()
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return self
+        if fd < 0:
+            return self
+
+        watches = 0
+        for path in existing:
+            if libc.inotify_add_watch(fd, os.fsencode(path), self.mask) >= 0:
+                watches += 1
+
+        if watches:
+            self.fd = fd
+        else:
+            os.close(fd)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def is_watching(self):
+        return self.fd is not None
+
+    def wait(self, timeout):
+        """
+        Wait until something happens in the watched directories or timeout
+        seconds have passed. Returns True if woken up by an event
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+
+        # Drain the events. We only care that something happened
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+
+def wait_until(check, timeout, watch_paths=(), max_interval=0.5):
+    """
+    Call check until it returns a true value and return the value. Between the
+    checks sleep until something happens in watch_paths. Without inotify the
+    sleep time is backed off exponentially up to max_interval.
+
+    Raises TimeoutError after timeout seconds
+    """
+    started = time.time()
+    delay = 0.01
+    with inotify_watch(watch_paths) as watch:
+        while True:
+            result = check()
+            if result:
+                return result
+
+            remaining = timeout - (time.time() - started)
+            if remaining <= 0:
+                raise TimeoutError()
+
+            if watch.is_watching():
+                watch.wait(min(max_interval, remaining))
+            else:
+                watch.wait(min(delay, remaining))
+                delay = min(delay * 2, max_interval)
+
+
+def is_listening(pid, port):
+    """
+    Return True if there is a TCP socket listening on port in the network
+    namespace of the process. Returns None if it cannot be determined
+    """
+    if not pid or pid < 0:
+        return None
+
+    found_table = False
+    for table in ("tcp", "tcp6"):
+        try:
+            with open("/proc/{pid}/net/{table}".format(pid=pid, table=table), "r") as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+
+        found_table = True
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            local_port = int(fields[1].rsplit(":", 1)[1], 16)
+            if local_port == port and fields[3] == TCP_LISTEN:
+                return True
+
+    if not found_table:
+        return None
+    return False
+
+
+def has_ssh_banner(address):
+    """
+    Connect once to address (tuple of host and port) and return True if a SSH
+    server answers
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(1)
+    try:
+        s.connect(address)
+        return b'SSH' in s.recv(5)
+    except socket.error:
+        return False
+    finally:
+        s.close()
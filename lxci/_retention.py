@@ -0,0 +1,130 @@
+import datetime
+import os
+
+from lxci import config
+from lxci._lxci import (
+    file_lock,
+    list_archived_containers,
+    verbose_message,
+)
+from lxci._bulk import run_bulk
+
+
+def _parse_time(value):
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def get_archived_time(container):
+    """
+    returns datetime when the container was archived
+    """
+    meta = container.read_meta()
+    for key in ("archived", "stopped", "created"):
+        archived = _parse_time(meta.get(key))
+        if archived:
+            return archived
+    # Archived by an old lxci version
+    path = os.path.join(container.get_config_path(), container.get_name())
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+def get_archive_size(container):
+    """
+    Get the disk usage of the archived container from the meta data. It is
+    measured and saved only once so that the rootfs is not walked on every
+    garbage collection. The size is recorded from the runtime container only
+    when there are runtime tiers, and archive() clears it for the copied
+    containers, so it is measured here when missing.
+
+    returns size in bytes
+    """
+    size = container.read_meta().get("size")
+    if size is None:
+        size = container.get_disk_usage()
+        container.add_meta({"size": size})
+        container.flush_meta()
+    return size
+
+def _value(container):
+    # Archives of successful builds are less valuable than the failed ones
+    # which are kept for inspection. Older ones are less valuable than newer
+    meta = container.read_meta()
+    return (meta.get("exit_code", 1) != 0, get_archived_time(container))
+
+def select_expired(containers, max_age=0, max_per_tag=0, max_size=0, now=None):
+    """
+    Select archived containers to destroy: the ones older than max_age days,
+    the ones over the max_per_tag newest of each of their tags and then the
+    least valuable ones until the rest fits in max_size megabytes. 0 disables
+    the limit.
+
+    returns list of (container, reason) tuples
+    """
+    now = now or datetime.datetime.now()
+    expired = {}
+
+    if max_age:
+        oldest = now - datetime.timedelta(days=max_age)
+        for c in containers:
+            if get_archived_time(c) < oldest:
+                expired.setdefault(c.get_name(), (c, "older than {} days".format(max_age)))
+
+    if max_per_tag:
+        by_tag = {}
+        for c in containers:
+            for tag in c.get_tags() or ["default"]:
+                by_tag.setdefault(tag, []).append(c)
+        for tag, tagged in sorted(by_tag.items()):
+            tagged.sort(key=get_archived_time, reverse=True)
+            for c in tagged[max_per_tag:]:
+                expired.setdefault(c.get_name(), (c, "more than {} archives with tag {}".format(max_per_tag, tag)))
+
+    if max_size:
+        budget = max_size * 1024 * 1024
+        kept = [c for c in containers if c.get_name() not in expired]
+        total = sum(get_archive_size(c) for c in kept)
+        for c in sorted(kept, key=_value):
+            if total <= budget:
+                break
+            total -= get_archive_size(c)
+            expired[c.get_name()] = (c, "archive over {} MB".format(max_size))
+
+    return sorted(expired.values(), key=lambda e: e[0].get_name())
+
+def _destroy_expired(dry_run, jobs):
+    expired = select_expired(
+        list_archived_containers(return_object=True),
+        max_age=config.ARCHIVE_MAX_AGE,
+        max_per_tag=config.ARCHIVE_MAX_PER_TAG,
+        max_size=config.ARCHIVE_MAX_SIZE,
+    )
+    for c, reason in expired:
+        verbose_message("{} archived container {}: {}".format(
+            "Would destroy" if dry_run else "Destroying", c.get_name(), reason
+        ))
+    if dry_run:
+        return [(c.get_name(), reason) for c, reason in expired]
+
+    failed = run_bulk("destroy", [c for c, _ in expired], jobs=jobs)
+    return [(c.get_name(), reason) for c, reason in expired if c.get_name() not in failed]
+
+def collect_garbage(dry_run=False, jobs=None):
+    """
+    Destroy archived containers according to ARCHIVE_MAX_AGE,
+    ARCHIVE_MAX_PER_TAG and ARCHIVE_MAX_SIZE. If another garbage collection
+    is already running nothing is done.
+
+    returns list of (name, reason) tuples of the destroyed containers
+    """
+    if not (config.ARCHIVE_MAX_AGE or config.ARCHIVE_MAX_PER_TAG or config.ARCHIVE_MAX_SIZE):
+        return []
+
+    try:
+        with file_lock(os.path.join(config.STATE_PATH, "gc.lock"), blocking=False):
+            return _destroy_expired(dry_run, jobs)
+    except BlockingIOError:
+        verbose_message("Garbage collection is already running")
+        return []
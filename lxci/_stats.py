@@ -0,0 +1,171 @@
+import datetime
+import json
+import math
+import os
+import sys
+
+from lxci import config
+
+# Phases in the order they happen. Used for sorting the stats
+PHASES = (
+    "cache_build", "clone", "prepare", "mount", "sync", "restore", "boot",
+    "ready_marker", "network", "ssh", "command", "stop", "results", "archive", "destroy",
+)
+
+GROUP_BY_KEYS = ("base", "backingstore", "tag")
+
+def get_history_path():
+    return os.path.join(config.STATE_PATH, "history.jsonl")
+
+def append_history(runtime_container):
+    """
+    Append the phase timings of the finished runtime container to the
+    history. When the history grows over HISTORY_SIZE megabytes it is rotated
+    to history.jsonl.1 replacing the previous one.
+    """
+    # Imported here so that --stats does not load the container code
+    from lxci._lxci import file_lock
+    meta = runtime_container.read_meta()
+    entry = {
+        "name": runtime_container.get_name(),
+        "base": meta.get("base"),
+        "backingstore": meta.get("backingstore"),
+        "tags": meta.get("tags", []),
+        "exit_code": meta.get("exit_code"),
+        "finished": datetime.datetime.now().isoformat(),
+        "timings": meta.get("timings", {}),
+        "resources": meta.get("resources", {}),
+        "size": meta.get("size"),
+    }
+
+    path = get_history_path()
+    with file_lock(path + ".lock"):
+        try:
+            if os.path.getsize(path) > config.HISTORY_SIZE * 1024 * 1024:
+                os.replace(path, path + ".1")
+        except FileNotFoundError:
+            pass
+        with open(path, "a") as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+def read_history():
+    """
+    returns list of history entries from the oldest to the newest
+    """
+    path = get_history_path()
+    entries = []
+    for p in (path + ".1", path):
+        try:
+            with open(p, "r") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Partially written line
+                        continue
+        except FileNotFoundError:
+            pass
+    return entries
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of the values
+    """
+    values = sorted(values)
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[rank - 1]
+
+def _phase_order(phase):
+    try:
+        return (PHASES.index(phase), phase)
+    except ValueError:
+        return (len(PHASES), phase)
+
+def compute_stats(entries, group_by="base"):
+    """
+    Compute count, p50, p95, max and sum of each phase grouped by base,
+    backingstore or tag. Entries with multiple tags are counted in each of
+    them.
+
+    returns list of dicts sorted by group and phase
+    """
+    if group_by not in GROUP_BY_KEYS:
+        raise ValueError("Unknown group {}. Expected one of {}".format(group_by, ", ".join(GROUP_BY_KEYS)))
+
+    durations = {}
+    for entry in entries:
+        if group_by == "tag":
+            groups = entry.get("tags") or ["default"]
+        else:
+            groups = [entry.get(group_by) or "unknown"]
+        for group in groups:
+            for phase, took in entry.get("timings", {}).items():
+                durations.setdefault((group, phase), []).append(took)
+
+    stats = []
+    for group, phase in sorted(durations, key=lambda k: (k[0], _phase_order(k[1]))):
+        values = durations[(group, phase)]
+        stats.append({
+            "group": group,
+            "phase": phase,
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "max": max(values),
+            "sum": sum(values),
+        })
+    return stats
+
+def print_stats(stats, group_by="base", file=sys.stdout):
+    """
+    Print the stats as a table
+    """
+    group_width = max([len(group_by)] + [len(s["group"]) for s in stats])
+    phase_width = max([len("PHASE")] + [len(s["phase"]) for s in stats])
+    row = "{group:<{gw}}  {phase:<{pw}}  {count:>6}  {p50:>8}  {p95:>8}  {max:>8}"
+    print(row.format(
+        group=group_by.upper(), phase="PHASE", count="COUNT", p50="P50", p95="P95", max="MAX",
+        gw=group_width, pw=phase_width
+    ), file=file)
+    for s in stats:
+        print(row.format(
+            group=s["group"],
+            phase=s["phase"],
+            count=s["count"],
+            p50="{:.2f}s".format(s["p50"]),
+            p95="{:.2f}s".format(s["p95"]),
+            max="{:.2f}s".format(s["max"]),
+            gw=group_width,
+            pw=phase_width
+        ), file=file)
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def write_prometheus_textfile(stats, path, group_by="base"):
+    """
+    Write the stats in the Prometheus text format for the textfile collector
+    of node_exporter. The file is replaced atomically.
+    """
+    lines = [
+        "# HELP lxci_phase_seconds Duration of the lxci container phases",
+        "# TYPE lxci_phase_seconds summary",
+    ]
+    max_lines = [
+        "# HELP lxci_phase_seconds_max Maximum duration of the lxci container phases",
+        "# TYPE lxci_phase_seconds_max gauge",
+    ]
+    for s in stats:
+        labels = '{key}="{group}",phase="{phase}"'.format(
+            key=group_by, group=_escape_label(s["group"]), phase=_escape_label(s["phase"])
+        )
+        for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+            lines.append('lxci_phase_seconds{{{labels},quantile="{q}"}} {v}'.format(labels=labels, q=quantile, v=s[key]))
+        lines.append("lxci_phase_seconds_sum{{{labels}}} {v}".format(labels=labels, v=s["sum"]))
+        lines.append("lxci_phase_seconds_count{{{labels}}} {v}".format(labels=labels, v=s["count"]))
+        max_lines.append("lxci_phase_seconds_max{{{labels}}} {v}".format(labels=labels, v=s["max"]))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines + max_lines) + "\n")
+    os.replace(tmp_path, path)
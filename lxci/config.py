@@ -1,9 +1,11 @@
-import lxc
+"""
+lxCI configuration. The config file is read and the values are resolved on
+the first access of a value so that importing this module is cheap. The
+directories are created when their path is first used.
+"""
 import os
 import configparser
 import getpass
-import subprocess
-import sys
 import grp, pwd
 from os.path import join
 
@@ -16,14 +18,18 @@ if getpass.getuser() != "root":
 
 # LXCI_HOME overrides everything
 _home = os.environ.get("LXCI_HOME", _home)
-# ensure it exists
-os.makedirs(_home, exist_ok=True)
 
 # default paths
 RUNTIME_CONFIG_PATH = "/var/lib/lxci/runtime"
 ARCHIVE_CONFIG_PATH = "/var/lib/lxci/archive"
 RESULTS_PATH = "/var/lib/lxci/results"
+STATE_PATH = "/var/lib/lxci/state"
+CACHE_CONFIG_PATH = "/var/lib/lxci/cache"
+PACKAGE_CACHE_PATH = "/var/lib/lxci/packages"
+BUILD_CACHE_PATH = "/var/lib/lxci/build-cache"
+EXPORT_PATH = "/var/lib/lxci/exports"
 RESULTS_OWNER = os.environ.get("SUDO_USER", getpass.getuser())
+# Defaults to the primary group of RESULTS_OWNER
 RESULTS_GROUP = None
 
 # non-root cannot write to the default paths
@@ -31,41 +37,213 @@ if getpass.getuser() != "root":
     RUNTIME_CONFIG_PATH = join(_home, "runtime")
     ARCHIVE_CONFIG_PATH = join(_home, "archive")
     RESULTS_PATH = join(_home, "results")
+    STATE_PATH = join(_home, "state")
+    CACHE_CONFIG_PATH = join(_home, "cache")
+    PACKAGE_CACHE_PATH = join(_home, "packages")
+    BUILD_CACHE_PATH = join(_home, "build-cache")
+    EXPORT_PATH = join(_home, "exports")
 
 
-# use lxc default path for the base containers
-BASE_CONFIG_PATH = lxc.default_config_path
+# Defaults to the lxc default path
+BASE_CONFIG_PATH = None
 
 SSH_KEY_PATH = join(_home, "key")
 SSH_PUB_KEY_PATH = join(_home, "key.pub")
 VERBOSE = False
 
-# load customizations
-try:
-    with open(join(_home, "config"), "r") as _f:
-        _parser = configparser.ConfigParser()
-        _parser.read_string("[default]\n" + _f.read())
-        for _key, _value in _parser["default"].items():
-            globals()[_key.upper()] = _value
-except FileNotFoundError:
-    pass
-
-VERBOSE = bool(VERBOSE)
-
-# If not specified default to primary group of the owner
-if not RESULTS_GROUP:
-    _res_gid = pwd.getpwnam(RESULTS_OWNER).pw_gid
-    RESULTS_GROUP = grp.getgrgid(_res_gid).gr_name
-
-with open(os.path.join(_dir, "VERSION"), "r") as _f:
-    VERSION = _f.read().strip()
-
-# ensure rest of the directories
-os.makedirs(BASE_CONFIG_PATH, exist_ok=True)
-os.makedirs(RUNTIME_CONFIG_PATH, exist_ok=True)
-os.makedirs(ARCHIVE_CONFIG_PATH, exist_ok=True)
-os.makedirs(RESULTS_PATH, exist_ok=True)
-
-if not os.path.exists(SSH_KEY_PATH):
-    print("ssh key missing. Generating", SSH_KEY_PATH, file=sys.stderr)
-    subprocess.check_call(["ssh-keygen", "-q", "-N", "", "-f", SSH_KEY_PATH])
+# Number of ready containers kept in the pool for each base container
+POOL_SIZE = 2
+# prepared or booted
+POOL_STATE = "prepared"
+
+# Seconds to wait for each phase of the container start
+BOOT_TIMEOUT = 60
+NETWORK_TIMEOUT = 10
+SSH_TIMEOUT = 10
+READY_TIMEOUT = 60
+# Container path of a file written by the container when it is ready. If set
+# it is waited for instead of the network and the SSH server
+READY_MARKER = ""
+
+# How the commands are executed in the container: ssh or attach
+EXEC_BACKEND = "ssh"
+
+# Number of jobs run concurrently by --batch and containers stopped or
+# destroyed concurrently
+JOBS = 4
+
+# Format of the result artifacts: dir, tar, tar.gz, tar.xz or tar.zst
+RESULTS_FORMAT = "dir"
+
+# How --sync gets the workspace to the container: rsync or mount
+SYNC_MODE = "rsync"
+
+# Number of prepared base containers kept for --cache
+CACHE_SIZE = 4
+
+# Share the apt and pip downloads of the builds of each base container
+PACKAGE_CACHE = 0
+# Megabytes of package cache kept for each base container. The least
+# recently used files are evicted first. 0 for no limit
+PACKAGE_CACHE_SIZE = 2048
+
+# Megabytes of --build-cache kept for each tag. The least recently used files
+# are evicted first. 0 for no limit
+BUILD_CACHE_SIZE = 4096
+
+# Megabytes of phase timing history kept in STATE_PATH for --stats
+HISTORY_SIZE = 10
+
+# Save the output of the commands with timestamps to RESULTS_PATH/NAME.log
+BUILD_LOG = 1
+# gzip the build log
+BUILD_LOG_COMPRESS = 0
+# Megabytes of the build log kept. The oldest half is dropped when full. 0
+# for no limit
+BUILD_LOG_SIZE = 100
+
+# Comma separated runtime paths, for example on tmpfs, used before
+# RUNTIME_CONFIG_PATH when they have room for the container
+RUNTIME_TIERS = ""
+# Megabytes kept free in a runtime tier in addition to the expected size of
+# the container
+RUNTIME_TIER_RESERVE = 512
+
+# Retention of the archived containers for --gc. Days, archives per tag and
+# megabytes of all archives. 0 for no limit
+ARCHIVE_MAX_AGE = 0
+ARCHIVE_MAX_PER_TAG = 0
+ARCHIVE_MAX_SIZE = 0
+# Run --gc after each build
+GC_AFTER_BUILD = 0
+
+# cgroup limits of the runtime containers. Memory in bytes with an optional
+# K, M or G suffix. Empty or 0 for no limit
+MEMORY_LIMIT = ""
+CPU_SHARES = 0
+BLKIO_WEIGHT = 0
+
+# Submit non-interactive builds to lxcid when it is running
+USE_DAEMON = 0
+# Unix socket of lxcid. DEFAULT: STATE_PATH/lxcid.sock
+DAEMON_SOCKET = ""
+# Group allowed to submit jobs to lxcid. Only root if empty
+DAEMON_GROUP = ""
+# Maximum number of jobs run by lxcid at the same time. 0 for the CPU count
+DAEMON_MAX_JOBS = 0
+# Megabytes of available memory and free runtime disk space lxcid requires
+# for each starting job
+DAEMON_JOB_MEMORY = 1024
+DAEMON_JOB_DISK = 2048
+# lxcid does not start new jobs when the load average per CPU is over this
+DAEMON_MAX_LOAD = 1.0
+
+# Moved out of the module namespace so that __getattr__() is called for them
+_defaults = dict((_key, _value) for _key, _value in globals().items() if _key.isupper())
+for _key in _defaults:
+    del globals()[_key]
+
+_int_keys = (
+    "POOL_SIZE", "BOOT_TIMEOUT", "NETWORK_TIMEOUT", "SSH_TIMEOUT", "READY_TIMEOUT",
+    "JOBS", "CACHE_SIZE", "HISTORY_SIZE", "BUILD_LOG_SIZE", "CPU_SHARES",
+    "BLKIO_WEIGHT", "DAEMON_MAX_JOBS", "DAEMON_JOB_MEMORY", "DAEMON_JOB_DISK",
+    "ARCHIVE_MAX_AGE", "ARCHIVE_MAX_PER_TAG", "ARCHIVE_MAX_SIZE",
+    "RUNTIME_TIER_RESERVE", "PACKAGE_CACHE_SIZE", "BUILD_CACHE_SIZE",
+)
+_bool_keys = ("BUILD_LOG", "BUILD_LOG_COMPRESS", "USE_DAEMON", "GC_AFTER_BUILD", "PACKAGE_CACHE")
+_float_keys = ("DAEMON_MAX_LOAD",)
+
+# Created on the first use of the path
+_dirs = (
+    "BASE_CONFIG_PATH", "RUNTIME_CONFIG_PATH", "ARCHIVE_CONFIG_PATH",
+    "RESULTS_PATH", "STATE_PATH", "CACHE_CONFIG_PATH", "PACKAGE_CACHE_PATH",
+    "BUILD_CACHE_PATH", "EXPORT_PATH",
+)
+
+# Resolved config values
+_values = None
+
+
+def _load():
+    """
+    Read the config file on top of the defaults
+
+    returns dict of the config values
+    """
+    values = dict(_defaults)
+    try:
+        with open(join(_home, "config"), "r") as f:
+            parser = configparser.ConfigParser()
+            parser.read_string("[default]\n" + f.read())
+            for key, value in parser["default"].items():
+                values[key.upper()] = value
+    except FileNotFoundError:
+        pass
+
+    values["VERBOSE"] = bool(values["VERBOSE"])
+    for key in _int_keys:
+        values[key] = int(values[key])
+    for key in _bool_keys:
+        values[key] = bool(int(values[key]))
+    for key in _float_keys:
+        values[key] = float(values[key])
+
+    if not values["DAEMON_SOCKET"]:
+        values["DAEMON_SOCKET"] = join(values["STATE_PATH"], "lxcid.sock")
+
+    return values
+
+
+def _get_base_config_path():
+    # lxc is imported only for this
+    import lxc
+    return lxc.default_config_path
+
+def _get_results_group():
+    gid = pwd.getpwnam(_get("RESULTS_OWNER")).pw_gid
+    return grp.getgrgid(gid).gr_name
+
+def _get_version():
+    with open(os.path.join(_dir, "VERSION"), "r") as f:
+        return f.read().strip()
+
+# Values which are expensive to resolve and are resolved only when not set
+_resolvers = {
+    "BASE_CONFIG_PATH": _get_base_config_path,
+    "RESULTS_GROUP": _get_results_group,
+    "VERSION": _get_version,
+}
+
+
+def _get(name):
+    try:
+        return globals()[name]
+    except KeyError:
+        return __getattr__(name)
+
+def __getattr__(name):
+    global _values
+    if not name.isupper():
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    if _values is None:
+        _values = _load()
+
+    value = _values.get(name)
+    if not value and name in _resolvers:
+        value = _resolvers[name]()
+    elif name not in _values:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    if name in _dirs:
+        os.makedirs(value, exist_ok=True)
+
+    # Values set by lxci, for example VERBOSE for --verbose, are already in
+    # the module namespace and never get here
+    globals()[name] = value
+    return value
+
+def __dir__():
+    global _values
+    if _values is None:
+        _values = _load()
+    return sorted(set(globals()) | set(_values) | set(_resolvers))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import signal
+import sys
+import threading
+
+import lxci
+from lxci import config, verbose_message
+
+parser = argparse.ArgumentParser(
+    description="lxcid - Run lxci builds when the host has capacity for them",
+    epilog="lxci submits the builds to lxcid when USE_DAEMON is set in the config. Use environment variable LXCI_HOME to set custom path to configuration file"
+)
+parser.add_argument("-s", "--socket", metavar="PATH", dest="socket", help="path of the Unix socket to listen. DEFAULT: DAEMON_SOCKET from the config")
+parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="be verbose")
+
+
+def get_lxci_command():
+    # lxci is installed next to lxcid
+    bin_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+    for name in ("lxci.py", "lxci"):
+        path = os.path.join(bin_dir, name)
+        if os.path.exists(path):
+            return [sys.executable, path]
+    sys.exit("lxci not found in {}".format(bin_dir))
+
+
+def main():
+    args = parser.parse_args()
+    if args.verbose:
+        config.VERBOSE = True
+
+    server = lxci.create_daemon(get_lxci_command(), socket_path=args.socket)
+
+    def shutdown(signum, frame):
+        # shutdown() waits for serve_forever() so it cannot be called from
+        # the same thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    verbose_message("Listening on {}".format(server.server_address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(server.server_address)
+
+if __name__ == "__main__":
+    main()
@@ -8,3 +8,15 @@ ls "$RESULTS_PATH/container/foobar" || {
     echo "The artifact should have been copied"
     exit 1
 }
+
+$LXCI $BASE --verbose --name moved --command "echo data > /home/lxci/results/moved" 2>&1 | grep -q "move=1" || {
+    echo "The artifact should have been moved out of the destroyed container"
+    exit 1
+}
+
+$LXCI $BASE --name linked --archive --command "echo data > /home/lxci/results/linked"
+src="$(find "$ARCHIVE_CONFIG_PATH/linked" -path "*/home/lxci/results/linked" | head -n 1)"
+if [ "$(stat -c %u "$src")" = "$(id -u)" ] && [ "$(stat -c %i "$src")" != "$(stat -c %i "$RESULTS_PATH/linked/linked")" ]; then
+    echo "The artifact owned by the results owner should have been hardlinked"
+    exit 1
+fi
@@ -0,0 +1,13 @@
+#!/bin/sh
+
+set -eu
+
+$LXCI $BASE --name container --exec-backend attach --command '[ "$(id -un)" = "lxci" ]' || {
+    echo "Command should have been executed as the lxci user"
+    exit 1
+}
+
+$LXCI $BASE --name container --exec-backend attach --command "exit 3" && {
+    echo "Exit status should have been passed through"
+    exit 1
+} || true
@@ -0,0 +1,51 @@
+#!/bin/sh
+
+set -eu
+
+cat > "$LXCI_HOME/manifest.json" <<EOF2
+{
+    "defaults": {"snapshot": true, "tag": "batch-{name}"},
+    "jobs": [
+        {"base": "$BASE", "name": "batch1", "command": "exit 0"},
+        {"base": "$BASE", "name": "batch2", "command": "exit 0"}
+    ]
+}
+EOF2
+
+./lxci.py --batch "$LXCI_HOME/manifest.json" --jobs 2 || {
+    echo "All jobs should have succeeded"
+    exit 1
+}
+
+cat > "$LXCI_HOME/manifest.json" <<EOF2
+{
+    "defaults": {"snapshot": true},
+    "jobs": [
+        {"base": "$BASE", "name": "batch1", "command": "exit 0"},
+        {"base": "$BASE", "name": "batch2", "command": "exit 1"}
+    ]
+}
+EOF2
+
+./lxci.py --batch "$LXCI_HOME/manifest.json" --jobs 2 && {
+    echo "Batch should fail if any of the jobs fail"
+    exit 1
+} || true
+
+cat > "$LXCI_HOME/manifest.json" <<EOF2
+{
+    "jobs": [
+        {"base": "$BASE", "name": "batch-{foo}", "command": "exit 0"}
+    ]
+}
+EOF2
+
+res="$(./lxci.py --batch "$LXCI_HOME/manifest.json" 2>&1)" && {
+    echo "Batch should fail on an unknown placeholder"
+    exit 1
+} || true
+
+echo "$res" | grep -q "Invalid placeholder in manifest job 0 name" || {
+    echo "An unknown placeholder should be reported without a traceback"
+    exit 1
+}
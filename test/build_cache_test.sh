@@ -0,0 +1,26 @@
+#!/bin/sh
+
+set -eu
+
+echo "BUILD_CACHE_PATH=$LXCI_HOME/build-cache" >> "$LXCI_HOME/config"
+
+$LXCI $BASE --tag bcache --build-cache --command 'test "$CCACHE_DIR" = /home/lxci/cache/ccache && echo one > /home/lxci/cache/file'
+
+$LXCI $BASE --tag bcache --build-cache --command 'test "$(cat /home/lxci/cache/file)" = one && echo two > /home/lxci/cache/file && false' || true
+
+$LXCI $BASE --tag bcache --build-cache --command 'test "$(cat /home/lxci/cache/file)" = one' || {
+    echo "A failed build should not have replaced the build cache"
+    exit 1
+}
+
+$LXCI $BASE --name bcache-rerun --tag bcache --build-cache --command 'true'
+$LXCI $BASE --name bcache-rerun --tag bcache --build-cache --command 'test "$(cat /home/lxci/cache/file)" = one' || {
+    echo "A rerun with the same --name should keep the build cache"
+    exit 1
+}
+
+$LXCI $BASE --tag bcache --build-cache --command 'rm /home/lxci/cache/file'
+$LXCI $BASE --tag bcache --build-cache --command 'test ! -e /home/lxci/cache/file' || {
+    echo "A file removed by a successful build should be gone from the build cache"
+    exit 1
+}
@@ -0,0 +1,10 @@
+#!/bin/sh
+
+set -eu
+
+$LXCI $BASE --name logged --command "echo hello from the build"
+
+grep -q "^[0-9-]* [0-9:.]* hello from the build" "$RESULTS_PATH/logged.log" || {
+    echo "The output should have been saved with timestamps to the build log"
+    exit 1
+}
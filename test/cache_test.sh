@@ -0,0 +1,17 @@
+#!/bin/sh
+
+set -eu
+
+$LXCI $BASE --cache --name cached1 --command "id lxci && test -f /home/lxci/.ssh/authorized_keys"
+
+[ "$(./lxci.py --list cache | wc -l)" = "1" ] || {
+    echo "There should be one cached base container"
+    exit 1
+}
+
+$LXCI $BASE --cache --name cached2 --command "id lxci"
+
+[ "$(./lxci.py --list cache | wc -l)" = "1" ] || {
+    echo "The cached base container should have been reused"
+    exit 1
+}
@@ -0,0 +1,11 @@
+#!/bin/sh
+
+set -eu
+
+$LXCI $BASE --checkpoint --name restored1 --command "true"
+$LXCI $BASE --checkpoint --name restored2 --archive --command 'test "$(hostname)" = restored2'
+
+./lxci.py --info restored2 | grep -q '"restored": true' || {
+    echo "The container should have been restored from the checkpoint"
+    exit 1
+}
@@ -0,0 +1,25 @@
+#!/bin/sh
+
+set -eu
+
+./lxcid.py &
+daemon_pid=$!
+trap "kill $daemon_pid" EXIT
+
+echo "USE_DAEMON=1" >> "$LXCI_HOME/config"
+sleep 1
+
+res="$($LXCI $BASE --name daemon1 --command "echo hello from lxcid; exit 3" </dev/null)" && {
+    echo "The exit status of the build should have been passed from lxcid"
+    exit 1
+}
+
+echo "$res" | grep -q "hello from lxcid" || {
+    echo "The output of the build should have been streamed from lxcid"
+    exit 1
+}
+
+[ -f "$RESULTS_PATH/daemon1.log" ] || {
+    echo "The build should have been run by lxcid"
+    exit 1
+}
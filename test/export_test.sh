@@ -0,0 +1,31 @@
+#!/bin/sh
+
+set -eu
+
+echo "EXPORT_PATH=$LXCI_HOME/exports" >> "$LXCI_HOME/config"
+
+$LXCI $BASE --name exported1 --archive --memory-limit 512M --command "echo hello > /home/lxci/hello"
+
+./lxci.py --export exported1
+
+./lxci.py --list archive | grep -q "^exported1$" && {
+    echo "The exported container should have been removed from the archive"
+    exit 1
+}
+
+[ "$(./lxci.py --list export)" = "exported1" ] || {
+    echo "The export should be listed"
+    exit 1
+}
+
+./lxci.py --inspect exported1 < /dev/null
+
+./lxci.py --info exported1 | grep -q restored_from || {
+    echo "--inspect should have restored the export to the archive"
+    exit 1
+}
+
+grep -q "memory.*512M" "$ARCHIVE_CONFIG_PATH/exported1/config" || {
+    echo "The container config should have been restored from the export"
+    exit 1
+}
@@ -0,0 +1,20 @@
+#!/bin/sh
+
+set -eu
+
+for i in 1 2 3; do
+    $LXCI $BASE --name gc$i --tag gc --archive --command "true"
+done
+
+echo "ARCHIVE_MAX_PER_TAG=2" >> "$LXCI_HOME/config"
+./lxci.py --gc
+
+./lxci.py --list archive | grep -q "^gc1$" && {
+    echo "The oldest archive over ARCHIVE_MAX_PER_TAG should have been destroyed"
+    exit 1
+}
+
+[ "$(./lxci.py --list archive --tag gc | wc -l)" = "2" ] || {
+    echo "The two newest archives should have been kept"
+    exit 1
+}
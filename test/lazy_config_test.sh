@@ -0,0 +1,30 @@
+#!/bin/sh
+
+set -eu
+
+home="$LXCI_HOME/lazy"
+
+LXCI_HOME="$home" ./lxci.py --version >/dev/null
+
+[ ! -e "$home" ] || {
+    echo "lxci --version should not create the config directories or the SSH key"
+    exit 1
+}
+
+LXCI_HOME="$home" python3 -c "import sys, lxci; lxci.config.VERSION; sys.exit('lxci._lxci' in sys.modules)" || {
+    echo "import lxci should not import the container code"
+    exit 1
+}
+
+$LXCI $BASE --name lazylist --archive --command true
+./lxci.py --list archive >/dev/null
+
+python3 -c "
+import runpy, sys
+sys.argv = ['lxci.py', '--list', 'archive']
+runpy.run_path('lxci.py', run_name='__main__')
+sys.exit('lxc' in sys.modules)
+" >/dev/null || {
+    echo "--list with an up to date index should not import lxc"
+    exit 1
+}
@@ -0,0 +1,22 @@
+#!/bin/sh
+
+set -eu
+
+mkdir -p "$HOME/tmp/workspace"
+echo hello > "$HOME/tmp/workspace/mountme"
+
+
+$LXCI $BASE --name container --sync "$HOME/tmp/workspace/" --sync-mode mount --command "cat mountme && echo changed > mountme && touch newfile" || {
+    echo "The workspace was not mounted or it was not writable"
+    exit 1
+}
+
+if [ "$(cat "$HOME/tmp/workspace/mountme")" != "hello" ]; then
+    echo "Writes in the container leaked to the host workspace"
+    exit 1
+fi
+
+if [ -e "$HOME/tmp/workspace/newfile" ]; then
+    echo "New file in the container leaked to the host workspace"
+    exit 1
+fi
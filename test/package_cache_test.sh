@@ -0,0 +1,19 @@
+#!/bin/sh
+
+set -eu
+
+echo "PACKAGE_CACHE_PATH=$LXCI_HOME/packages" >> "$LXCI_HOME/config"
+
+$LXCI $BASE --sudo --package-cache --name pkg1 --archive --command "sudo sh -c 'echo deb > /var/cache/apt/archives/lxci-test_1.0_all.deb'"
+
+[ -f "$LXCI_HOME/packages/$BASE/apt/lxci-test_1.0_all.deb" ] || {
+    echo "The downloaded package should have been added to the cache"
+    exit 1
+}
+
+./lxci.py --info pkg1 | grep -q "lxci-test_1.0_all.deb" || {
+    echo "The downloaded package should be in the meta data"
+    exit 1
+}
+
+$LXCI $BASE --package-cache --name pkg2 --command "test -f /var/cache/apt/archives/lxci-test_1.0_all.deb"
@@ -0,0 +1,17 @@
+#!/bin/sh
+
+set -eu
+
+$LXCI $BASE --fill-pool
+
+[ "$(./lxci.py --list pool | wc -l)" = "2" ] || {
+    echo "The pool should have two containers"
+    exit 1
+}
+
+$LXCI $BASE --pool --name pooltest --command "test -d /home/lxci/workspace"
+
+ls "$RUNTIME_CONFIG_PATH/pooltest" && {
+    echo "Container should have been destroyed"
+    exit 1
+} || true
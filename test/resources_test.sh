@@ -0,0 +1,15 @@
+#!/bin/sh
+
+set -eu
+
+$LXCI $BASE --name limited --memory-limit 256M --archive --command "dd if=/dev/zero of=/tmp/zero bs=1M count=10"
+
+grep -q "cpu_seconds" "$RESULTS_PATH/limited.resources.json" || {
+    echo "CPU time of the build should have been saved to the results path"
+    exit 1
+}
+
+./lxci.py --info limited | grep -q "256M" || {
+    echo "The memory limit should have been saved to the meta data"
+    exit 1
+}
@@ -0,0 +1,10 @@
+#!/bin/sh
+
+set -eu
+
+$LXCI $BASE --name container --results-format tar.gz --command "echo hello > /home/lxci/results/foobar"
+
+tar xzf "$RESULTS_PATH/container.tar.gz" -O SHA256SUMS | grep -q foobar || {
+    echo "The tarball should have a checksum for the artifact"
+    exit 1
+}
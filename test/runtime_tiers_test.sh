@@ -0,0 +1,13 @@
+#!/bin/sh
+
+set -eu
+
+echo "RUNTIME_TIERS=$LXCI_HOME/fast" >> "$LXCI_HOME/config"
+
+$LXCI $BASE --name tier1 --tag tiers --command "true"
+$LXCI $BASE --name tier2 --tag tiers --archive --command "true"
+
+./lxci.py --info tier2 | grep -q "\"tier\": \"$LXCI_HOME/fast\"" || {
+    echo "The second build should have been placed on the first tier"
+    exit 1
+}
@@ -0,0 +1,16 @@
+#!/bin/sh
+
+set -eu
+
+$LXCI $BASE --name stats1 --command "true"
+
+./lxci.py --stats | grep -q "^$BASE  *boot " || {
+    echo "Boot time of the build should be in the stats"
+    exit 1
+}
+
+./lxci.py --stats --prometheus "$LXCI_HOME/lxci.prom"
+grep -q "lxci_phase_seconds_count{base=\"$BASE\",phase=\"clone\"} 1" "$LXCI_HOME/lxci.prom" || {
+    echo "Prometheus export is missing the clone time"
+    exit 1
+}
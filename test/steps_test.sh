@@ -0,0 +1,15 @@
+#!/bin/sh
+
+set -eu
+
+$LXCI $BASE --name steps1 --archive-on-fail --step "one=touch /tmp/one" --step "two=test -f /tmp/one"
+
+$LXCI $BASE --name steps2 --archive --fail-fast --step "fail=exit 3" --step "never=true" && {
+    echo "The failed step should have failed the build"
+    exit 1
+}
+
+./lxci.py --info steps2 | grep -q '"skipped": true' || {
+    echo "The step after the failed one should have been skipped"
+    exit 1
+}